@@ -6,12 +6,37 @@
 
 import argparse
 import datetime
+import heapq
 import math
 import sqlite3
 import sys
 import time
 from datetime import timedelta
 
+import numpy as np
+
+import astroSchedule
+import metrics
+import styringDB
+
+EPOCH = datetime.datetime(1970, 1, 1)  # Reference for event times in microseconds
+BATCH_INTERVAL = 10  # Seconds between cycles in --batch mode
+ASTRO_COLUMNS = (
+    "lastastrotime",
+    "lasastroOP",
+    "nextastrotime",
+    "nextastroOP",
+    "astrostate",
+)
+SCHEDULER_MAX_SLEEP = 60  # Longest scheduler sleep before checking for device changes
+SCHEDULER_RECHECK = 3600  # Recheck interval for devices without an upcoming event
+
+# Lag between a scheduled astro event and astrostate being flipped in the database
+flip_lag_seconds = metrics.histogram(
+    "gungnir_astro_flip_lag_seconds",
+    "Time from a scheduled astro event until its astrostate was written.",
+)
+
 
 def calculate_sunrise_sunset(date, latitude, longitude):
     """Calculate the sunrise and sunset times for the given date and location."""
@@ -86,6 +111,72 @@ def calculate_sunrise_sunset(date, latitude, longitude):
     return sunrise_time, sunset_time
 
 
+def calculate_sunrise_sunset_batch(dates, latitudes, longitudes):
+    """Calculate sunrise and sunset times for many locations and dates at once.
+
+    Vectorized version of calculate_sunrise_sunset(). Returns two arrays of
+    shape (len(latitudes), len(dates)) with dtype datetime64[us]. Entries are
+    NaT on days where the sun never rises or never sets at that location.
+    """
+    zenith = 90.833  # Official zenith for sunrise/sunset
+
+    latitudes = np.asarray(latitudes, dtype=float).reshape(-1, 1)
+    longitudes = np.asarray(longitudes, dtype=float).reshape(-1, 1)
+    day_start = np.array(dates, dtype="datetime64[D]").astype("datetime64[us]")
+
+    # Day of the year for every date, as a row vector
+    N = np.array([date.timetuple().tm_yday for date in dates], dtype=float)
+    N = N.reshape(1, -1)
+
+    # Convert longitude to hour value
+    lng_hour = longitudes / 15
+
+    def solar_hour_angle_terms(t):
+        M = (0.9856 * t) - 3.289
+        L = (
+            M
+            + (1.916 * np.sin(np.radians(M)))
+            + (0.020 * np.sin(np.radians(2 * M)))
+            + 282.634
+        ) % 360
+        RA = np.degrees(np.arctan(0.91764 * np.tan(np.radians(L)))) % 360
+        RA = RA + (np.floor(L / 90) * 90 - np.floor(RA / 90) * 90)
+        RA = RA / 15
+        sinDec = 0.39782 * np.sin(np.radians(L))
+        cosDec = np.cos(np.arcsin(sinDec))
+        cosH = (
+            np.cos(np.radians(zenith)) - (sinDec * np.sin(np.radians(latitudes)))
+        ) / (cosDec * np.cos(np.radians(latitudes)))
+        return RA, cosH
+
+    # Sunrise calculations
+    t_rise = N + ((6 - lng_hour) / 24)
+    RA_rise, cosH_rise = solar_hour_angle_terms(t_rise)
+
+    # Sunset calculations
+    t_set = N + ((18 - lng_hour) / 24)
+    RA_set, cosH_set = solar_hour_angle_terms(t_set)
+
+    # Same rule as the scalar version: a day without a sunrise or without a
+    # sunset has no events at all (polar night / midnight sun).
+    no_event = (np.abs(cosH_rise) > 1) | (np.abs(cosH_set) > 1)
+
+    H_rise = (360 - np.degrees(np.arccos(np.clip(cosH_rise, -1, 1)))) / 15
+    T_rise = H_rise + RA_rise - (0.06571 * t_rise) - 6.622
+    UT_rise = (T_rise - lng_hour) % 24
+
+    H_set = np.degrees(np.arccos(np.clip(cosH_set, -1, 1))) / 15
+    T_set = H_set + RA_set - (0.06571 * t_set) - 6.622
+    UT_set = (T_set - lng_hour) % 24
+
+    sunrise_times = day_start + np.rint(UT_rise * 3600e6).astype("timedelta64[us]")
+    sunset_times = day_start + np.rint(UT_set * 3600e6).astype("timedelta64[us]")
+    sunrise_times[no_event] = np.datetime64("NaT")
+    sunset_times[no_event] = np.datetime64("NaT")
+
+    return sunrise_times, sunset_times
+
+
 def calculate_events(current_time, latitude, longitude, offset):
     """Calculate the last event, next event, and the event after."""
     # Collect events over a 3-day window
@@ -133,11 +224,100 @@ def calculate_events(current_time, latitude, longitude, offset):
     return last_event, next_event, event_after, current_state
 
 
-def write_to_db(styring_db, device_id, last_event, next_event, current_state):
-    conn = sqlite3.connect(styring_db)
-    cursor = conn.cursor()
+def calculate_event_series(dates, latitudes, longitudes, offset):
+    """Calculate the sorted ON/OFF event series for many locations at once.
 
-    # Prepare data to update
+    Returns (times, is_on, keep) arrays of shape (locations, 2 * len(dates)).
+    Times are microseconds since the epoch sorted per row, with missing
+    events sorted last. keep marks the events calculate_events() would use:
+    present and not a consecutive duplicate of the previous action.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    sunrise_times, sunset_times = calculate_sunrise_sunset_batch(
+        dates, latitudes, longitudes
+    )
+
+    # Adjust for offset
+    offset = np.broadcast_to(np.asarray(offset, dtype="int64"), latitudes.shape)
+    offset = offset.astype("timedelta64[m]").reshape(-1, 1)
+    sunrise_times = sunrise_times + offset
+    sunset_times = sunset_times - offset
+
+    # Interleave the events per day (sunrise, sunset) and work in integer
+    # microseconds. Missing events sort last.
+    missing = np.iinfo(np.int64).max
+    times = np.stack([sunrise_times, sunset_times], axis=2).reshape(len(latitudes), -1)
+    is_missing = np.isnat(times)
+    times = times.astype("int64")
+    times[is_missing] = missing
+    is_on = np.tile([False, True], len(dates))
+    is_on = np.broadcast_to(is_on, times.shape)
+
+    # Sort events by time
+    order = np.argsort(times, axis=1, kind="stable")
+    times = np.take_along_axis(times, order, axis=1)
+    is_on = np.take_along_axis(is_on, order, axis=1)
+
+    # Remove consecutive duplicate actions
+    keep = times != missing
+    keep[:, 1:] &= is_on[:, 1:] != is_on[:, :-1]
+
+    return times, is_on, keep
+
+
+def event_from_micros(is_on, micros):
+    """Build an (action, datetime) event from a calculate_event_series() entry."""
+    action = "ON" if is_on else "OFF"
+    return (action, EPOCH + timedelta(microseconds=int(micros)))
+
+
+def calculate_events_batch(current_time, latitudes, longitudes, offset):
+    """Calculate events for many locations at once.
+
+    Returns a list with one (last_event, next_event, event_after,
+    current_state) tuple per location, exactly as calculate_events() would.
+    The offset may be a single number of minutes or one value per location.
+    """
+    if len(latitudes) == 0:
+        return []
+
+    # Collect events over the same window as calculate_events()
+    dates = [current_time.date() + timedelta(days=d) for d in range(-1, 4)]
+    times, is_on, keep = calculate_event_series(dates, latitudes, longitudes, offset)
+
+    # Find last event before current time and the two events after it
+    now = np.datetime64(current_time, "us").astype("int64")
+    past = keep & (times <= now)
+    future = keep & (times > now)
+    future_rank = np.cumsum(future, axis=1)
+    width = times.shape[1]
+    last_index = np.where(
+        past.any(axis=1), width - 1 - np.argmax(past[:, ::-1], axis=1), -1
+    )
+    next_index = np.where(future_rank[:, -1] >= 1, np.argmax(future, axis=1), -1)
+    after_index = np.where(
+        future_rank[:, -1] >= 2, np.argmax(future & (future_rank == 2), axis=1), -1
+    )
+
+    def to_event(row, index):
+        if index < 0:
+            return None
+        return event_from_micros(is_on[row, index], times[row, index])
+
+    results = []
+    for row in range(len(times)):
+        last_event = to_event(row, last_index[row])
+        next_event = to_event(row, next_index[row])
+        event_after = to_event(row, after_index[row])
+        current_state = last_event[0] if last_event else "OFF"  # Default state
+        results.append((last_event, next_event, event_after, current_state))
+
+    return results
+
+
+def astro_columns(last_event, next_event, current_state):
+    """Return the astro column values written for a device, in ASTRO_COLUMNS order."""
     timestamp_format = "%Y-%m-%dT%H:%M:%S.%f"  # ISO 8601 format with microseconds
 
     lastastrotime = last_event[1].strftime(timestamp_format) if last_event else None
@@ -146,48 +326,61 @@ def write_to_db(styring_db, device_id, last_event, next_event, current_state):
     nextastroOP = next_event[0] if next_event else None
     astrostate = current_state  # Current state of the lights (ON/OFF)
 
+    return (lastastrotime, lasastroOP, nextastrotime, nextastroOP, astrostate)
+
+
+def write_to_db(styring_db, device_id, last_event, next_event, current_state):
+    # Prepare data to update
+    values = astro_columns(last_event, next_event, current_state)
+
     # Update the database
     try:
-        cursor.execute(
-            """
-            UPDATE heimtaugaskapar
-            SET lastastrotime = ?,
-                lasastroOP = ?,
-                nextastrotime = ?,
-                nextastroOP = ?,
-                astrostate = ?
-            WHERE id = ?
-        """,
-            (
-                lastastrotime,
-                lasastroOP,
-                nextastrotime,
-                nextastroOP,
-                astrostate,
-                device_id,
-            ),
+        styringDB.update_devices(
+            ASTRO_COLUMNS, [(device_id, values)], db_name=styring_db
         )
-        conn.commit()
     except sqlite3.Error as e:
         print(f"An error occurred while updating the database for {device_id}: {e}")
-    finally:
-        conn.close()
+
+
+def write_to_db_batch(styring_db, events_by_id):
+    """Write the events of many devices in one transaction.
+
+    Rows whose astro columns already hold the new values are skipped, so a
+    cycle where nothing changed does not take the write lock at all.
+    Returns the number of rows written.
+    """
+    if not events_by_id:
+        return 0
+
+    try:
+        current = {
+            device["id"]: tuple(device[column] for column in ASTRO_COLUMNS)
+            for device in styringDB.get_all_devices(db_name=styring_db)
+        }
+
+        changed = []
+        for device_id, events in events_by_id.items():
+            last_event, next_event, _, current_state = events
+            values = astro_columns(last_event, next_event, current_state)
+            if device_id in current and current[device_id] != values:
+                changed.append((device_id, values))
+
+        # One transaction for the whole cycle
+        styringDB.update_devices(ASTRO_COLUMNS, changed, db_name=styring_db)
+    except sqlite3.Error as e:
+        print(f"An error occurred while updating the database: {e}")
+        return 0
+
+    return len(changed)
 
 
 def get_all_devices(styring_db):
     """Retrieve all devices from the database."""
-    conn = sqlite3.connect(styring_db)
-    conn.row_factory = sqlite3.Row  # Enable dict-like access
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT * FROM heimtaugaskapar")
-        rows = cursor.fetchall()
-        devices = [dict(row) for row in rows]
+        devices = styringDB.get_all_devices(db_name=styring_db)
     except sqlite3.Error as e:
         print(f"An error occurred while fetching devices: {e}")
         devices = []
-    finally:
-        conn.close()
     return devices
 
 
@@ -214,20 +407,23 @@ def process_device(device_info, current_time, args, styring_db):
         latitude = float(latitude)
         longitude = float(longitude)
 
-        # Calculate events
-        last_event, next_event, event_after, current_state = calculate_events(
-            current_time, latitude, longitude, args.offset
-        )
+        # Look up events in the materialized schedule, or calculate them
+        events = None
+        if args.schedule:
+            events = astroSchedule.lookup_events(styring_db, device_id, current_time)
+        if events is None:
+            events = calculate_events(current_time, latitude, longitude, args.offset)
+        last_event, next_event, event_after, current_state = events
 
         if args.verbose:
-            messages.append(f"\nDevice ID: {device_id}")
-            messages.append(
-                f"It is now {current_time.strftime('%d%b %H:%M:%S')} UTC -- The Lights are {current_state}"
+            messages.extend(
+                verbose_messages(
+                    device_id,
+                    current_time,
+                    args.offset,
+                    (last_event, next_event, event_after, current_state),
+                )
             )
-            messages.append(f"The configured offset is: {args.offset} minutes")
-            messages.append(print_event_str("Last event", last_event))
-            messages.append(print_event_str("Next event", next_event))
-            messages.append(print_event_str("Event after", event_after))
 
         if args.write2db:
             write_to_db(styring_db, device_id, last_event, next_event, current_state)
@@ -235,6 +431,216 @@ def process_device(device_info, current_time, args, styring_db):
     return messages
 
 
+def verbose_messages(device_id, current_time, offset, events):
+    """Return the verbose report lines for one device."""
+    last_event, next_event, event_after, current_state = events
+    return [
+        f"\nDevice ID: {device_id}",
+        f"It is now {current_time.strftime('%d%b %H:%M:%S')} UTC -- The Lights are {current_state}",
+        f"The configured offset is: {offset} minutes",
+        print_event_str("Last event", last_event),
+        print_event_str("Next event", next_event),
+        print_event_str("Event after", event_after),
+    ]
+
+
+def compute_events(devices, current_time, args, styring_db):
+    """Return a dict of device id -> events for every device with a location."""
+    located = [
+        device_info
+        for device_info in devices
+        if device_info.get("lat") is not None and device_info.get("lon") is not None
+    ]
+
+    events_by_id = {}
+    if args.schedule:
+        # Look up events in the materialized schedule where possible
+        for device_info in located:
+            events = astroSchedule.lookup_events(
+                styring_db, device_info["id"], current_time
+            )
+            if events is not None:
+                events_by_id[device_info["id"]] = events
+        located = [
+            device_info
+            for device_info in located
+            if device_info["id"] not in events_by_id
+        ]
+
+    results = calculate_events_batch(
+        current_time,
+        [float(device_info["lat"]) for device_info in located],
+        [float(device_info["lon"]) for device_info in located],
+        args.offset,
+    )
+    for device_info, events in zip(located, results):
+        events_by_id[device_info["id"]] = events
+
+    return events_by_id
+
+
+def process_devices(devices, current_time, args, styring_db):
+    """Process a list of devices with a single vectorized calculation."""
+    messages = []
+    events_by_id = compute_events(devices, current_time, args, styring_db)
+
+    for device_info in devices:
+        device_id = device_info["id"]
+        if device_id not in events_by_id:
+            msg = f"Device '{device_id}' does not have latitude and longitude information."
+            messages.append(msg)
+            continue
+
+        events = events_by_id[device_id]
+        last_event, next_event, event_after, current_state = events
+
+        if args.verbose:
+            messages.extend(
+                verbose_messages(device_id, current_time, args.offset, events)
+            )
+
+        if args.write2db:
+            write_to_db(styring_db, device_id, last_event, next_event, current_state)
+
+    return messages
+
+
+def run_batch(args, styring_db):
+    """Recompute the whole fleet every cycle and write it in one transaction."""
+    while True:
+        current_time = datetime.datetime.utcnow()
+        devices = load_devices(styring_db, args.id)
+        if args.schedule:
+            astroSchedule.refresh_schedule(styring_db, args.offset, current_time)
+
+        with metrics.sweep_seconds.time(loop="RelevantEvents-batch"):
+            events_by_id = compute_events(devices, current_time, args, styring_db)
+            written = write_to_db_batch(styring_db, events_by_id)
+
+        if args.verbose:
+            for device_id, events in events_by_id.items():
+                for msg in verbose_messages(
+                    device_id, current_time, args.offset, events
+                ):
+                    print(msg)
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        print(
+            f"{timestamp} - Updated event data for {written} of {len(events_by_id)} devices."
+        )
+
+        time.sleep(BATCH_INTERVAL)
+
+
+def load_devices(styring_db, device_id=None):
+    """Fetch one device by ID, or all devices when no ID is given."""
+    if not device_id:
+        return get_all_devices(styring_db)
+
+    device = styringDB.get_device_by_id(device_id, db_name=styring_db)
+    if device:
+        return [device]
+    print(f"No device found with ID {device_id}")
+    return []
+
+
+def device_locations(devices):
+    """Return the (id, lat, lon) set the scheduler uses to detect fleet changes."""
+    return {
+        (device_info["id"], device_info.get("lat"), device_info.get("lon"))
+        for device_info in devices
+    }
+
+
+def run_scheduler(args, styring_db):
+    """Sleep until the earliest next event in the fleet and flip the devices due.
+
+    Each device sits in a heap keyed by its next event time, so switching
+    latency does not depend on the number of devices. The lag between the
+    scheduled and the actual flip is recorded for every flip.
+    """
+    heap = []
+    lag_stats = {"flips": 0, "total": 0.0, "max": 0.0}
+
+    def schedule_devices(devices, current_time):
+        events_by_id = compute_events(devices, current_time, args, styring_db)
+        write_to_db_batch(styring_db, events_by_id)
+        for device_id, events in events_by_id.items():
+            last_event, next_event, event_after, current_state = events
+            if next_event:
+                heapq.heappush(heap, (next_event[1], device_id, True))
+            else:
+                # No upcoming event (polar day/night), check again later
+                recheck_time = current_time + timedelta(seconds=SCHEDULER_RECHECK)
+                heapq.heappush(heap, (recheck_time, device_id, False))
+        return events_by_id
+
+    devices = load_devices(styring_db, args.id)
+    locations = device_locations(devices)
+    schedule_devices(devices, datetime.datetime.utcnow())
+    print(f"Scheduled {len(heap)} devices.")
+
+    while True:
+        # Sleep until the earliest event, but wake up regularly to pick up
+        # added, removed or moved devices.
+        wait = SCHEDULER_MAX_SLEEP
+        if heap:
+            until_next = (heap[0][0] - datetime.datetime.utcnow()).total_seconds()
+            wait = min(max(until_next, 0), SCHEDULER_MAX_SLEEP)
+        time.sleep(wait)
+
+        current_time = datetime.datetime.utcnow()
+        due = []
+        while heap and heap[0][0] <= current_time:
+            due.append(heapq.heappop(heap))
+
+        if not due:
+            if args.schedule:
+                astroSchedule.refresh_schedule(styring_db, args.offset, current_time)
+            fresh_devices = load_devices(styring_db, args.id)
+            fresh_locations = device_locations(fresh_devices)
+            if fresh_locations != locations:
+                devices, locations = fresh_devices, fresh_locations
+                heap = []
+                schedule_devices(devices, current_time)
+                print(f"Device list changed, rescheduled {len(heap)} devices.")
+            continue
+
+        due_ids = {device_id for _, device_id, _ in due}
+        with metrics.sweep_seconds.time(loop="RelevantEvents-scheduler"):
+            events_by_id = schedule_devices(
+                [device for device in devices if device["id"] in due_ids],
+                current_time,
+            )
+
+        # Measure how late each flip landed compared to its scheduled time
+        flipped_at = datetime.datetime.utcnow()
+        lags = [
+            (flipped_at - scheduled_time).total_seconds()
+            for scheduled_time, _, is_event in due
+            if is_event
+        ]
+        for lag in lags:
+            flip_lag_seconds.observe(lag)
+        if lags:
+            lag_stats["flips"] += len(lags)
+            lag_stats["total"] += sum(lags)
+            lag_stats["max"] = max(lag_stats["max"], max(lags))
+            timestamp = flipped_at.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            print(
+                f"{timestamp} - Flipped {len(lags)} devices, "
+                f"lag max {max(lags) * 1000:.0f} ms "
+                f"(overall avg {lag_stats['total'] / lag_stats['flips'] * 1000:.0f} ms, "
+                f"max {lag_stats['max'] * 1000:.0f} ms over {lag_stats['flips']} flips)"
+            )
+
+        if args.verbose:
+            for device_id in sorted(events_by_id):
+                for msg in verbose_messages(
+                    device_id, current_time, args.offset, events_by_id[device_id]
+                ):
+                    print(msg)
+
+
 # Main execution starts here
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -262,10 +668,31 @@ if __name__ == "__main__":
         default=0,
         help="Offset in minutes for lights ON/OFF times",
     )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="Look up events in the precomputed astro_schedule table instead of calculating them.",
+    )
+    parser.add_argument(
+        "--scheduler",
+        action="store_true",
+        help="With --write2db, sleep until the next event is due instead of visiting one device per second.",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help=f"With --write2db, update all devices in one transaction every {BATCH_INTERVAL} seconds.",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
     args = parser.parse_args()
 
     styring_db = "styring.db"
 
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
     if args.write2db and args.test:
         print("Error: The --write2db flag cannot be used with --test.")
         sys.exit(1)
@@ -286,27 +713,21 @@ if __name__ == "__main__":
         current_time = datetime.datetime.utcnow()
 
     try:
-        if args.id:
-            # Fetch the device information from the database
-            conn = sqlite3.connect(styring_db)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM heimtaugaskapar WHERE id = ?", (args.id,))
-            row = cursor.fetchone()
-            if row:
-                devices = [dict(row)]
-            else:
-                print(f"No device found with ID {args.id}")
-                devices = []
-            conn.close()
-        else:
-            devices = get_all_devices(styring_db)
+        devices = load_devices(styring_db, args.id)
+
+        if args.schedule and not args.test:
+            # Bring the materialized schedule up to date before using it
+            astroSchedule.refresh_schedule(styring_db, args.offset, current_time)
 
         device_count = len(devices)
         device_index = 0
         output_messages = []
 
-        if args.write2db:
+        if args.write2db and args.scheduler:
+            run_scheduler(args, styring_db)
+        elif args.write2db and args.batch:
+            run_batch(args, styring_db)
+        elif args.write2db:
             # Loop indefinitely when --write2db is specified
             while True:
                 current_time = datetime.datetime.utcnow()
@@ -324,6 +745,11 @@ if __name__ == "__main__":
 
                 # If we've completed a full cycle, output the messages and reset
                 if device_index == 0:
+                    if args.schedule:
+                        # Extend the horizon and pick up lat/lon changes
+                        astroSchedule.refresh_schedule(
+                            styring_db, args.offset, datetime.datetime.utcnow()
+                        )
                     if args.verbose:
                         # Output the collected messages
                         for msg in output_messages:
@@ -338,10 +764,9 @@ if __name__ == "__main__":
                     output_messages = []
         else:
             # Process devices once and exit
-            for device_info in devices:
-                messages = process_device(device_info, current_time, args, styring_db)
-                for msg in messages:
-                    print(msg)
+            messages = process_devices(devices, current_time, args, styring_db)
+            for msg in messages:
+                print(msg)
 
     except KeyboardInterrupt:
         print("\nScript terminated by user.")
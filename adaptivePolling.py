@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# adaptivePolling.py - decides how often each cabinet is polled
+
+import datetime
+from collections import deque
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"  # Format of the astro and command times
+
+DENSE_INTERVAL = 15  # Seconds between polls around a flip or after a command
+TRANSITION_WINDOW = 600  # Seconds before and after a scheduled flip polled densely
+COMMAND_WINDOW = 300  # Seconds after a switch command polled densely
+BASE_INTERVAL = 60  # Seconds between polls right after a state change
+MAX_INTERVAL = 1800  # Longest back-off between polls of a stable device
+BACKOFF_FACTOR = 2  # Interval growth for each poll that found nothing new
+FLAP_WINDOW = 3600  # Seconds of LOCAL/REMOTE history used to spot flapping
+FLAP_THRESHOLD = 2  # LOCAL/REMOTE changes within the window that count as flapping
+FLAP_INTERVAL = 30  # Seconds between polls of a flapping device
+
+
+def parse_time(value):
+    """Parse a stored timestamp, returning None if it is missing or invalid."""
+    if not value:
+        return None
+    for timestamp_format in (TIMESTAMP_FORMAT, "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, timestamp_format)
+        except ValueError:
+            continue
+    return None
+
+
+class AdaptivePollScheduler:
+    """Keeps a next-poll time per device and picks the devices to poll.
+
+    Devices are polled densely in the minutes around their scheduled astro
+    flip (nextastrotime/lastastrotime) and after a switch command, back off
+    exponentially while nothing changes, and get any spare budget when their
+    LOCAL/REMOTE state has been flapping.
+    """
+
+    def __init__(self):
+        self.intervals = {}  # Device id -> current back-off interval in seconds
+        self.next_due = {}  # Device id -> datetime of the next poll
+        self.last_polled = {}  # Device id -> datetime of the last poll
+        self.localremote = {}  # Device id -> last seen LOCAL/REMOTE state
+        self.flaps = {}  # Device id -> times LOCAL/REMOTE changed
+
+    def is_flapping(self, device_id, now):
+        flaps = self.flaps.get(device_id)
+        if not flaps:
+            return False
+        while flaps and (now - flaps[0]).total_seconds() > FLAP_WINDOW:
+            flaps.popleft()
+        return len(flaps) >= FLAP_THRESHOLD
+
+    def in_dense_window(self, device, command_time, now):
+        for column in ("nextastrotime", "lastastrotime"):
+            flip_time = parse_time(device.get(column))
+            if (
+                flip_time
+                and abs((now - flip_time).total_seconds()) <= TRANSITION_WINDOW
+            ):
+                return True
+        if command_time and 0 <= (now - command_time).total_seconds() <= COMMAND_WINDOW:
+            return True
+        return False
+
+    def interval(self, device, command_time, now):
+        """Return the seconds until this device should be polled again."""
+        device_id = device["id"]
+        if self.in_dense_window(device, command_time, now):
+            return DENSE_INTERVAL
+        if self.is_flapping(device_id, now):
+            return FLAP_INTERVAL
+        interval = self.intervals.get(device_id, BASE_INTERVAL)
+
+        # Never sleep through the start of the next flip's dense window
+        flip_time = parse_time(device.get("nextastrotime"))
+        if flip_time:
+            until_window = (flip_time - now).total_seconds() - TRANSITION_WINDOW
+            interval = min(interval, max(until_window, DENSE_INTERVAL))
+        return interval
+
+    def select(self, devices, command_times, now, budget, exclude=()):
+        """Pick up to budget devices to poll now, most overdue first.
+
+        A device whose last command is newer than its last poll is due right
+        away. Budget left over after the due devices goes to flapping devices
+        that are not due yet.
+        """
+        due = []
+        flapping = []
+        for device in devices:
+            device_id = device["id"]
+            if device_id in exclude:
+                continue
+            command_time = parse_time(command_times.get(device_id))
+            next_due = self.next_due.get(device_id, now)
+            last_polled = self.last_polled.get(device_id)
+            if command_time and (last_polled is None or command_time > last_polled):
+                next_due = min(next_due, command_time)
+            if next_due <= now:
+                due.append((next_due, device))
+            elif self.is_flapping(device_id, now):
+                flapping.append((next_due, device))
+
+        due.sort(key=lambda item: item[0])
+        selected = [device for _, device in due[:budget]]
+        if len(selected) < budget:
+            flapping.sort(key=lambda item: item[0])
+            spare = budget - len(selected)
+            selected.extend(device for _, device in flapping[:spare])
+        return selected
+
+    def record(self, device, changed, localremote, command_time, now):
+        """Update a device's cadence after a poll and schedule its next one."""
+        device_id = device["id"]
+        self.last_polled[device_id] = now
+
+        previous = self.localremote.get(device_id)
+        if localremote and previous and localremote != previous:
+            self.flaps.setdefault(device_id, deque()).append(now)
+        if localremote:
+            self.localremote[device_id] = localremote
+
+        if changed:
+            self.intervals[device_id] = BASE_INTERVAL
+        else:
+            interval = self.intervals.get(device_id, BASE_INTERVAL)
+            self.intervals[device_id] = min(interval * BACKOFF_FACTOR, MAX_INTERVAL)
+
+        seconds = self.interval(device, command_time, now)
+        self.next_due[device_id] = now + datetime.timedelta(seconds=seconds)
+        return seconds
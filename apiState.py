@@ -3,82 +3,55 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import argparse
-import os
-import sqlite3
-import subprocess
 
 import requests
-from dotenv import get_key, load_dotenv
 
-# Load environment variables
-load_dotenv()
-
-# Explicitly get USERNAME from the .env file
-USERNAME = get_key(".env", "USERNAME")
-PASSWORD = os.getenv("PASSWORD")
+import styringDB
+from controllerClient import get_client
+from metrics import controller_retries_total
+from updateDBcell import update_db_cell
 
 DB_NAME = "styring.db"  # Update this to your actual database name if different
-TIMEOUT = 5  # Timeout for API requests in seconds
 RETRY_LIMIT = 3  # Number of times to retry the API request
 
 
-# Function to get data from SQLite DB by device ID
-def get_device_info_by_id(device_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id, tsip, inputpin, outputpin FROM heimtaugaskapar WHERE id = ?"
-    cursor.execute(query, (device_id,))
-    result = cursor.fetchone()
+# Function to map a device row to the fields the controller API needs
+def device_info_from_row(device):
+    return {
+        "id": device["id"],
+        "ip": device["tsip"],
+        "input_pin": device["inputpin"],
+        "output_pin": device["outputpin"],
+    }
 
-    conn.close()
 
-    if result:
-        return {
-            "id": result[0],
-            "ip": result[1],
-            "input_pin": result[2],
-            "output_pin": result[3],
-        }
+# Function to get data from SQLite DB by device ID
+def get_device_info_by_id(device_id):
+    device = styringDB.get_device_by_id(device_id, db_name=DB_NAME)
+    if device:
+        return device_info_from_row(device)
     else:
         raise ValueError(f"No device found with id {device_id}")
 
 
 # Function to get data from SQLite DB by HS number
 def get_device_info_by_hs(hs):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id, tsip, inputpin, outputpin FROM heimtaugaskapar WHERE hs = ?"
-    cursor.execute(query, (hs,))
-    result = cursor.fetchone()
-
-    conn.close()
-
-    if result:
-        return {
-            "id": result[0],
-            "ip": result[1],
-            "input_pin": result[2],
-            "output_pin": result[3],
-        }
+    device = styringDB.get_device_by_hs(hs, db_name=DB_NAME)
+    if device:
+        return device_info_from_row(device)
     else:
         raise ValueError(f"No device found with hs {hs}")
 
 
 # Function to get output or input pin by IP address
 def get_device_info_by_ip(ip):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id, inputpin, outputpin FROM heimtaugaskapar WHERE tsip = ?"
-    cursor.execute(query, (ip,))
-    result = cursor.fetchone()
-
-    conn.close()
-
-    if result:
-        return {"id": result[0], "input_pin": result[1], "output_pin": result[2]}
+    device = styringDB.get_device_by_tsip(ip, db_name=DB_NAME)
+    if device:
+        return {
+            "id": device["id"],
+            "input_pin": device["inputpin"],
+            "output_pin": device["outputpin"],
+        }
     else:
         raise ValueError(f"No device found with IP {ip}")
 
@@ -90,18 +63,10 @@ def check_pin_state(device_info, var):
     # Select pin based on --var flag (either input_pin or output_pin)
     pin = device_info["input_pin"] if var == "inputstate" else device_info["output_pin"]
 
-    # Construct the URL with plain-text credentials in the query string
-    url = f"http://{ip}/cgi-bin/io_value"
-    payload = {
-        "username": USERNAME,
-        "password": PASSWORD,
-        "pin": pin,
-    }
-
-    # Send the request
+    # Send the request over the controller's keep-alive session
     for attempt in range(RETRY_LIMIT):
         try:
-            response = requests.get(url, params=payload, timeout=TIMEOUT)
+            response = get_client().io_value(ip, pin)
 
             if response.status_code == 200:
                 pin_state = (
@@ -116,26 +81,20 @@ def check_pin_state(device_info, var):
             print(
                 f"Attempt {attempt + 1}/{RETRY_LIMIT}: Error communicating with {ip}: {e}"
             )
+            if attempt + 1 < RETRY_LIMIT:
+                controller_retries_total.inc(script="apiState")
 
     return None
 
 
-# Function to update the DB using updateDBcell.py script
+# Function to update the database through updateDBcell
 def update_db(device_id, col_to_change, new_value):
-    # fmt: off
-    command = [
-        "python3", "updateDBcell.py",
-        "--db", DB_NAME,
-        "--table", "heimtaugaskapar",
-        "--colchange", col_to_change,
-        "--colname", "id",
-        "--colnamerow", device_id,
-        "--newval", new_value,
-    ]
-    # fmt: on
-
-    result = subprocess.run(command, capture_output=True, text=True)
-    print(result.stdout)
+    try:
+        update_db_cell(
+            DB_NAME, "heimtaugaskapar", col_to_change, "id", device_id, new_value
+        )
+    except Exception as e:
+        print(f"Error: {e}")
 
 
 # Main function to handle command-line arguments
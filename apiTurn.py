@@ -3,65 +3,43 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import argparse
-import os
-import sqlite3
-import subprocess
+import datetime
 
 import requests
-from dotenv import get_key, load_dotenv
 
-# Load environment variables
-load_dotenv()
-
-# Explicitly get USERNAME from the .env file directly
-USERNAME = get_key(".env", "USERNAME")
-PASSWORD = os.getenv("PASSWORD")
+import styringDB
+from controllerClient import USERNAME, get_client
+from metrics import controller_retries_total
+from updateDBcell import update_db_cell
 
 DB_NAME = "styring.db"  # Update this to your actual database name if different
-TIMEOUT = 5  # Timeout for API requests in seconds
 RETRY_LIMIT = 3  # Number of times to retry the API request
 
 
+# Function to map a device row to the fields the controller API needs
+def device_info_from_row(device):
+    return {
+        "id": device["id"],
+        "ip": device["tsip"],
+        "input_pin": device["inputpin"],
+        "output_pin": device["outputpin"],
+    }
+
+
 # Function to get data from SQLite DB by device ID
 def get_device_info_by_id(device_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id, tsip, inputpin, outputpin FROM heimtaugaskapar WHERE id = ?"
-    cursor.execute(query, (device_id,))
-    result = cursor.fetchone()
-
-    conn.close()
-
-    if result:
-        return {
-            "id": result[0],
-            "ip": result[1],
-            "input_pin": result[2],
-            "output_pin": result[3],
-        }
+    device = styringDB.get_device_by_id(device_id, db_name=DB_NAME)
+    if device:
+        return device_info_from_row(device)
     else:
         raise ValueError(f"No device found with id {device_id}")
 
 
 # Function to get data from SQLite DB by HS number
 def get_device_info_by_hs(hs):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id, tsip, inputpin, outputpin FROM heimtaugaskapar WHERE hs = ?"
-    cursor.execute(query, (hs,))
-    result = cursor.fetchone()
-
-    conn.close()
-
-    if result:
-        return {
-            "id": result[0],
-            "ip": result[1],
-            "input_pin": result[2],
-            "output_pin": result[3],
-        }
+    device = styringDB.get_device_by_hs(hs, db_name=DB_NAME)
+    if device:
+        return device_info_from_row(device)
     else:
         raise ValueError(f"No device found with hs {hs}")
 
@@ -71,16 +49,8 @@ def turn_output(device_info, state):
     ip = device_info["ip"]
     pin = device_info["output_pin"]
 
-    # Construct the URL with plain-text credentials in the query string
-    url = f"http://{ip}/cgi-bin/io_state"
-    payload = {
-        "username": USERNAME,
-        "password": PASSWORD,
-        "pin": pin,
-        "state": state.lower(),
-    }
-
     # Print the URL without exposing the password
+    url = f"http://{ip}/cgi-bin/io_state"
     print(
         f"API URL: {url}?username={USERNAME}&pin={pin}&state={state.lower()} [password hidden]"
     )
@@ -88,12 +58,13 @@ def turn_output(device_info, state):
     # Send the request
     for attempt in range(RETRY_LIMIT):
         try:
-            response = requests.get(url, params=payload, timeout=TIMEOUT)
+            response = get_client().io_state(ip, pin, state)
 
             if response.status_code == 200:
                 print(
                     f"Successfully turned {state.upper()} {pin} for device with IP {ip}"
                 )
+                record_command(device_info["id"], state.upper())
                 return {"status": "success", "ip": ip, "pin": pin}
             else:
                 print(f"Failed to send request. Status code: {response.status_code}")
@@ -109,56 +80,77 @@ def turn_output(device_info, state):
             print(
                 f"Attempt {attempt + 1}/{RETRY_LIMIT}: Error communicating with {ip}: {e}"
             )
+            if attempt + 1 < RETRY_LIMIT:
+                controller_retries_total.inc(script="apiTurn")
 
     return {"status": "failure", "ip": ip, "pin": pin, "reason": "max retries exceeded"}
 
 
 # Function to check the pin state (input or output) via API and update the database
 def check_and_update_pin_state(device_info, var):
-    # Construct the URL for checking the pin state
     ip = device_info["ip"]
     pin = device_info["input_pin"] if var == "inputstate" else device_info["output_pin"]
 
-
-    url = f"http://{ip}/cgi-bin/io_value"
-    payload = {
-        "username": USERNAME,
-        "password": PASSWORD,
-        "pin": pin,
-    }
-
-    # Send the request
+    # Send the request over the controller's keep-alive session
     try:
-        response = requests.get(url, params=payload, timeout=TIMEOUT)
+        response = get_client().io_value(ip, pin)
         if response.status_code == 200:
             pin_state = response.text.strip()  # Get the pin state (0 or 1)
             new_value = "ON" if pin_state == "1" else "OFF"
             print(f"{var.capitalize()} for {pin} at IP {ip}: {new_value}")
 
-            # Update the database using updateDBcell.py script
+            # Update the database
             update_db(device_info["id"], var, new_value)
+            return new_value
         else:
             print(f"Failed to check {var}. Status code: {response.status_code}")
     except requests.exceptions.RequestException as e:
         print(f"Error communicating with {ip} for {var}: {e}")
+    return None
+
+
+# Function to switch a device and read both pins back, without a subprocess
+def switch_device(device_info, state):
+    """Turn the output to state and verify it by reading the pins back.
+
+    Returns the turn_output() result with "verified" set to True when the
+    output pin reads back as the requested state, and the read-back states
+    under "outputstate" and "inputstate".
+    """
+    state = state.upper()
+    result = turn_output(device_info, state)
+    result["verified"] = False
+    if result["status"] != "success":
+        return result
+
+    result["outputstate"] = check_and_update_pin_state(device_info, "outputstate")
+    result["inputstate"] = check_and_update_pin_state(device_info, "inputstate")
+    if result["outputstate"] == state:
+        result["verified"] = True
+    elif result["outputstate"] is None:
+        result["reason"] = "output read-back failed"
+    else:
+        result["reason"] = f"output reads {result['outputstate']} after switching"
+    return result
+
+
+# Function to remember the command so the pollers watch the device closely
+def record_command(device_id, state):
+    issued_at = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
+    try:
+        styringDB.record_command(device_id, state, issued_at, db_name=DB_NAME)
+    except Exception as e:
+        print(f"Error recording command for device {device_id}: {e}")
 
 
-# Function to update the database using updateDBcell.py script
+# Function to update the database through updateDBcell
 def update_db(device_id, col_to_change, new_value):
-    # fmt: off
-    command = [
-        "python3", "updateDBcell.py",
-        "--db", DB_NAME,
-        "--table", "heimtaugaskapar",
-        "--colchange", col_to_change,
-        "--colname", "id",
-        "--colnamerow", device_id,
-        "--newval", new_value,
-    ]
-    # fmt: on
-
-    result = subprocess.run(command, capture_output=True, text=True)
-    print(result.stdout)
+    try:
+        update_db_cell(
+            DB_NAME, "heimtaugaskapar", col_to_change, "id", device_id, new_value
+        )
+    except Exception as e:
+        print(f"Error: {e}")
 
 
 # Main function to handle command-line arguments
@@ -186,13 +178,8 @@ def main():
         elif args.hs:
             device_info = get_device_info_by_hs(args.hs)
 
-        # Turn the output on or off
-        result = turn_output(device_info, args.turn.upper())
-
-        # If the API call was successful, check and update both outputstate and inputstate
-        if result["status"] == "success":
-            check_and_update_pin_state(device_info, "outputstate")
-            check_and_update_pin_state(device_info, "inputstate")
+        # Turn the output on or off, then check and update both pin states
+        switch_device(device_info, args.turn)
 
     except Exception as e:
         print(f"Error: {e}")
@@ -2,97 +2,230 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import sqlite3
-import subprocess
+import argparse
+import datetime
 import time
 
+import metrics
+import styringDB
+from adaptivePolling import parse_time
+from commandQueue import FAILED, VERIFIED, get_queue
+from deviceRegistry import DeviceRegistry
+from staggerPlanner import (
+    DS_LIMIT,
+    GLOBAL_RATE,
+    STAGGER_WINDOW,
+    StaggerPlanner,
+    ds_limit_arg,
+)
+from updateDBcell import update_db_cells
+
 DB_NAME = "styring.db"  # Database name
-CHECK_INTERVAL = 1  # Interval between processing devices in seconds
-
-
-def update_uxstate(device_id, new_value):
-    # fmt: off
-    command = [
-        "python3", "updateDBcell.py",
-        "--db", DB_NAME,
-        "--table", "heimtaugaskapar",
-        "--colchange", "uxstate",
-        "--colname", "id",
-        "--colnamerow", device_id,
-        "--newval", new_value,
-    ]
-    # fmt: on
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"Error updating uxstate for device {device_id}: {result.stderr}")
-    else:
-        print(f"Updated uxstate for device {device_id} to {new_value}.")
+CHECK_INTERVAL = 1  # Interval between sweeps in seconds
+COMMAND_RETRY_INTERVAL = 60  # Seconds before an unanswered command is resent
+REPORT_INTERVAL = 60  # Seconds between sweep reports when nothing happens
 
 
-def main():
-    while True:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
+# Function to queue a switch command, returning the job id
+def turn_device(device, turn_state):
+    job = get_queue(DB_NAME).submit(device, turn_state)
+    print(f"Queued turning {turn_state} device {device['id']} as job {job['id']}")
+    return job["id"]
 
-        # Fetch all devices from the heimtaugaskapar table
-        cursor.execute(
-            "SELECT id, astroman, astrostate, outputstate FROM heimtaugaskapar"
-        )
-        devices = cursor.fetchall()
-
-        conn.close()
-
-        for device in devices:
-            device_id = device[0]
-            astroman = device[1]
-            astrostate = device[2]
-            outputstate = device[3]
-
-            if astroman == "MANUAL":
-                # Do nothing and move to the next device
-                print(f"Device {device_id} is in MANUAL mode. Skipping.")
-                continue
-            elif astroman == "ASTRO":
-                # Update uxstate to match astrostate
-                update_uxstate(device_id, astrostate)
-
-                # Check if astrostate is not the same as outputstate
-                if astrostate != outputstate:
-                    # Determine the action based on astrostate
-                    if astrostate in ["ON", "OFF"]:
-                        turn_state = astrostate
-                        # Use apiTurn.py to send the command
-                        # fmt: off
-                        command = [
-                            "python3", "apiTurn.py",
-                            "--id", device_id,
-                            "--turn", turn_state,
-                        ]
-                        # fmt: on
-                        result = subprocess.run(command, capture_output=True, text=True)
-                        if result.returncode != 0:
-                            print(
-                                f"Error turning {turn_state} device {device_id}: {result.stderr}"
-                            )
-                        else:
-                            print(
-                                f"Turned {turn_state} device {device_id}: {result.stdout}"
-                            )
-                    else:
-                        print(
-                            f"Device {device_id} has invalid astrostate '{astrostate}'. Skipping."
-                        )
-                else:
-                    print(
-                        f"Device {device_id}: astrostate matches outputstate. No action needed."
-                    )
-            else:
+
+# Function to pick the astro flip a command's switch lag is measured from
+def lag_flip_time(device, measured_flips, max_age):
+    """Return the flip time to measure this command's lag from, or None.
+
+    Only the first command sent for a flip is measured, and only if the flip
+    is at most max_age seconds old. Retries and devices put back into ASTRO
+    long after the flip would otherwise add hour-long samples.
+    """
+    flip_time = parse_time(device["lastastrotime"])
+    if flip_time is None or measured_flips.get(device["id"]) == flip_time:
+        return None
+    measured_flips[device["id"]] = flip_time
+    if (datetime.datetime.utcnow() - flip_time).total_seconds() > max_age:
+        return None
+    return flip_time
+
+
+# Function to count the queued commands that finished since the last sweep
+def collect_jobs(pending_jobs, counters):
+    queue = get_queue(DB_NAME)
+    for device_id, (job_id, flip_time) in list(pending_jobs.items()):
+        job = queue.get(job_id)
+        if job is None or job["status"] not in (VERIFIED, FAILED):
+            continue
+        del pending_jobs[device_id]
+        if job["status"] == FAILED:
+            counters["failed"] += 1
+            print(f"Error turning {job['state']} device {device_id}: {job['error']}")
+        elif flip_time:
+            # How long after the scheduled flip the lights actually switched
+            lag = parse_time(job["finished_at"]) - flip_time
+            metrics.switch_lag_seconds.observe(lag.total_seconds())
+
+
+# Function to reconcile every ASTRO device once, writing only what changed
+def sweep(registry, last_commands, warned, planner, pending_jobs, measured_flips):
+    counters = {
+        "examined": 0,
+        "changed": 0,
+        "planned": 0,
+        "commands": 0,
+        "failed": 0,
+    }
+    uxstate_rows = []
+    to_turn = []
+
+    # Devices are kept in memory and only the rows changed since the last
+    # sweep are read from the heimtaugaskapar table
+    registry.refresh(force=True)
+    devices = registry.all_devices()
+    now = time.monotonic()
+
+    for device in devices:
+        device_id = device["id"]
+        astroman = device["astroman"]
+        astrostate = device["astrostate"]
+        outputstate = device["outputstate"]
+        counters["examined"] += 1
+
+        if astroman == "MANUAL":
+            # Do nothing and move to the next device
+            continue
+        elif astroman != "ASTRO":
+            # Report an invalid value once, not on every sweep
+            if warned.get(device_id) != ("astroman", astroman):
                 print(
                     f"Device {device_id} has invalid astroman value '{astroman}'. Skipping."
                 )
+                warned[device_id] = ("astroman", astroman)
+            continue
+
+        # Update uxstate to match astrostate, if it does not already
+        if device["uxstate"] != astrostate:
+            uxstate_rows.append((device_id, {"uxstate": astrostate}))
+
+        # Check if astrostate is not the same as outputstate
+        if astrostate == outputstate:
+            last_commands.pop(device_id, None)
+            continue
+        if astrostate not in ["ON", "OFF"]:
+            if warned.get(device_id) != ("astrostate", astrostate):
+                print(
+                    f"Device {device_id} has invalid astrostate '{astrostate}'. Skipping."
+                )
+                warned[device_id] = ("astrostate", astrostate)
+            continue
+
+        # Do not resend the same command until the controller had time to
+        # act on it and the pollers had time to read the new state back
+        last_state, sent_at = last_commands.get(device_id, (None, 0))
+        if last_state == astrostate and now - sent_at < COMMAND_RETRY_INTERVAL:
+            continue
+        to_turn.append((device, astrostate))
+
+    # Write every uxstate change of this sweep in one transaction
+    try:
+        update_db_cells(DB_NAME, "heimtaugaskapar", "id", uxstate_rows)
+        registry.apply_changes(uxstate_rows)
+        counters["changed"] = len(uxstate_rows)
+    except Exception as e:
+        print(f"Error updating uxstate for {len(uxstate_rows)} devices: {e}")
+
+    # OFF commands go out at once, ON commands are staggered to limit inrush.
+    # Devices planned for ON that no longer need it are taken off the plan.
+    turn_on = [device for device, turn_state in to_turn if turn_state == "ON"]
+    on_ids = {device["id"] for device in turn_on}
+    for device_id in list(planner.planned):
+        if device_id not in on_ids:
+            planner.cancel(device_id)
+    counters["planned"] = len(planner.plan(turn_on, now))
+
+    due = [(device, "OFF") for device, turn_state in to_turn if turn_state == "OFF"]
+    due += [(device, "ON") for device in planner.due(time.monotonic())]
+    for device, turn_state in due:
+        flip_time = lag_flip_time(
+            device, measured_flips, planner.window + COMMAND_RETRY_INTERVAL
+        )
+        pending_jobs[device["id"]] = (turn_device(device, turn_state), flip_time)
+        last_commands[device["id"]] = (turn_state, time.monotonic())
+        counters["commands"] += 1
+
+    collect_jobs(pending_jobs, counters)
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Switch ASTRO devices to their astrostate, staggering ON commands."
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=STAGGER_WINDOW,
+        help=f"Seconds over which one transition's ON commands are spread (default {STAGGER_WINDOW})",
+    )
+    parser.add_argument(
+        "--ds-limit",
+        type=ds_limit_arg,
+        default=DS_LIMIT,
+        help=f"ON commands per dreifistöð in one slot (default {DS_LIMIT})",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=GLOBAL_RATE,
+        help=f"ON commands per second across all dreifistöðvar (default {GLOBAL_RATE})",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
+    # Apply pending schema migrations, the device registry follows the change log
+    styringDB.migrate(DB_NAME)
+
+    registry = DeviceRegistry(DB_NAME)
+    planner = StaggerPlanner(
+        window=args.window, ds_limit=args.ds_limit, global_rate=args.rate
+    )
+    last_commands = {}  # Device id -> (state, monotonic time) of the last command
+    pending_jobs = {}  # Device id -> (job id, astro flip time) of an unfinished command
+    warned = {}  # Device id -> invalid value already reported
+    measured_flips = {}  # Device id -> astro flip its switch lag was measured for
+    last_report = 0
+
+    while True:
+        with metrics.sweep_seconds.time(loop="astro"):
+            counters = sweep(
+                registry, last_commands, warned, planner, pending_jobs, measured_flips
+            )
+
+        # Report the sweep when something happened, and regularly otherwise
+        if (
+            counters["changed"]
+            or counters["planned"]
+            or counters["commands"]
+            or counters["failed"]
+            or time.monotonic() - last_report >= REPORT_INTERVAL
+        ):
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            print(
+                f"{timestamp} - Examined {counters['examined']} devices, "
+                f"{counters['changed']} uxstate changed, "
+                f"{counters['planned']} ON commands planned, "
+                f"{counters['commands']} commands issued, {counters['failed']} failed."
+            )
+            last_report = time.monotonic()
 
-            # Wait before processing the next device
-            time.sleep(CHECK_INTERVAL)
+        # Wait before the next sweep
+        time.sleep(CHECK_INTERVAL)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import argparse
+import datetime
+import sqlite3
+from datetime import timedelta
+
+import RelevantEvents
+import styringDB
+
+DB_NAME = "styring.db"  # Database name
+HORIZON_DAYS = 400  # How far ahead the schedule is materialized
+PAST_DAYS = 2  # Days of past events kept so the last event can always be found
+REFRESH_MARGIN_DAYS = 30  # Regenerate a device once its horizon shrinks by this much
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"  # Same format as lastastrotime/nextastrotime
+
+
+# Function to create the schedule tables if they do not exist yet
+def ensure_schema(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS astro_schedule (
+            device_id TEXT NOT NULL,
+            eventtime TEXT NOT NULL,
+            op TEXT NOT NULL,
+            PRIMARY KEY (device_id, eventtime)
+        ) WITHOUT ROWID
+    """
+    )
+    # Inputs each device's schedule was generated from, to detect changes
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS astro_schedule_source (
+            device_id TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            offset_minutes INTEGER,
+            horizon_start TEXT,
+            horizon_end TEXT
+        )
+    """
+    )
+
+
+def build_schedules(devices, offset, start_date, days):
+    """Calculate the ON/OFF events of every device for days starting at start_date.
+
+    Returns a dict of device id -> list of (op, eventtime string).
+    """
+    if not devices:
+        return {}
+
+    dates = [start_date + timedelta(days=day) for day in range(days)]
+    times, is_on, keep = RelevantEvents.calculate_event_series(
+        dates,
+        [float(device["lat"]) for device in devices],
+        [float(device["lon"]) for device in devices],
+        offset,
+    )
+
+    schedules = {}
+    for row, device in enumerate(devices):
+        schedule = []
+        for index in keep[row].nonzero()[0]:
+            op, eventtime = RelevantEvents.event_from_micros(
+                is_on[row, index], times[row, index]
+            )
+            schedule.append((op, eventtime.strftime(TIMESTAMP_FORMAT)))
+        schedules[device["id"]] = schedule
+    return schedules
+
+
+def refresh_schedule(
+    styring_db, offset, current_time, horizon_days=HORIZON_DAYS, force=False
+):
+    """Regenerate the schedule of every device whose inputs or horizon are stale.
+
+    Returns the number of devices whose schedule was regenerated.
+    """
+    with styringDB.transaction(styring_db) as conn:
+        ensure_schema(conn)
+
+        devices = conn.execute(
+            "SELECT id, lat, lon FROM heimtaugaskapar "
+            "WHERE lat IS NOT NULL AND lon IS NOT NULL"
+        ).fetchall()
+        sources = {
+            row["device_id"]: row
+            for row in conn.execute("SELECT * FROM astro_schedule_source")
+        }
+
+        today = current_time.date()
+        horizon_start = today - timedelta(days=PAST_DAYS)
+        min_horizon_end = (
+            today + timedelta(days=horizon_days - REFRESH_MARGIN_DAYS)
+        ).isoformat()
+
+        stale = []
+        for device in devices:
+            source = sources.get(device["id"])
+            if (
+                force
+                or source is None
+                or source["lat"] != float(device["lat"])
+                or source["lon"] != float(device["lon"])
+                or source["offset_minutes"] != offset
+                or source["horizon_end"] < min_horizon_end
+            ):
+                stale.append(device)
+
+        days = PAST_DAYS + horizon_days
+        schedules = build_schedules(stale, offset, horizon_start, days)
+        horizon_end = (horizon_start + timedelta(days=days)).isoformat()
+
+        for device in stale:
+            device_id = device["id"]
+            conn.execute("DELETE FROM astro_schedule WHERE device_id = ?", (device_id,))
+            conn.executemany(
+                "INSERT INTO astro_schedule (device_id, eventtime, op) VALUES (?, ?, ?)",
+                [(device_id, eventtime, op) for op, eventtime in schedules[device_id]],
+            )
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO astro_schedule_source
+                    (device_id, lat, lon, offset_minutes, horizon_start, horizon_end)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    device_id,
+                    float(device["lat"]),
+                    float(device["lon"]),
+                    offset,
+                    horizon_start.isoformat(),
+                    horizon_end,
+                ),
+            )
+
+        # Drop schedules of devices that were removed or lost their location
+        located_ids = {device["id"] for device in devices}
+        removed = [
+            (device_id,) for device_id in sources if device_id not in located_ids
+        ]
+        conn.executemany("DELETE FROM astro_schedule WHERE device_id = ?", removed)
+        conn.executemany(
+            "DELETE FROM astro_schedule_source WHERE device_id = ?", removed
+        )
+
+        # Age out past events, the lookup only needs the most recent ones
+        cutoff = datetime.datetime.combine(horizon_start, datetime.time(0, 0, 0))
+        conn.execute(
+            "DELETE FROM astro_schedule WHERE eventtime < ?",
+            (cutoff.strftime(TIMESTAMP_FORMAT),),
+        )
+
+    return len(stale)
+
+
+def lookup_events(styring_db, device_id, current_time):
+    """Look up the last event, next event, and the event after from the schedule.
+
+    Returns the same tuple as RelevantEvents.calculate_events(), or None when
+    the device has no materialized schedule.
+    """
+    now = current_time.strftime(TIMESTAMP_FORMAT)
+    try:
+        with styringDB.connection(styring_db) as conn:
+            last_rows = conn.execute(
+                """
+                SELECT op, eventtime FROM astro_schedule
+                WHERE device_id = ? AND eventtime <= ?
+                ORDER BY eventtime DESC LIMIT 1
+            """,
+                (device_id, now),
+            ).fetchall()
+            next_rows = conn.execute(
+                """
+                SELECT op, eventtime FROM astro_schedule
+                WHERE device_id = ? AND eventtime > ?
+                ORDER BY eventtime LIMIT 2
+            """,
+                (device_id, now),
+            ).fetchall()
+    except sqlite3.OperationalError:
+        return None  # Schedule table has not been created yet
+
+    if not last_rows and not next_rows:
+        return None
+
+    events = [
+        (op, datetime.datetime.strptime(eventtime, TIMESTAMP_FORMAT))
+        for op, eventtime in last_rows + next_rows
+    ]
+    last_event = events.pop(0) if last_rows else None
+    next_event = events.pop(0) if events else None
+    event_after = events.pop(0) if events else None
+    current_state = last_event[0] if last_event else "OFF"  # Default state
+
+    return last_event, next_event, event_after, current_state
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Materialize the astro switching schedule into the database."
+    )
+    parser.add_argument("--db", default=DB_NAME, help="Database name")
+    parser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        help="Offset in minutes for lights ON/OFF times",
+    )
+    parser.add_argument(
+        "--horizon",
+        type=int,
+        default=HORIZON_DAYS,
+        help=f"Number of days to schedule ahead (default {HORIZON_DAYS})",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate the schedule for every device, even if unchanged.",
+    )
+    args = parser.parse_args()
+
+    refreshed = refresh_schedule(
+        args.db,
+        args.offset,
+        datetime.datetime.utcnow(),
+        horizon_days=args.horizon,
+        force=args.force,
+    )
+    print(f"Regenerated the astro schedule for {refreshed} devices.")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,26 +2,34 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import sqlite3
+import argparse
+import asyncio
+import datetime
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import apiState
+import metrics
+import pollerLeases
+import styringDB
+from adaptivePolling import AdaptivePollScheduler, parse_time
+from updateDBcell import update_db_cells
 
 DB_NAME = "styring.db"  # Database name
 CHECK_INTERVAL = 10  # Minimum interval between API requests in seconds
+MAX_CONCURRENCY = 50  # Controllers polled at the same time in async mode
+CONTROLLER_INTERVAL = 1.0  # Minimum seconds between requests to one controller
+SWEEP_INTERVAL = 10  # Minimum seconds between the start of two sweeps
+WRITE_BATCH_SIZE = 100  # Polled devices written to the database per transaction
+POLL_BUDGET = 20  # Devices polled per second at most in adaptive mode
+DEVICE_RELOAD_INTERVAL = 10  # Seconds between device table reloads in adaptive mode
+RENEW_STEP = 5  # Longest sleep between sweeps in shard mode before rebalancing
 
 
 # Function to get all devices from the heimtaugaskapar table
 def get_all_devices():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    query = "SELECT id FROM heimtaugaskapar"
-    cursor.execute(query)
-    devices = cursor.fetchall()
-
-    conn.close()
-
-    return [device[0] for device in devices]
+    return styringDB.get_device_ids(db_name=DB_NAME)
 
 
 # Function to call apiState.py for inputstate or outputstate
@@ -37,18 +45,12 @@ def check_state(device_id, var):
 
 # Function to compare inputstate and outputstate and update localremote
 def update_localremote(device_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
     # Get inputstate and outputstate
-    cursor.execute(
-        "SELECT inputstate, outputstate FROM heimtaugaskapar WHERE id = ?", (device_id,)
-    )
-    row = cursor.fetchone()
+    device = styringDB.get_device_by_id(device_id, db_name=DB_NAME)
 
-    if row:
-        inputstate = row[0]
-        outputstate = row[1]
+    if device:
+        inputstate = device["inputstate"]
+        outputstate = device["outputstate"]
 
         if inputstate != outputstate:
             localremote = "LOCAL"
@@ -56,20 +58,236 @@ def update_localremote(device_id):
             localremote = "REMOTE"
 
         # Update localremote
-        cursor.execute(
-            "UPDATE heimtaugaskapar SET localremote = ? WHERE id = ?",
-            (localremote, device_id),
-        )
-        conn.commit()
+        styringDB.update_device(device_id, db_name=DB_NAME, localremote=localremote)
         print(f"Updated localremote for device {device_id} to {localremote}")
     else:
         print(f"Device {device_id} not found in database.")
 
-    conn.close()
 
+# Spaces out requests to each controller by a minimum interval
+class ControllerRateLimiter:
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_allowed = {}  # Controller IP -> loop time of its next request
+        self.locks = {}
 
-# Main loop that checks both inputstate and outputstate for each device
-def main():
+    async def wait(self, ip):
+        lock = self.locks.setdefault(ip, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_running_loop()
+            delay = self.next_allowed.get(ip, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_allowed[ip] = loop.time() + self.interval
+
+
+# Function to read inputstate and outputstate of one device from its controller
+async def poll_device(device, semaphore, limiter, leases=None):
+    device_info = apiState.device_info_from_row(device)
+    states = {}
+    for var in ("inputstate", "outputstate"):
+        await limiter.wait(device_info["ip"])
+        async with semaphore:
+            if leases is not None and not leases.holds_device(device):
+                return device, {}  # The lease ran out, another worker has it now
+            pin_state = await asyncio.to_thread(
+                apiState.check_pin_state, device_info, var
+            )
+        if pin_state is not None:
+            states[var] = "ON" if pin_state == "1" else "OFF"
+    return device, states
+
+
+# Function to work out which columns of a polled device actually changed
+def changed_columns(device, states):
+    values = dict(states)
+    inputstate = values.get("inputstate", device["inputstate"])
+    outputstate = values.get("outputstate", device["outputstate"])
+    values["localremote"] = "LOCAL" if inputstate != outputstate else "REMOTE"
+    return {
+        column: value for column, value in values.items() if device[column] != value
+    }
+
+
+# Function to poll every device concurrently and write the results in batches
+async def sweep(semaphore, limiter, devices=None, leases=None):
+    if devices is None:
+        devices = styringDB.get_all_devices(db_name=DB_NAME)
+    tasks = [poll_device(device, semaphore, limiter, leases) for device in devices]
+
+    pending_rows = []
+    polled = 0
+    changed = 0
+    for task in asyncio.as_completed(tasks):
+        device, states = await task
+        if leases is not None and not leases.holds_device(device):
+            states = {}  # Read before the lease ran out, leave it to the new owner
+        if states:
+            polled += 1
+        values = changed_columns(device, states) if states else {}
+        if values:
+            pending_rows.append((device["id"], values))
+        if len(pending_rows) >= WRITE_BATCH_SIZE:
+            update_db_cells(DB_NAME, "heimtaugaskapar", "id", pending_rows)
+            changed += len(pending_rows)
+            pending_rows = []
+
+    update_db_cells(DB_NAME, "heimtaugaskapar", "id", pending_rows)
+    changed += len(pending_rows)
+    return len(devices), polled, changed
+
+
+# Async loop that sweeps the whole fleet with bounded concurrency
+async def run_async(concurrency, controller_interval, sweep_interval, once=False):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = ControllerRateLimiter(controller_interval)
+
+    while True:
+        started = loop.time()
+        device_count, polled, changed = await sweep(semaphore, limiter)
+        elapsed = loop.time() - started
+        metrics.sweep_seconds.observe(elapsed, loop="checkStates")
+
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        print(
+            f"{timestamp} - Swept {device_count} devices in {elapsed:.1f} s: "
+            f"{polled} answered, {changed} changed."
+        )
+        if once:
+            return
+
+        await asyncio.sleep(max(sweep_interval - elapsed, 0))
+
+
+# Function to claim this worker's share of the partitions, keeping what it
+# holds if the database cannot be reached
+async def rebalance_leases(leases, devices):
+    try:
+        return await asyncio.to_thread(leases.rebalance, devices)
+    except Exception as e:
+        print(f"Error rebalancing leases: {e}")
+        return leases.held()
+
+
+# Function to keep this worker's leases alive while it sweeps
+async def renew_leases(leases):
+    while True:
+        await asyncio.sleep(pollerLeases.RENEW_INTERVAL)
+        try:
+            await asyncio.to_thread(leases.renew)
+        except Exception as e:
+            print(f"Error renewing leases: {e}")
+
+
+# Async loop that sweeps only the partitions this worker holds leases on
+async def run_sharded(concurrency, controller_interval, sweep_interval, leases):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = ControllerRateLimiter(controller_interval)
+
+    try:
+        while True:
+            started = loop.time()
+            devices = styringDB.get_all_devices(db_name=DB_NAME)
+            held = await rebalance_leases(leases, devices)
+            mine = [device for device in devices if leases.partition_of(device) in held]
+
+            renewer = asyncio.create_task(renew_leases(leases))
+            try:
+                device_count, polled, changed = await sweep(
+                    semaphore, limiter, devices=mine, leases=leases
+                )
+            finally:
+                renewer.cancel()
+            elapsed = loop.time() - started
+            metrics.sweep_seconds.observe(elapsed, loop="checkStates-shard")
+
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            print(
+                f"{timestamp} - Worker {leases.worker_id} swept {device_count} devices "
+                f"in {len(held)} partitions in {elapsed:.1f} s: "
+                f"{polled} answered, {changed} changed."
+            )
+
+            # Sleep in steps, rebalancing on each so the leases are renewed
+            # and partitions released by other workers are picked up while idle
+            while loop.time() - started < sweep_interval:
+                await asyncio.sleep(
+                    min(sweep_interval - (loop.time() - started), RENEW_STEP)
+                )
+                await rebalance_leases(leases, devices)
+    finally:
+        leases.release_all()
+
+
+# Async loop that polls each device at the cadence the adaptive scheduler picks
+async def run_adaptive(concurrency, controller_interval, budget):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = ControllerRateLimiter(controller_interval)
+    scheduler = AdaptivePollScheduler()
+
+    devices = {}
+    command_times = {}
+    in_flight = set()
+    pending_rows = []
+    polls = 0
+    last_reload = None
+    last_report = loop.time()
+
+    async def poll_and_record(device):
+        nonlocal polls
+        try:
+            device, states = await poll_device(device, semaphore, limiter)
+            values = changed_columns(device, states) if states else {}
+            if values:
+                pending_rows.append((device["id"], values))
+                devices[device["id"]] = {**device, **values}
+            localremote = values.get("localremote", device["localremote"])
+            command_time = parse_time(command_times.get(device["id"]))
+            now = datetime.datetime.utcnow()
+            scheduler.record(device, bool(values), localremote, command_time, now)
+            polls += 1
+        finally:
+            in_flight.discard(device["id"])
+
+    while True:
+        if last_reload is None or loop.time() - last_reload >= DEVICE_RELOAD_INTERVAL:
+            rows = styringDB.get_all_devices(db_name=DB_NAME)
+            devices = {device["id"]: device for device in rows}
+            last_reload = loop.time()
+        command_times = styringDB.get_command_times(db_name=DB_NAME)
+
+        now = datetime.datetime.utcnow()
+        for device in scheduler.select(
+            devices.values(), command_times, now, budget, exclude=in_flight
+        ):
+            in_flight.add(device["id"])
+            asyncio.create_task(poll_and_record(device))
+
+        # Write everything polled since the last tick in one transaction,
+        # timed by gungnir_db_write_seconds in styringDB.transaction()
+        rows, pending_rows[:] = list(pending_rows), []
+        update_db_cells(DB_NAME, "heimtaugaskapar", "id", rows)
+
+        if loop.time() - last_report >= 60:
+            timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+            print(
+                f"{timestamp} - Adaptive polling: {polls} polls in the last minute, "
+                f"{len(in_flight)} in flight, {len(devices)} devices."
+            )
+            polls = 0
+            last_report = loop.time()
+
+        await asyncio.sleep(1)
+
+
+# Sequential loop that checks both inputstate and outputstate for each device
+def run_sequential():
     while True:
         devices = get_all_devices()
 
@@ -90,5 +308,109 @@ def main():
             # time.sleep(CHECK_INTERVAL)
 
 
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Poll device input and output states and update the database."
+    )
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="Poll one device at a time through apiState.py, as before.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=MAX_CONCURRENCY,
+        help=f"Controllers polled at the same time (default {MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--controller-interval",
+        type=float,
+        default=CONTROLLER_INTERVAL,
+        help=f"Minimum seconds between requests to one controller (default {CONTROLLER_INTERVAL})",
+    )
+    parser.add_argument(
+        "--sweep-interval",
+        type=float,
+        default=SWEEP_INTERVAL,
+        help=f"Minimum seconds between the start of two sweeps (default {SWEEP_INTERVAL})",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Run a single sweep and exit."
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Poll densely around scheduled flips and commands, back off when stable.",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=POLL_BUDGET,
+        help=f"Devices polled per second at most in adaptive mode (default {POLL_BUDGET})",
+    )
+    parser.add_argument(
+        "--shard",
+        choices=pollerLeases.PARTITION_BY,
+        help="Poll only the partitions this worker leases, partitioned by hash of "
+        "the id, hverfi or ds. Start several workers to share the fleet.",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=pollerLeases.PARTITIONS,
+        help="Partitions with --shard hash, the same on every worker "
+        f"(default {pollerLeases.PARTITIONS})",
+    )
+    parser.add_argument(
+        "--worker-id", help="Name of this worker with --shard (default host-pid)"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
+    # Apply pending schema migrations for device_commands and the lease tables
+    styringDB.migrate(DB_NAME)
+
+    try:
+        if args.sequential:
+            run_sequential()
+        elif args.shard:
+            leases = pollerLeases.LeaseManager(
+                worker_id=args.worker_id,
+                partition_by=args.shard,
+                partitions=args.partitions,
+                db_name=DB_NAME,
+            )
+            asyncio.run(
+                run_sharded(
+                    args.concurrency,
+                    args.controller_interval,
+                    args.sweep_interval,
+                    leases,
+                )
+            )
+        elif args.adaptive:
+            asyncio.run(
+                run_adaptive(args.concurrency, args.controller_interval, args.budget)
+            )
+        else:
+            asyncio.run(
+                run_async(
+                    args.concurrency,
+                    args.controller_interval,
+                    args.sweep_interval,
+                    once=args.once,
+                )
+            )
+    except KeyboardInterrupt:
+        print("\nScript terminated by user.")
+
+
 if __name__ == "__main__":
     main()
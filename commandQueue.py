@@ -0,0 +1,183 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# commandQueue.py - runs switch commands on a worker pool and tracks them as jobs
+
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import apiTurn
+import styringDB
+
+WORKERS = 32  # Switch commands run in parallel
+JOB_RETENTION = 3600  # Seconds a finished job can still be looked up
+MAX_JOBS = 10000  # Jobs kept in memory before the oldest finished ones are dropped
+GROUP_TIMEOUT = 60  # Seconds a group switch waits for its jobs to finish
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"  # Same format as the astro times
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+VERIFIED = "verified"
+FAILED = "failed"
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+
+
+class CommandQueue:
+    """Switch commands executed in-process by a long-lived thread pool.
+
+    submit() returns at once with a job; the job moves from queued to
+    running to verified (the output pin read back as the requested state) or
+    failed. Commands to the same device run one at a time, in order.
+    """
+
+    def __init__(self, db_name=styringDB.DB_NAME, workers=WORKERS):
+        self.db_name = db_name
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="command"
+        )
+        self.jobs = OrderedDict()  # Job id -> job dict, oldest first
+        self.finished = {}  # Job id -> monotonic time the job finished
+        self.device_locks = {}  # Device id -> lock serializing its commands
+        self.lock = threading.Lock()
+        self.job_finished = threading.Condition(self.lock)
+
+    def submit(self, device, state):
+        """Queue a switch of device (a heimtaugaskapar row) and return the job."""
+        job = {
+            "id": uuid.uuid4().hex,
+            "device_id": device["id"],
+            "state": state.upper(),
+            "status": QUEUED,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+            "outputstate": None,
+            "inputstate": None,
+            "error": None,
+        }
+        with self.lock:
+            self._prune()
+            self.jobs[job["id"]] = job
+            snapshot = dict(job)
+
+        device_info = apiTurn.device_info_from_row(device)
+        self.executor.submit(self._run, job["id"], device_info, job["state"])
+        return snapshot
+
+    def get(self, job_id):
+        """Return a copy of the job, or None if it is unknown or expired."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def as_completed(self, job_ids, timeout=GROUP_TIMEOUT):
+        """Yield each job as it finishes, then any still unfinished at timeout."""
+        pending = set(job_ids)
+        deadline = time.monotonic() + timeout
+        while pending:
+            with self.lock:
+                done = [job_id for job_id in pending if job_id in self.finished]
+                if not done:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.job_finished.wait(remaining)
+                    continue
+                jobs = [dict(self.jobs[job_id]) for job_id in done]
+            pending.difference_update(done)
+            yield from jobs
+
+        for job_id in pending:
+            job = self.get(job_id)
+            if job:
+                yield job
+
+    def _prune(self):
+        cutoff = time.monotonic() - JOB_RETENTION
+        for job_id in list(self.jobs):
+            finished = self.finished.get(job_id)
+            if finished is None:
+                continue
+            if finished < cutoff or len(self.jobs) > MAX_JOBS:
+                del self.jobs[job_id]
+                del self.finished[job_id]
+
+    def _update(self, job_id, **values):
+        with self.lock:
+            self.jobs[job_id].update(values)
+            if values.get("status") in (VERIFIED, FAILED):
+                self.finished[job_id] = time.monotonic()
+                self.job_finished.notify_all()
+
+    def _device_lock(self, device_id):
+        with self.lock:
+            return self.device_locks.setdefault(device_id, threading.Lock())
+
+    def _run(self, job_id, device_info, state):
+        with self._device_lock(device_info["id"]):
+            self._update(job_id, status=RUNNING, started_at=_now())
+            try:
+                result = apiTurn.switch_device(device_info, state)
+                if result["verified"]:
+                    styringDB.update_device(
+                        device_info["id"], db_name=self.db_name, uxstate=state
+                    )
+            except Exception as e:
+                print(f"Error switching device {device_info['id']}: {e}")
+                self._update(job_id, status=FAILED, finished_at=_now(), error=str(e))
+                return
+
+            self._update(
+                job_id,
+                status=VERIFIED if result["verified"] else FAILED,
+                finished_at=_now(),
+                outputstate=result.get("outputstate"),
+                inputstate=result.get("inputstate"),
+                error=None if result["verified"] else result.get("reason"),
+            )
+
+
+# Function to switch a group of devices at once and yield each device's result
+def switch_group(devices, state, queue=None, timeout=GROUP_TIMEOUT):
+    """Queue a switch for every MANUAL device and yield results as they finish.
+
+    Devices that are not in MANUAL mode are not switched; they are yielded
+    first with status "rejected". The rest are yielded as job dicts in the
+    order their switches finish.
+    """
+    queue = queue or get_queue()
+    job_ids = []
+    for device in devices:
+        if device["astroman"] != "MANUAL":
+            yield {
+                "device_id": device["id"],
+                "state": state.upper(),
+                "status": "rejected",
+                "error": "Device is not in MANUAL mode",
+            }
+            continue
+        job_ids.append(queue.submit(device, state)["id"])
+
+    yield from queue.as_completed(job_ids, timeout=timeout)
+
+
+_shared_queue = None
+_shared_queue_lock = threading.Lock()
+
+
+def get_queue(db_name=styringDB.DB_NAME):
+    """Return the command queue shared by every caller in this process."""
+    global _shared_queue
+    with _shared_queue_lock:
+        if _shared_queue is None:
+            _shared_queue = CommandQueue(db_name=db_name)
+        return _shared_queue
@@ -0,0 +1,137 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# controllerClient.py - keep-alive HTTP client for the cabinet controllers
+
+import os
+import threading
+import time
+
+import requests
+from dotenv import get_key, load_dotenv
+from requests.adapters import HTTPAdapter
+
+from metrics import controller_request_seconds, controller_requests_total
+
+# Load environment variables
+load_dotenv()
+
+# Explicitly get USERNAME from the .env file
+USERNAME = get_key(".env", "USERNAME")
+PASSWORD = os.getenv("PASSWORD")
+
+CONNECT_TIMEOUT = 5  # Seconds to wait for a TCP connection to a controller
+READ_TIMEOUT = 5  # Seconds to wait for a controller to answer
+POOL_MAXSIZE = 2  # Keep-alive connections kept open per controller
+
+
+class ControllerClient:
+    """HTTP client that keeps one pooled keep-alive session per controller.
+
+    Sessions are keyed by the controller's tsip, so every pin read and
+    switch to the same cabinet reuses an open connection instead of
+    paying for a new handshake over the Tailscale link.
+    """
+
+    def __init__(
+        self,
+        username=USERNAME,
+        password=PASSWORD,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        pool_maxsize=POOL_MAXSIZE,
+    ):
+        self.username = username
+        self.password = password
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+        self.sessions = {}  # tsip -> requests.Session
+        self.counters = {}  # tsip -> {"requests": n, "errors": n}
+        self.lock = threading.Lock()
+
+    def session(self, ip):
+        """Return the keep-alive session for a controller, creating it once."""
+        with self.lock:
+            session = self.sessions.get(ip)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize
+                )
+                session.mount("http://", adapter)
+                self.sessions[ip] = session
+                self.counters[ip] = {"requests": 0, "errors": 0}
+            return session
+
+    def get(self, ip, path, params):
+        """Send an authenticated GET to a controller and return the response."""
+        session = self.session(ip)
+        payload = {"username": self.username, "password": self.password, **params}
+        started = time.perf_counter()
+        try:
+            response = session.get(
+                f"http://{ip}/{path}", params=payload, timeout=self.timeout
+            )
+        except requests.exceptions.RequestException as e:
+            with self.lock:
+                self.counters[ip]["errors"] += 1
+            outcome = (
+                "timeout" if isinstance(e, requests.exceptions.Timeout) else "error"
+            )
+            controller_requests_total.inc(tsip=ip, outcome=outcome)
+            raise
+        finally:
+            controller_request_seconds.observe(time.perf_counter() - started, tsip=ip)
+        with self.lock:
+            self.counters[ip]["requests"] += 1
+        controller_requests_total.inc(tsip=ip, outcome="ok")
+        return response
+
+    def io_value(self, ip, pin):
+        """Read the value of an input or output pin."""
+        return self.get(ip, "cgi-bin/io_value", {"pin": pin})
+
+    def io_state(self, ip, pin, state):
+        """Set an output pin to "on" or "off"."""
+        return self.get(ip, "cgi-bin/io_state", {"pin": pin, "state": state.lower()})
+
+    def stats(self):
+        """Return request, error and connection counts per controller.
+
+        reused is the number of requests that went over an already open
+        connection instead of a new one.
+        """
+        with self.lock:
+            sessions = dict(self.sessions)
+            counters = {ip: dict(counts) for ip, counts in self.counters.items()}
+
+        for ip, session in sessions.items():
+            pools = session.get_adapter("http://").poolmanager.pools
+            connections = sum(pools[key].num_connections for key in pools.keys())
+            counts = counters[ip]
+            counts["connections"] = connections
+            counts["reused"] = max(
+                counts["requests"] + counts["errors"] - connections, 0
+            )
+        return counters
+
+    def close(self):
+        """Close every open session."""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the client shared by every caller in this process."""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = ControllerClient()
+        return _shared_client
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# controllerSim.py - simulates a fleet of cabinet controllers on loopback.
+#
+# Every address in 127.0.0.0/8 reaches this one server, so each tsip like
+# 127.0.3.17:18080 becomes its own virtual controller, told apart by the
+# Host header. Serves cgi-bin/io_value and cgi-bin/io_state like the real
+# controllers, with configurable latency, timeouts, dropouts and manual
+# switches at the cabinet.
+
+import argparse
+import asyncio
+import json
+import random
+import zlib
+from urllib.parse import parse_qs, urlsplit
+
+PORT = 18080  # Port the simulated controllers listen on
+LATENCY = 0.05  # Mean seconds a controller takes to answer
+JITTER = 0.02  # Random spread added to the latency in seconds
+HANG_TIME = 60  # Seconds a timed out request is held before the connection drops
+
+
+class VirtualController:
+    """Output pins that can be switched and input pins that follow them.
+
+    An input pin reads its matching output (din1 follows dout1) unless a
+    manual switch at the cabinet has overridden it, which the pollers see
+    as LOCAL.
+    """
+
+    def __init__(self):
+        self.outputs = {}  # Output pin -> 0 or 1
+        self.overrides = {}  # Input pin -> 0 or 1 set by a manual switch
+
+    def read(self, pin):
+        if pin.startswith("din"):
+            if pin in self.overrides:
+                return self.overrides[pin]
+            return self.outputs.get("dout" + pin[3:], 0)
+        return self.outputs.get(pin, 0)
+
+    def switch(self, pin, state):
+        self.outputs[pin] = 1 if state == "on" else 0
+
+    def flip_local(self, pin="din1"):
+        """Toggle a manual switch at the cabinet."""
+        if pin in self.overrides:
+            del self.overrides[pin]
+        else:
+            self.overrides[pin] = 1 - self.read(pin)
+
+
+class SimulatedFleet:
+    """Every virtual controller, keyed by the host they are addressed as."""
+
+    def __init__(
+        self,
+        latency=LATENCY,
+        jitter=JITTER,
+        timeout_rate=0.0,
+        dropout_rate=0.0,
+        dead_fraction=0.0,
+        flip_rate=0.0,
+        seed=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout_rate = timeout_rate
+        self.dropout_rate = dropout_rate
+        self.dead_fraction = dead_fraction
+        self.flip_rate = flip_rate  # Manual switches per controller per hour
+        self.random = random.Random(seed)
+        self.controllers = {}
+        self.stats = {
+            "requests": 0,
+            "io_value": 0,
+            "io_state": 0,
+            "timeouts": 0,
+            "dropouts": 0,
+            "flips": 0,
+            "not_found": 0,
+        }
+
+    def controller(self, host):
+        if host not in self.controllers:
+            self.controllers[host] = VirtualController()
+        return self.controllers[host]
+
+    def is_dead(self, host):
+        # Stable per host, so the same controllers stay dead for the whole run
+        return (zlib.crc32(host.encode()) % 10000) < self.dead_fraction * 10000
+
+    async def handle(self, host, target):
+        """Answer one request. Returns (status, body), or None to drop it."""
+        url = urlsplit(target)
+        if url.path == "/__stats":
+            # The counters themselves, not a controller, so never delayed
+            return 200, json.dumps({**self.stats, "controllers": len(self.controllers)})
+
+        self.stats["requests"] += 1
+        if self.is_dead(host) or self.random.random() < self.timeout_rate:
+            self.stats["timeouts"] += 1
+            await asyncio.sleep(HANG_TIME)
+            return None
+        if self.random.random() < self.dropout_rate:
+            self.stats["dropouts"] += 1
+            return None
+
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        await asyncio.sleep(max(delay, 0))
+
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        controller = self.controller(host)
+        pin = params.get("pin", "")
+        if url.path == "/cgi-bin/io_value":
+            self.stats["io_value"] += 1
+            return 200, str(controller.read(pin))
+        if url.path == "/cgi-bin/io_state":
+            self.stats["io_state"] += 1
+            controller.switch(pin, params.get("state", "off").lower())
+            return 200, "OK"
+        self.stats["not_found"] += 1
+        return 404, "Not found"
+
+    async def flip_locally(self):
+        """Make random manual switches at the cabinets, flip_rate per hour each."""
+        while True:
+            await asyncio.sleep(1)
+            chance = self.flip_rate / 3600
+            for controller in self.controllers.values():
+                if self.random.random() < chance:
+                    controller.flip_local()
+                    self.stats["flips"] += 1
+
+
+async def serve_connection(fleet, reader, writer):
+    """Serve HTTP/1.1 requests on one keep-alive connection."""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+            except ValueError:
+                break
+            result = await fleet.handle(headers.get("host", ""), target)
+            if result is None:
+                break  # Drop the connection without an answer
+
+            status, body = result
+            body = body.encode("utf-8")
+            reason = "OK" if status == 200 else "Not Found"
+            writer.write(
+                f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: text/plain\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(fleet, host, port):
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(fleet, reader, writer),
+        host,
+        port,
+        backlog=1024,
+    )
+    asyncio.create_task(fleet.flip_locally())
+    print(f"Simulating controllers on {host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate cabinet controllers for every 127.x.y.z address."
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument(
+        "--latency", type=float, default=LATENCY, help="Mean answer time in seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=JITTER, help="Latency spread in seconds"
+    )
+    parser.add_argument(
+        "--timeout-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests that are never answered",
+    )
+    parser.add_argument(
+        "--dropout-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests whose connection is dropped",
+    )
+    parser.add_argument(
+        "--dead-fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of controllers that never answer",
+    )
+    parser.add_argument(
+        "--flip-rate",
+        type=float,
+        default=0.0,
+        help="Manual switches at the cabinet per controller per hour",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed for a repeatable run")
+    args = parser.parse_args()
+
+    fleet = SimulatedFleet(
+        latency=args.latency,
+        jitter=args.jitter,
+        timeout_rate=args.timeout_rate,
+        dropout_rate=args.dropout_rate,
+        dead_fraction=args.dead_fraction,
+        flip_rate=args.flip_rate,
+        seed=args.seed,
+    )
+    try:
+        asyncio.run(run(fleet, args.host, args.port))
+    except KeyboardInterrupt:
+        print("\nSimulator stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,631 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# coordinator.py - runs astro events, reconciliation and polling in one process.
+#
+# Replaces running RelevantEvents.py, astro.py and checkStates.py side by
+# side; do not run those at the same time as the coordinator. The tasks
+# share one in-memory copy of heimtaugaskapar and a single writer task
+# makes every database write. Changes made by other processes (intrapi.py,
+# ux.py) are picked up from the change log. A task that fails is restarted
+# with backoff.
+
+import argparse
+import asyncio
+import datetime
+import heapq
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+
+import apiState
+import apiTurn
+import astro
+import astroSchedule
+import checkStates
+import metrics
+import RelevantEvents
+import styringDB
+from controllerClient import get_client
+from staggerPlanner import (
+    DS_LIMIT,
+    GLOBAL_RATE,
+    STAGGER_WINDOW,
+    StaggerPlanner,
+    ds_limit_arg,
+)
+from updateDBcell import update_db_cells
+
+DB_NAME = "styring.db"  # Database name
+TASKS = ("astro", "reconcile", "poll")  # Tasks that can be switched on and off
+FOLLOW_INTERVAL = 1  # Seconds between checks of the change log for outside writes
+WRITE_INTERVAL = 0.5  # Seconds the writer gathers changes into one transaction
+RECONCILE_INTERVAL = 5  # Longest wait of the reconcile task without a wake-up
+COMMAND_RETRY_INTERVAL = 60  # Seconds before an unverified command is resent
+POLL_INTERVAL = 60  # Seconds between the start of two poll sweeps
+SWITCH_CONCURRENCY = 32  # Switch commands in flight at the same time
+RESTART_DELAY = 1  # Seconds before a failed task is restarted, doubled each time
+MAX_RESTART_DELAY = 60  # Longest wait before a restart
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Columns whose change may mean a device needs switching
+RECONCILE_FIELDS = ("astroman", "astrostate", "outputstate")
+
+task_restarts_total = metrics.counter(
+    "gungnir_coordinator_task_restarts_total",
+    "Coordinator tasks restarted after failing.",
+    ["task"],
+)
+
+
+def log(message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+    print(f"{timestamp} - {message}")
+
+
+class FleetState:
+    """The devices shared by the tasks, and the writes waiting for the writer.
+
+    Tasks change devices with update(), which applies the change in memory
+    at once and queues it for the writer. Every database write of the
+    coordinator goes through the writer task, either as a queued device
+    change or as a call passed to call_writer().
+    """
+
+    def __init__(self, db_name=DB_NAME):
+        self.db_name = db_name
+        self.devices = {}  # Device id -> device dict
+        self.version = None  # Change log seq the devices are current to
+        self.pending = {}  # Device id -> changed columns not written yet
+        self.writing = {}  # Device id -> changed columns being written now
+        self.commands = []  # (device id, state, issued_at) not recorded yet
+        self.calls = []  # (function, args, future) for the writer to run
+        self.io_lock = asyncio.Lock()  # Keeps the writer and follow() apart
+        self.dirty = asyncio.Event()  # Set when the writer has work
+        # Set when a device may need switching
+        self.reconcile_needed = asyncio.Event()
+        # Set when devices are added, moved or removed
+        self.locations_changed = asyncio.Event()
+
+    async def load(self):
+        version, devices = await asyncio.to_thread(
+            styringDB.get_all_devices_with_version, self.db_name
+        )
+        self.devices = {device["id"]: device for device in devices}
+        self.version = version
+        self.locations_changed.set()
+        self.reconcile_needed.set()
+
+    def update(self, device_id, **values):
+        """Change columns of a device in memory and queue the write.
+
+        Returns the columns that actually changed.
+        """
+        device = self.devices.get(device_id)
+        if device is None:
+            return {}
+        changed = {
+            column: value for column, value in values.items() if device[column] != value
+        }
+        if changed:
+            device.update(changed)
+            self.pending.setdefault(device_id, {}).update(changed)
+            self.dirty.set()
+            if any(column in changed for column in RECONCILE_FIELDS):
+                self.reconcile_needed.set()
+        return changed
+
+    def record_command(self, device_id, state):
+        issued_at = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+        self.commands.append((device_id, state, issued_at))
+        self.dirty.set()
+
+    def call_writer(self, function, *args):
+        """Have the writer run a function that writes; returns a future of its result."""
+        future = asyncio.get_running_loop().create_future()
+        self.calls.append((function, args, future))
+        self.dirty.set()
+        return future
+
+    async def follow(self):
+        """Apply the writes other processes made since the last check."""
+        async with self.io_lock:
+            version, changed_ids, complete = await asyncio.to_thread(
+                styringDB.get_changes_since, self.version, self.db_name
+            )
+            if version == self.version:
+                return
+            if complete:
+                fresh = await asyncio.to_thread(
+                    styringDB.get_devices_by_ids, changed_ids, self.db_name
+                )
+            else:
+                # The log was pruned past our version, compare every device
+                fresh = dict.fromkeys(self.devices)
+                for device in await asyncio.to_thread(
+                    styringDB.get_all_devices, self.db_name
+                ):
+                    fresh[device["id"]] = device
+
+            for device_id, device in fresh.items():
+                current = self.devices.get(device_id)
+                if device is None:
+                    if current is not None:
+                        del self.devices[device_id]
+                        self.locations_changed.set()
+                    continue
+
+                # Our own changes not written yet win over the database
+                device.update(self.writing.get(device_id, {}))
+                device.update(self.pending.get(device_id, {}))
+                if current is None:
+                    self.devices[device_id] = device
+                    self.locations_changed.set()
+                    self.reconcile_needed.set()
+                    continue
+                if (current["lat"], current["lon"]) != (device["lat"], device["lon"]):
+                    self.locations_changed.set()
+                if any(current[field] != device[field] for field in RECONCILE_FIELDS):
+                    self.reconcile_needed.set()
+                current.update(device)
+            self.version = version
+
+
+# Function to write a batch of device changes and commands in one transaction
+def write_batch(db_name, rows, commands):
+    with styringDB.transaction(db_name):
+        update_db_cells(db_name, "heimtaugaskapar", "id", rows)
+        for device_id, state, issued_at in commands:
+            styringDB.record_command(device_id, state, issued_at, db_name=db_name)
+
+
+# The only task that writes to the database
+async def writer_task(state):
+    while True:
+        await state.dirty.wait()
+        await asyncio.sleep(WRITE_INTERVAL)  # Gather what follows into the batch
+        state.dirty.clear()
+
+        async with state.io_lock:
+            state.writing, state.pending = state.pending, {}
+            commands, state.commands = state.commands, []
+            calls, state.calls = state.calls, []
+            rows = list(state.writing.items())
+            try:
+                await asyncio.to_thread(write_batch, state.db_name, rows, commands)
+            except Exception:
+                # Put the batch back in front of anything queued since
+                for device_id, values in state.writing.items():
+                    state.pending[device_id] = {
+                        **values,
+                        **state.pending.get(device_id, {}),
+                    }
+                state.commands[:0] = commands
+                state.calls[:0] = calls
+                state.dirty.set()
+                raise
+            finally:
+                state.writing = {}
+
+            for function, args, future in calls:
+                try:
+                    future.set_result(await asyncio.to_thread(function, *args))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+# Keeps the shared devices in step with writes made by other processes
+async def follow_task(state):
+    while True:
+        await state.follow()
+        await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+# Works out astro events, sleeping until the next one is due
+async def astro_task(state, options):
+    heap = []  # (event time, device id, is an event) as in RelevantEvents.run_scheduler
+    schedule_refreshed = None
+
+    while True:
+        now = datetime.datetime.utcnow()
+        if options.schedule and (
+            schedule_refreshed is None
+            or (now - schedule_refreshed).total_seconds()
+            >= RelevantEvents.SCHEDULER_RECHECK
+        ):
+            await state.call_writer(
+                astroSchedule.refresh_schedule, state.db_name, options.offset, now
+            )
+            schedule_refreshed = now
+
+        due = []
+        if state.locations_changed.is_set():
+            state.locations_changed.clear()
+            heap = []
+            due_ids = set(state.devices)
+        else:
+            while heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap))
+            due_ids = {device_id for _, device_id, _ in due}
+
+        if due_ids:
+            devices = [
+                dict(state.devices[device_id])
+                for device_id in due_ids
+                if device_id in state.devices
+            ]
+            with metrics.sweep_seconds.time(loop="coordinator-astro"):
+                events_by_id = await asyncio.to_thread(
+                    RelevantEvents.compute_events,
+                    devices,
+                    now,
+                    options,
+                    state.db_name,
+                )
+            for device_id, events in events_by_id.items():
+                last_event, next_event, _, current_state = events
+                values = RelevantEvents.astro_columns(
+                    last_event, next_event, current_state
+                )
+                state.update(
+                    device_id, **dict(zip(RelevantEvents.ASTRO_COLUMNS, values))
+                )
+                if next_event:
+                    heapq.heappush(heap, (next_event[1], device_id, True))
+                else:
+                    # No upcoming event (polar day/night), check again later
+                    recheck = now + timedelta(seconds=RelevantEvents.SCHEDULER_RECHECK)
+                    heapq.heappush(heap, (recheck, device_id, False))
+
+            flipped_at = datetime.datetime.utcnow()
+            lags = [
+                (flipped_at - event_time).total_seconds()
+                for event_time, _, is_event in due
+                if is_event
+            ]
+            for lag in lags:
+                RelevantEvents.flip_lag_seconds.observe(lag)
+            if lags:
+                log(f"Astro flipped {len(lags)} devices, lag max {max(lags):.3f} s.")
+
+        # Sleep until the next event, or until devices are added or moved
+        wait = RelevantEvents.SCHEDULER_MAX_SLEEP
+        if heap:
+            until_next = (heap[0][0] - datetime.datetime.utcnow()).total_seconds()
+            wait = min(max(until_next, 0), wait)
+        try:
+            await asyncio.wait_for(state.locations_changed.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Function to send a switch command, retrying like apiTurn.turn_output
+def send_command(device_info, turn_state):
+    for attempt in range(apiTurn.RETRY_LIMIT):
+        try:
+            response = get_client().io_state(
+                device_info["ip"], device_info["output_pin"], turn_state
+            )
+            return response.status_code == 200
+        except requests.exceptions.RequestException as e:
+            print(
+                f"Attempt {attempt + 1}/{apiTurn.RETRY_LIMIT}: Error communicating "
+                f"with {device_info['ip']}: {e}"
+            )
+            if attempt + 1 < apiTurn.RETRY_LIMIT:
+                metrics.controller_retries_total.inc(script="coordinator")
+    return False
+
+
+class Switcher:
+    """Switches devices in the background and feeds the read-back into the state."""
+
+    def __init__(self, state, concurrency=SWITCH_CONCURRENCY):
+        self.state = state
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.in_flight = set()  # Device ids being switched right now
+        self.switches = {}  # Device id -> switches finished, to spot stale reads
+        self.tasks = set()
+
+    def start(self, device, turn_state, flip_time=None):
+        """Switch a device in the background, measuring its lag from flip_time."""
+        self.in_flight.add(device["id"])
+        task = asyncio.create_task(self.switch(dict(device), turn_state, flip_time))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def switch(self, device, turn_state, flip_time):
+        device_id = device["id"]
+        try:
+            device_info = apiTurn.device_info_from_row(device)
+            async with self.semaphore:
+                sent = await asyncio.to_thread(send_command, device_info, turn_state)
+                if not sent:
+                    log(f"Error turning {turn_state} device {device_id}")
+                    return
+                self.state.record_command(device_id, turn_state)
+                states = {}
+                for var in ("outputstate", "inputstate"):
+                    pin_state = await asyncio.to_thread(
+                        apiState.check_pin_state, device_info, var
+                    )
+                    if pin_state is not None:
+                        states[var] = "ON" if pin_state == "1" else "OFF"
+
+            current = self.state.devices.get(device_id)
+            if current is None:
+                return
+            self.state.update(device_id, **checkStates.changed_columns(current, states))
+            if states.get("outputstate") != turn_state:
+                log(
+                    f"Device {device_id} reads {states.get('outputstate')} after switching"
+                )
+                return
+            if flip_time:
+                lag = datetime.datetime.utcnow() - flip_time
+                metrics.switch_lag_seconds.observe(lag.total_seconds())
+        finally:
+            self.in_flight.discard(device_id)
+            self.switches[device_id] = self.switches.get(device_id, 0) + 1
+            # The read-back may leave the device still needing a command
+            self.state.reconcile_needed.set()
+
+
+# Switches ASTRO devices to their astrostate as soon as anything changes
+async def reconcile_task(state, switcher, planner):
+    last_commands = {}  # Device id -> (state, monotonic time) of the last command
+    warned = {}  # Device id -> invalid value already reported
+    measured_flips = {}  # Device id -> astro flip its switch lag was measured for
+
+    while True:
+        state.reconcile_needed.clear()
+        now = time.monotonic()
+        to_turn = []
+        for device_id, device in list(state.devices.items()):
+            astroman = device["astroman"]
+            astrostate = device["astrostate"]
+            if astroman == "MANUAL":
+                continue
+            if astroman != "ASTRO":
+                if warned.get(device_id) != ("astroman", astroman):
+                    print(
+                        f"Device {device_id} has invalid astroman value '{astroman}'. Skipping."
+                    )
+                    warned[device_id] = ("astroman", astroman)
+                continue
+
+            state.update(device_id, uxstate=astrostate)
+            if astrostate == device["outputstate"]:
+                last_commands.pop(device_id, None)
+                continue
+            if astrostate not in ["ON", "OFF"]:
+                if warned.get(device_id) != ("astrostate", astrostate):
+                    print(
+                        f"Device {device_id} has invalid astrostate '{astrostate}'. Skipping."
+                    )
+                    warned[device_id] = ("astrostate", astrostate)
+                continue
+            if device_id in switcher.in_flight:
+                continue
+            last_state, sent_at = last_commands.get(device_id, (None, 0))
+            if last_state == astrostate and now - sent_at < COMMAND_RETRY_INTERVAL:
+                continue
+            to_turn.append((device, astrostate))
+
+        # OFF commands go out at once, ON commands are staggered as in astro.py
+        turn_on = [device for device, turn_state in to_turn if turn_state == "ON"]
+        on_ids = {device["id"] for device in turn_on}
+        for device_id in list(planner.planned):
+            if device_id not in on_ids:
+                planner.cancel(device_id)
+        planner.plan(turn_on, now)
+
+        due = [(device, "OFF") for device, turn_state in to_turn if turn_state == "OFF"]
+        due += [(device, "ON") for device in planner.due(time.monotonic())]
+        for device, turn_state in due:
+            flip_time = astro.lag_flip_time(
+                device, measured_flips, planner.window + COMMAND_RETRY_INTERVAL
+            )
+            switcher.start(device, turn_state, flip_time)
+            last_commands[device["id"]] = (turn_state, time.monotonic())
+        if due:
+            log(f"Reconcile sent {len(due)} commands, {len(planner.planned)} planned.")
+
+        # Wait for a change, the next planned command or the retry interval
+        wait = RECONCILE_INTERVAL
+        if planner.queue:
+            wait = min(max(planner.queue[0][0] - time.monotonic(), 0), wait)
+        try:
+            await asyncio.wait_for(state.reconcile_needed.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+# Reads every controller at a fixed interval and records what changed
+async def poll_task(state, switcher, concurrency, controller_interval, interval):
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = checkStates.ControllerRateLimiter(controller_interval)
+
+    while True:
+        started = time.monotonic()
+        devices = [
+            dict(device)
+            for device_id, device in state.devices.items()
+            if device_id not in switcher.in_flight
+        ]
+        # A device switched while it was polled may have been read before
+        # the switch, its read-back is newer than the poll
+        switches = {
+            device["id"]: switcher.switches.get(device["id"]) for device in devices
+        }
+        results = await asyncio.gather(
+            *(checkStates.poll_device(device, semaphore, limiter) for device in devices)
+        )
+
+        answered = changed = 0
+        for device, states in results:
+            current = state.devices.get(device["id"])
+            if (
+                not states
+                or current is None
+                or device["id"] in switcher.in_flight
+                or switcher.switches.get(device["id"]) != switches[device["id"]]
+            ):
+                continue
+            answered += 1
+            if state.update(
+                device["id"], **checkStates.changed_columns(current, states)
+            ):
+                changed += 1
+
+        elapsed = time.monotonic() - started
+        metrics.sweep_seconds.observe(elapsed, loop="coordinator-poll")
+        log(
+            f"Polled {len(devices)} devices in {elapsed:.1f} s: "
+            f"{answered} answered, {changed} changed."
+        )
+        await asyncio.sleep(max(interval - elapsed, 0))
+
+
+# Runs a task forever, restarting it with backoff when it fails
+async def supervise(name, factory):
+    delay = RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        try:
+            await factory()
+            log(f"Task {name} returned, restarting it.")
+        except Exception as e:
+            traceback.print_exc()
+            log(f"Task {name} failed: {e}. Restarting in {delay} s.")
+            task_restarts_total.inc(task=name)
+        if time.monotonic() - started > MAX_RESTART_DELAY:
+            delay = RESTART_DELAY  # It ran fine for a while, start over
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RESTART_DELAY)
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=args.concurrency + SWITCH_CONCURRENCY + 4)
+    )
+    await asyncio.to_thread(styringDB.migrate, DB_NAME)
+
+    state = FleetState(DB_NAME)
+    await state.load()
+    log(f"Loaded {len(state.devices)} devices, running {', '.join(args.tasks)}.")
+
+    switcher = Switcher(state)
+    planner = StaggerPlanner(
+        window=args.window, ds_limit=args.ds_limit, global_rate=args.rate
+    )
+    options = argparse.Namespace(schedule=args.schedule, offset=args.offset)
+
+    tasks = {
+        "writer": lambda: writer_task(state),
+        "follow": lambda: follow_task(state),
+    }
+    if "astro" in args.tasks:
+        tasks["astro"] = lambda: astro_task(state, options)
+    if "reconcile" in args.tasks:
+        tasks["reconcile"] = lambda: reconcile_task(state, switcher, planner)
+    if "poll" in args.tasks:
+        tasks["poll"] = lambda: poll_task(
+            state,
+            switcher,
+            args.concurrency,
+            args.controller_interval,
+            args.poll_interval,
+        )
+    await asyncio.gather(*(supervise(name, factory) for name, factory in tasks.items()))
+
+
+def parse_tasks(value):
+    tasks = [task.strip() for task in value.split(",") if task.strip()]
+    unknown = [task for task in tasks if task not in TASKS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Unknown tasks: {', '.join(unknown)}")
+    return tasks
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run astro events, reconciliation and polling in one process."
+    )
+    parser.add_argument(
+        "--tasks",
+        type=parse_tasks,
+        default=list(TASKS),
+        help=f"Tasks to run (default {','.join(TASKS)})",
+    )
+    parser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        help="Offset in minutes for lights ON/OFF times",
+    )
+    parser.add_argument(
+        "--schedule",
+        action="store_true",
+        help="Look up events in the precomputed astro_schedule table.",
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=STAGGER_WINDOW,
+        help=f"Seconds over which one transition's ON commands are spread (default {STAGGER_WINDOW})",
+    )
+    parser.add_argument(
+        "--ds-limit",
+        type=ds_limit_arg,
+        default=DS_LIMIT,
+        help=f"ON commands per dreifistöð in one slot (default {DS_LIMIT})",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=GLOBAL_RATE,
+        help=f"ON commands per second across all dreifistöðvar (default {GLOBAL_RATE})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=checkStates.MAX_CONCURRENCY,
+        help=f"Controllers polled at the same time (default {checkStates.MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--controller-interval",
+        type=float,
+        default=checkStates.CONTROLLER_INTERVAL,
+        help=f"Minimum seconds between requests to one controller (default {checkStates.CONTROLLER_INTERVAL})",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help=f"Seconds between the start of two poll sweeps (default {POLL_INTERVAL})",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print("\nCoordinator stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# deviceEvents.py - follows the change log and fans device deltas out to listeners
+
+import queue
+import threading
+import time
+
+import styringDB
+
+EVENT_FIELDS = ("outputstate", "inputstate", "localremote", "astroman", "uxstate")
+POLL_INTERVAL = 1  # Seconds between checks of the change log
+SUBSCRIBER_BACKLOG = 1000  # Undelivered batches before a slow listener is dropped
+
+
+class DeviceEventFeed:
+    """One thread following heimtaugaskapar_changes for every listener.
+
+    Each batch published is (version, deltas), where a delta is a dict with
+    the device id and only those EVENT_FIELDS whose value changed. Listeners
+    that fall SUBSCRIBER_BACKLOG batches behind are dropped and should
+    reconnect and start over from a snapshot.
+    """
+
+    def __init__(self, db_name=styringDB.DB_NAME, poll_interval=POLL_INTERVAL):
+        self.db_name = db_name
+        self.poll_interval = poll_interval
+        self.version = None  # Change log seq the states are current to
+        self.states = {}  # Device id -> dict of EVENT_FIELDS
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _state(self, device):
+        return {field: device.get(field) for field in EVENT_FIELDS}
+
+    def start(self):
+        """Load the current states and start following the log, once."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            version, devices = styringDB.get_all_devices_with_version(self.db_name)
+            self.states = {device["id"]: self._state(device) for device in devices}
+            self.version = version
+            self.thread = threading.Thread(
+                target=self._run, name="device-events", daemon=True
+            )
+            self.thread.start()
+
+    def subscribe(self):
+        """Return a queue that receives every batch published from now on."""
+        self.start()
+        subscription = queue.Queue(maxsize=SUBSCRIBER_BACKLOG)
+        with self.lock:
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def is_subscribed(self, subscription):
+        with self.lock:
+            return subscription in self.subscribers
+
+    def snapshot(self):
+        """Return (version, full state of every device) as deltas."""
+        with self.lock:
+            deltas = [
+                {"id": device_id, **state} for device_id, state in self.states.items()
+            ]
+            return self.version, deltas
+
+    def _publish(self, version, deltas):
+        with self.lock:
+            for subscription in list(self.subscribers):
+                try:
+                    subscription.put_nowait((version, deltas))
+                except queue.Full:
+                    self.subscribers.discard(subscription)
+
+    def poll(self):
+        """Read the changes since the last poll and publish their deltas."""
+        version, changed_ids, complete = styringDB.get_changes_since(
+            self.version, self.db_name
+        )
+        if version == self.version:
+            return
+        if complete:
+            devices = styringDB.get_devices_by_ids(changed_ids, self.db_name)
+        else:
+            # The log was pruned past our version, compare every device
+            devices = dict.fromkeys(self.states)
+            for device in styringDB.get_all_devices(self.db_name):
+                devices[device["id"]] = device
+
+        deltas = []
+        with self.lock:
+            for device_id, device in devices.items():
+                if device is None:
+                    self.states.pop(device_id, None)
+                    continue
+                state = self._state(device)
+                previous = self.states.get(device_id, {})
+                changed = {
+                    field: value
+                    for field, value in state.items()
+                    if field not in previous or previous[field] != value
+                }
+                self.states[device_id] = state
+                if changed:
+                    deltas.append({"id": device_id, **changed})
+            self.version = version
+
+        if deltas:
+            self._publish(version, deltas)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error following the change log: {e}")
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def get_feed(db_name=styringDB.DB_NAME):
+    """Return the feed of a database shared by every caller in this process."""
+    with _feeds_lock:
+        if db_name not in _feeds:
+            _feeds[db_name] = DeviceEventFeed(db_name)
+        return _feeds[db_name]
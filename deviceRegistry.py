@@ -0,0 +1,143 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# deviceRegistry.py - in-memory device lookups kept in step with styring.db
+
+import threading
+import time
+
+import styringDB
+
+REFRESH_INTERVAL = 1.0  # Seconds between checks of the database for changes
+
+
+def normalize_hs(hs):
+    """Return the form of an HS number used as index key ('-' and '_' alike)."""
+    return str(hs).replace("-", "_")
+
+
+class DeviceRegistry:
+    """Every device held in memory with hash indexes on id, hs and tsip.
+
+    The registry follows the heimtaugaskapar_changes log: at most every
+    refresh_interval seconds it compares the data version with its own and
+    reloads only the devices changed since, or everything if the log has
+    been pruned past its version. Writes made through update_device() are
+    applied to the database and the registry together.
+    """
+
+    def __init__(self, db_name=styringDB.DB_NAME, refresh_interval=REFRESH_INTERVAL):
+        self.db_name = db_name
+        self.refresh_interval = refresh_interval
+        self.by_id = {}  # Device id -> device dict
+        self.by_hs = {}  # Normalized hs -> device dict
+        self.by_tsip = {}  # tsip -> device dict
+        self.version = None  # Last change log seq applied
+        self.checked_at = 0  # Monotonic time of the last version check
+        self.lock = threading.RLock()
+
+    def _index(self, device):
+        self.by_id[device["id"]] = device
+        if device.get("hs"):
+            self.by_hs[normalize_hs(device["hs"])] = device
+        if device.get("tsip"):
+            self.by_tsip[device["tsip"]] = device
+
+    def _unindex(self, device_id):
+        device = self.by_id.pop(device_id, None)
+        if device is None:
+            return
+        if device.get("hs") and self.by_hs.get(normalize_hs(device["hs"])) is device:
+            del self.by_hs[normalize_hs(device["hs"])]
+        if device.get("tsip") and self.by_tsip.get(device["tsip"]) is device:
+            del self.by_tsip[device["tsip"]]
+
+    def reload(self):
+        """Load every device from the database and rebuild the indexes."""
+        version, devices = styringDB.get_all_devices_with_version(self.db_name)
+        with self.lock:
+            self.by_id, self.by_hs, self.by_tsip = {}, {}, {}
+            for device in devices:
+                self._index(device)
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """Apply the changes logged since the registry's version."""
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.checked_at < self.refresh_interval:
+                return
+            self.checked_at = now
+            if self.version is None:
+                self.reload()
+                return
+
+            version, changed_ids, complete = styringDB.get_changes_since(
+                self.version, self.db_name
+            )
+            if version == self.version:
+                return
+            if not complete:
+                self.reload()
+                return
+
+            for device_id, device in styringDB.get_devices_by_ids(
+                changed_ids, self.db_name
+            ).items():
+                self._unindex(device_id)
+                if device is not None:
+                    self._index(device)
+            self.version = version
+
+    def get_by_id(self, device_id):
+        self.refresh()
+        device = self.by_id.get(device_id)
+        return dict(device) if device else None
+
+    def get_by_hs(self, hs):
+        self.refresh()
+        device = self.by_hs.get(normalize_hs(hs))
+        return dict(device) if device else None
+
+    def get_by_tsip(self, tsip):
+        self.refresh()
+        device = self.by_tsip.get(tsip)
+        return dict(device) if device else None
+
+    def lookup(self, identifier):
+        """Find a device by id, falling back to its HS number."""
+        return self.get_by_id(identifier) or self.get_by_hs(identifier)
+
+    def all_devices(self):
+        self.refresh()
+        return [dict(device) for device in self.by_id.values()]
+
+    def update_device(self, device_id, **values):
+        """Write columns of a device to the database and the registry."""
+        styringDB.update_device(device_id, db_name=self.db_name, **values)
+        self.apply_changes([(device_id, values)])
+
+    def apply_changes(self, rows):
+        """Apply writes already made to the database to the registry.
+
+        rows is a list of (device_id, {column: value}).
+        """
+        with self.lock:
+            for device_id, values in rows:
+                device = self.by_id.get(device_id)
+                if device is not None:
+                    device.update(values)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(db_name=styringDB.DB_NAME):
+    """Return the registry of a database shared by every caller in this process."""
+    with _registries_lock:
+        if db_name not in _registries:
+            _registries[db_name] = DeviceRegistry(db_name)
+        return _registries[db_name]
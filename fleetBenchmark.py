@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# fleetBenchmark.py - runs the control loops against a simulated fleet.
+#
+# Seeds a synthetic heimtaugaskapar table in a scratch directory, starts
+# controllerSim.py for its controllers, then times a checkStates sweep and
+# an astro transition of every ASTRO device to ON. Prints the results as
+# JSON on stdout; the scripts' own output goes to stderr.
+#
+# --smoke runs a small fleet through both loops in well under a minute and
+# exits with status 1 unless every ASTRO device was switched, as a quick
+# check that the control scripts still work together.
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import numpy
+
+import astro
+import checkStates
+import controllerSim
+import styringDB
+from adaptivePolling import parse_time
+from commandQueue import VERIFIED, get_queue
+from controllerClient import get_client
+from deviceRegistry import DeviceRegistry
+from staggerPlanner import (
+    DS_LIMIT,
+    GLOBAL_RATE,
+    STAGGER_WINDOW,
+    StaggerPlanner,
+    ds_limit_arg,
+)
+from updateDBcell import update_db_cells
+
+DEVICES = 1000  # Devices in the synthetic fleet
+DS_COUNT = 40  # Dreifistöðvar the fleet is spread over
+HVERFI_COUNT = 10  # Hverfi the fleet is spread over
+MANUAL_SHARE = 0.1  # Share of devices in MANUAL mode, the rest are ASTRO
+SWITCH_TIMEOUT = 1800  # Seconds the astro transition may take before giving up
+SMOKE_DEVICES = 20  # Devices in the fleet of a --smoke run
+SMOKE_WINDOW = 5  # Seconds the ON commands are spread over in a --smoke run
+SMOKE_TIMEOUT = 60  # Seconds the transition of a --smoke run may take
+SIMULATOR_START_TIMEOUT = 10  # Seconds to wait for controllerSim.py to listen
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+# Resolved at import, before main() changes the working directory
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "controllerSim.py")
+
+# Columns of the heimtaugaskapar table as the control scripts use it
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS heimtaugaskapar (
+        id TEXT PRIMARY KEY,
+        hs TEXT,
+        ds TEXT,
+        hverfi TEXT,
+        heimilisfang TEXT,
+        lat REAL,
+        lon REAL,
+        tsip TEXT,
+        telno TEXT,
+        comment TEXT,
+        inputpin TEXT,
+        outputpin TEXT,
+        inputstate TEXT,
+        outputstate TEXT,
+        localremote TEXT,
+        astroman TEXT,
+        astrostate TEXT,
+        uxstate TEXT,
+        lastastrotime TEXT,
+        lasastroOP TEXT,
+        nextastrotime TEXT,
+        nextastroOP TEXT
+    )
+"""
+
+
+def controller_address(index, port):
+    """Return a distinct loopback tsip for the index-th controller."""
+    return f"127.{index // 62500 + 1}.{index // 250 % 250}.{index % 250 + 1}:{port}"
+
+
+def seed_fleet(db_name, count, port, seed=0):
+    """Create a heimtaugaskapar table of count devices, all OFF, around Reykjavík."""
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        rows.append(
+            (
+                f"SIM{index:05d}",
+                f"HS_{index:05d}",
+                f"DS{index % DS_COUNT:02d}",
+                f"Hverfi {index % HVERFI_COUNT}",
+                64.10 + rng.random() * 0.08,
+                -21.98 + rng.random() * 0.20,
+                controller_address(index, port),
+                "din1",
+                "dout1",
+                "OFF",
+                "OFF",
+                "REMOTE",
+                "MANUAL" if rng.random() < MANUAL_SHARE else "ASTRO",
+                "OFF",
+                "OFF",
+            )
+        )
+    with styringDB.transaction(db_name) as conn:
+        conn.execute(SCHEMA)
+        conn.executemany(
+            """
+            INSERT INTO heimtaugaskapar (
+                id, hs, ds, hverfi, lat, lon, tsip, inputpin, outputpin,
+                inputstate, outputstate, localremote, astroman, astrostate, uxstate
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            rows,
+        )
+    styringDB.migrate(db_name)
+
+
+def start_simulator(port, sim_args):
+    """Start controllerSim.py and wait until it answers."""
+    process = subprocess.Popen(
+        [sys.executable, SIMULATOR, "--port", str(port)] + sim_args,
+        stdout=sys.stderr,
+    )
+    deadline = time.monotonic() + SIMULATOR_START_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            simulator_stats(port)
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"controllerSim.py did not start on port {port}")
+
+
+def simulator_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats", timeout=5) as r:
+        return json.load(r)
+
+
+def summarize(values):
+    """Return count, p50, p95, p99 and max of a list of seconds."""
+    if not values:
+        return {"count": 0}
+    p50, p95, p99 = numpy.percentile(values, [50, 95, 99])
+    return {
+        "count": len(values),
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "max": round(max(values), 3),
+    }
+
+
+def client_totals():
+    """Sum the shared controller client's counters over every controller."""
+    totals = {"requests": 0, "errors": 0, "connections": 0, "reused": 0}
+    for counts in get_client().stats().values():
+        for key in totals:
+            totals[key] += counts[key]
+    return totals
+
+
+# Function to time one checkStates sweep over the whole fleet
+def benchmark_sweep(concurrency):
+    started = time.perf_counter()
+    asyncio.run(checkStates.run_async(concurrency, 0, 0, once=True))
+    return round(time.perf_counter() - started, 3)
+
+
+# Function to flip every ASTRO device to ON and wait for astro to switch them
+def benchmark_switch(planner, timeout):
+    now = datetime.datetime.utcnow()
+    astro_ids = [
+        device["id"]
+        for device in styringDB.get_all_devices()
+        if device["astroman"] == "ASTRO"
+    ]
+    update_db_cells(
+        styringDB.DB_NAME,
+        "heimtaugaskapar",
+        "id",
+        [
+            (
+                device_id,
+                {"astrostate": "ON", "lastastrotime": now.strftime(TIMESTAMP_FORMAT)},
+            )
+            for device_id in astro_ids
+        ],
+    )
+
+    # astro.py keeps the fleet in a registry that follows the change log
+    registry = DeviceRegistry(styringDB.DB_NAME)
+    last_commands, warned, pending_jobs, measured_flips = {}, {}, {}, {}
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        counters = astro.sweep(
+            registry, last_commands, warned, planner, pending_jobs, measured_flips
+        )
+        # Done when nothing is in flight or planned; failed devices would
+        # only be retried after astro.COMMAND_RETRY_INTERVAL
+        if not (pending_jobs or planner.planned or counters["commands"]):
+            break
+        time.sleep(astro.CHECK_INTERVAL)
+    elapsed = time.perf_counter() - started
+
+    queue = get_queue()
+    with queue.lock:
+        jobs = [dict(job) for job in queue.jobs.values()]
+    lags = [
+        (parse_time(job["finished_at"]) - now).total_seconds()
+        for job in jobs
+        if job["status"] == VERIFIED
+    ]
+    still_off = sum(
+        1
+        for device in styringDB.get_devices_by_ids(astro_ids).values()
+        if device and device["outputstate"] != "ON"
+    )
+    return {
+        "devices": len(astro_ids),
+        "seconds": round(elapsed, 3),
+        "commands": len(jobs),
+        "verified": len(lags),
+        "failed": len(jobs) - len(lags),
+        "still_off": still_off,
+        "switch_lag_seconds": summarize(lags),
+    }
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark checkStates and astro against simulated controllers."
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=DEVICES,
+        help=f"Devices in the fleet (default {DEVICES})",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=controllerSim.PORT,
+        help=f"Port for controllerSim.py (default {controllerSim.PORT})",
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for the scratch styring.db (default: a temp dir)"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=checkStates.MAX_CONCURRENCY,
+        help=f"Controllers polled at the same time (default {checkStates.MAX_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--window",
+        type=float,
+        default=STAGGER_WINDOW,
+        help=f"Seconds the ON commands are spread over (default {STAGGER_WINDOW})",
+    )
+    parser.add_argument(
+        "--ds-limit",
+        type=ds_limit_arg,
+        default=DS_LIMIT,
+        help=f"ON commands per dreifistöð in one slot (default {DS_LIMIT})",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=GLOBAL_RATE,
+        help=f"ON commands per second overall (default {GLOBAL_RATE})",
+    )
+    parser.add_argument(
+        "--switch-timeout",
+        type=float,
+        default=SWITCH_TIMEOUT,
+        help=f"Seconds the transition may take (default {SWITCH_TIMEOUT})",
+    )
+    parser.add_argument(
+        "--skip-switch", action="store_true", help="Only benchmark the poll sweep"
+    )
+    parser.add_argument(
+        "--no-simulator",
+        action="store_true",
+        help="Use a controllerSim.py that is already running on --port",
+    )
+    parser.add_argument(
+        "--smoke",
+        action="store_true",
+        help=f"Quick check with {SMOKE_DEVICES} devices and a {SMOKE_WINDOW} s window, "
+        "exits with status 1 unless every ASTRO device was switched",
+    )
+    args, sim_args = parser.parse_known_args()
+    if args.smoke:
+        args.devices = SMOKE_DEVICES
+        args.window = SMOKE_WINDOW
+        args.switch_timeout = SMOKE_TIMEOUT
+        args.skip_switch = False
+    # Anything else (--latency, --timeout-rate, --flip-rate, ...) goes to the simulator
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gungnir-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    # The control scripts open styring.db relative to the working directory
+    os.chdir(workdir)
+    if os.path.exists(styringDB.DB_NAME):
+        sys.exit(
+            f"{workdir} already has a {styringDB.DB_NAME}, pick an empty --workdir"
+        )
+
+    simulator = None if args.no_simulator else start_simulator(args.port, sim_args)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            seed_started = time.perf_counter()
+            seed_fleet(styringDB.DB_NAME, args.devices, args.port)
+            seed_seconds = round(time.perf_counter() - seed_started, 3)
+
+            report = {
+                "devices": args.devices,
+                "workdir": workdir,
+                "seed_seconds": seed_seconds,
+                "sweep_seconds": benchmark_sweep(args.concurrency),
+                "sweep_requests": client_totals(),
+            }
+            if not args.skip_switch:
+                planner = StaggerPlanner(
+                    window=args.window, ds_limit=args.ds_limit, global_rate=args.rate
+                )
+                report["switch"] = benchmark_switch(planner, args.switch_timeout)
+                report["sweep_after_switch_seconds"] = benchmark_sweep(args.concurrency)
+            report["controller_requests"] = client_totals()
+            report["simulator"] = simulator_stats(args.port)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.smoke and (report["switch"]["failed"] or report["switch"]["still_off"]):
+        sys.exit("Smoke run failed: not every ASTRO device was switched")
+
+
+if __name__ == "__main__":
+    main()
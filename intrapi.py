@@ -4,23 +4,31 @@
 
 # intrapi.py
 
+import base64
+import hashlib
 import json
-import sqlite3
-import subprocess
+import threading
 from functools import wraps
 
-from flask import Flask, Response, abort, request
+from flask import Flask, Response, abort, request, url_for
+
+import metrics
+import stateHistory
+import styringDB
+from commandQueue import get_queue, switch_group
+from deviceRegistry import get_registry
 
 app = Flask(__name__)
 
 DATABASE = "styring.db"
 SECRET_FILE = "secret"
+CACHE_CONTROL = "private, no-cache"  # Clients revalidate every time, a 304 is cheap
+MAX_PAGE_SIZE = 1000  # Largest page of devices returned for ?limit=
+LIST_OPTIONS = ("fields", "ids", "hverfi", "astroman", "limit", "cursor")
 
-
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # Enable dict-like access to rows
-    return conn
+# Serialized /devices body of the last data version seen
+devices_cache = {"version": None, "body": None}
+devices_cache_lock = threading.Lock()
 
 
 # Load Id and Secret from the 'secret' file
@@ -52,29 +60,14 @@ def require_auth(func):
     return wrapper
 
 
-# Helper function to get device by id or hs
-def get_device_by_identifier(identifier):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Try to fetch by id (without any modifications)
-    cursor.execute("SELECT * FROM heimtaugaskapar WHERE id = ?", (identifier,))
-    device = cursor.fetchone()
-    if device:
-        conn.close()
-        return dict(device)
+# Time every route and serve /metrics, behind the same authentication
+metrics.instrument_flask(app, "intrapi", decorator=require_auth)
 
-    # Modify the identifier for hs lookup (replace '-' with '_')
-    hs_identifier = identifier.replace("-", "_")
 
-    # Try to fetch by hs
-    cursor.execute("SELECT * FROM heimtaugaskapar WHERE hs = ?", (hs_identifier,))
-    device = cursor.fetchone()
-    conn.close()
-    if device:
-        return dict(device)
-    else:
-        return None
+# Helper function to get device by id or hs, from the in-memory registry
+def get_device_by_identifier(identifier):
+    # Tries the id as given, then the hs with '-' and '_' treated alike
+    return get_registry(DATABASE).lookup(identifier)
 
 
 # New root endpoint that returns the same as '/devices'
@@ -84,15 +77,122 @@ def root():
     return get_all_devices()
 
 
+# Helper function to answer a GET with an ETag, or 304 if the client has it
+def conditional_response(etag, build_json):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(
+            build_json(), content_type="application/json; charset=utf-8"
+        )
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+# Helper function to serialize the whole fleet only when the data changed
+def cached_devices_json(version):
+    with devices_cache_lock:
+        if devices_cache["version"] != version:
+            # The body is read in one snapshot with the version it belongs to
+            version, devices_list = styringDB.get_all_devices_with_version(
+                db_name=DATABASE
+            )
+            devices_cache["body"] = json.dumps(devices_list, ensure_ascii=False)
+            devices_cache["version"] = version
+        return devices_cache["version"], devices_cache["body"]
+
+
+# Helper functions to turn a keyset position into an opaque cursor and back
+def encode_cursor(after_id):
+    token = json.dumps({"after": after_id}).encode("utf-8")
+    return base64.urlsafe_b64encode(token).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded))["after"]
+    except (ValueError, KeyError, TypeError):
+        abort(400, description="Invalid cursor")
+
+
+# Helper function to read the list options of /devices from the query string
+def list_options(args):
+    options = {}
+    if args.get("fields"):
+        fields = [field.strip() for field in args["fields"].split(",")]
+        valid_fields = set(styringDB.get_device_columns(db_name=DATABASE))
+        unknown = [field for field in fields if field not in valid_fields]
+        if unknown:
+            abort(400, description=f"Invalid field names: {', '.join(unknown)}")
+        options["fields"] = fields
+    if args.get("ids"):
+        ids = [device_id.strip() for device_id in args["ids"].split(",")]
+        options["ids"] = [device_id for device_id in ids if device_id]
+        if len(options["ids"]) > MAX_PAGE_SIZE:
+            abort(400, description=f"At most {MAX_PAGE_SIZE} ids per request")
+    if "hverfi" in args:
+        options["hverfi"] = args["hverfi"]
+    if "astroman" in args:
+        options["astroman"] = args["astroman"].upper()
+    if "limit" in args:
+        try:
+            limit = int(args["limit"])
+        except ValueError:
+            abort(400, description="'limit' must be a number")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            abort(400, description=f"'limit' must be between 1 and {MAX_PAGE_SIZE}")
+        options["limit"] = limit
+    if args.get("cursor"):
+        options["after_id"] = decode_cursor(args["cursor"])
+    return options
+
+
 @app.route("/devices", methods=["GET"])
 @require_auth
 def get_all_devices():
-    conn = get_db_connection()
-    devices = conn.execute("SELECT * FROM heimtaugaskapar").fetchall()
-    conn.close()
-    devices_list = [dict(device) for device in devices]
-    response_json = json.dumps(devices_list, ensure_ascii=False)
-    return Response(response_json, content_type="application/json; charset=utf-8")
+    if any(option in request.args for option in LIST_OPTIONS):
+        return query_devices()
+
+    # A client that already has this version only costs the version lookup
+    version = styringDB.get_data_version(db_name=DATABASE)
+    if request.if_none_match.contains(f"devices-{version}"):
+        return conditional_response(f"devices-{version}", None)
+
+    version, body = cached_devices_json(version)
+    return conditional_response(f"devices-{version}", lambda: body)
+
+
+# Helper function for /devices with fields, filters or paging in the query string
+def query_devices():
+    # The ETag covers the data version and the query string
+    query_key = hashlib.sha1(
+        json.dumps(sorted(request.args.items(multi=True))).encode("utf-8")
+    ).hexdigest()[:16]
+    version = styringDB.get_data_version(db_name=DATABASE)
+    if request.if_none_match.contains(f"devices-{version}-{query_key}"):
+        return conditional_response(f"devices-{version}-{query_key}", None)
+
+    options = list_options(request.args)
+    version, devices_list = styringDB.query_devices(db_name=DATABASE, **options)
+    response = conditional_response(
+        f"devices-{version}-{query_key}",
+        lambda: json.dumps(devices_list, ensure_ascii=False),
+    )
+
+    # A full page may have more after it, point the client at the next one
+    if "limit" in options and len(devices_list) == options["limit"]:
+        add_next_page(response, encode_cursor(devices_list[-1]["id"]))
+    return response
+
+
+# Helper function to point a client at the next page of a paged response
+def add_next_page(response, cursor):
+    next_args = {**request.args.to_dict(), **request.view_args, "cursor": cursor}
+    next_url = url_for(request.endpoint, **next_args)
+    response.headers["X-Next-Cursor"] = cursor
+    response.headers["Link"] = f'<{next_url}>; rel="next"'
 
 
 @app.route("/devices/<identifier>", methods=["GET"])
@@ -100,8 +200,16 @@ def get_all_devices():
 def get_device(identifier):
     device = get_device_by_identifier(identifier)
     if device:
-        response_json = json.dumps(device, ensure_ascii=False)
-        return Response(response_json, content_type="application/json; charset=utf-8")
+        # The registry only resolves the identifier, the body and its ETag
+        # are read together so a client never caches an older body
+        version, device = styringDB.get_device_with_version(
+            device["id"], db_name=DATABASE
+        )
+    if device:
+        return conditional_response(
+            f"{device['id']}-{version}",
+            lambda: json.dumps(device, ensure_ascii=False),
+        )
     else:
         abort(404, description="Device not found")
 
@@ -142,41 +250,101 @@ def device_state(identifier):
         if new_state not in ["ON", "OFF"]:
             abort(400, description="Invalid state. Must be 'ON' or 'OFF'.")
 
-        # Call apiTurn.py to change the state
-        result = subprocess.run(
-            ["python3", "apiTurn.py", "--id", device["id"], "--turn", new_state],
-            capture_output=True,
-            text=True,
+        # Queue the switch, the worker pool runs and verifies it
+        job = get_queue(DATABASE).submit(device, new_state)
+        response_json = json.dumps(job, ensure_ascii=False)
+        return Response(
+            response_json,
+            status=202,
+            headers={"Location": f"/jobs/{job['id']}"},
+            content_type="application/json; charset=utf-8",
         )
 
-        if result.returncode != 0:
-            response = {
-                "error": "Failed to change device state",
-                "details": result.stderr,
-            }
-            response_json = json.dumps(response, ensure_ascii=False)
-            return Response(
-                response_json,
-                status=500,
-                content_type="application/json; charset=utf-8",
-            )
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+@require_auth
+def get_job(job_id):
+    job = get_queue(DATABASE).get(job_id)
+    if not job:
+        abort(404, description="Job not found")
+
+    response_json = json.dumps(job, ensure_ascii=False)
+    return Response(response_json, content_type="application/json; charset=utf-8")
+
+
+# Helper function to read and validate the state of a bulk or group request
+def requested_state(data):
+    if not isinstance(data, dict):
+        abort(400, description="Request data must be a JSON object")
+    if "state" not in data:
+        abort(400, description="Missing 'state' in request data")
+
+    new_state = str(data["state"]).upper()
+    if new_state not in ["ON", "OFF"]:
+        abort(400, description="Invalid state. Must be 'ON' or 'OFF'.")
+    return new_state
+
+
+# Helper function to stream group switch results, one JSON object per line
+def stream_results(results):
+    def generate():
+        for result in results:
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return Response(generate(), content_type="application/x-ndjson; charset=utf-8")
+
+
+@app.route("/devices/bulk", methods=["POST"])
+@require_auth
+def devices_bulk():
+    data = request.get_json()
+    new_state = requested_state(data)
+    identifiers = data.get("ids")
+    if not isinstance(identifiers, list) or not identifiers:
+        abort(400, description="'ids' must be a non-empty list")
+
+    devices = []
+    missing = []
+    for identifier in identifiers:
+        device = get_device_by_identifier(str(identifier))
+        if device:
+            devices.append(device)
         else:
-            # Update uxstate in the database
-            conn = get_db_connection()
-            conn.execute(
-                "UPDATE heimtaugaskapar SET uxstate = ? WHERE id = ?",
-                (new_state, device["id"]),
-            )
-            conn.commit()
-            conn.close()
-            response = {
-                "message": f"Device {device['id']} turned {new_state} successfully"
-            }
-            response_json = json.dumps(response, ensure_ascii=False)
-            return Response(
-                response_json, content_type="application/json; charset=utf-8"
+            missing.append(
+                {
+                    "device_id": identifier,
+                    "state": new_state,
+                    "status": "rejected",
+                    "error": "Device not found",
+                }
             )
 
+    def results():
+        yield from missing
+        yield from switch_group(devices, new_state, queue=get_queue(DATABASE))
+
+    return stream_results(results())
+
+
+@app.route("/groups/state", methods=["POST"])
+@require_auth
+def groups_state():
+    data = request.get_json()
+    new_state = requested_state(data)
+    if "ids" in data:
+        return devices_bulk()
+
+    if "hverfi" not in data and "ds" not in data:
+        abort(400, description="Missing 'ids', 'hverfi' or 'ds' in request data")
+
+    devices = styringDB.get_devices_in_group(
+        hverfi=data.get("hverfi"), ds=data.get("ds"), db_name=DATABASE
+    )
+    if not devices:
+        abort(404, description="No devices found in group")
+
+    return stream_results(switch_group(devices, new_state, queue=get_queue(DATABASE)))
+
 
 @app.route("/devices/<identifier>/astroman", methods=["GET", "POST"])
 @require_auth
@@ -202,13 +370,7 @@ def device_astroman(identifier):
             )
 
         # Update the database
-        conn = get_db_connection()
-        conn.execute(
-            "UPDATE heimtaugaskapar SET astroman = ? WHERE id = ?",
-            (new_mode, device["id"]),
-        )
-        conn.commit()
-        conn.close()
+        get_registry(DATABASE).update_device(device["id"], astroman=new_mode)
 
         response = {"message": f"Device {device['id']} astroman set to {new_mode}"}
         response_json = json.dumps(response, ensure_ascii=False)
@@ -266,6 +428,84 @@ def device_lastastro(identifier):
     return Response(response_json, content_type="application/json; charset=utf-8")
 
 
+# Endpoint for the state transition history of a device
+@app.route("/devices/<identifier>/history", methods=["GET"])
+@require_auth
+def device_history(identifier):
+    device = get_device_by_identifier(identifier)
+    if not device:
+        abort(404, description="Device not found")
+
+    return transitions_page(device_id=device["id"])
+
+
+# Endpoint for the state transition history of a hverfi
+@app.route("/history", methods=["GET"])
+@require_auth
+def hverfi_history():
+    if "hverfi" not in request.args:
+        abort(400, description="Missing 'hverfi' in query string")
+
+    return transitions_page(hverfi=request.args["hverfi"])
+
+
+# Helper function to answer one page of transitions, oldest first
+def transitions_page(**selection):
+    limit = stateHistory.QUERY_LIMIT
+    if "limit" in request.args:
+        try:
+            limit = int(request.args["limit"])
+        except ValueError:
+            abort(400, description="'limit' must be a number")
+        if not 1 <= limit <= stateHistory.QUERY_LIMIT:
+            abort(
+                400,
+                description=f"'limit' must be between 1 and {stateHistory.QUERY_LIMIT}",
+            )
+    after = None
+    if request.args.get("cursor"):
+        after = decode_cursor(request.args["cursor"])
+        if not (isinstance(after, list) and len(after) == 2):
+            abort(400, description="Invalid cursor")
+
+    transitions = stateHistory.get_transitions(
+        field=request.args.get("field"),
+        start=request.args.get("from"),
+        end=request.args.get("to"),
+        after=after,
+        limit=limit,
+        db_name=DATABASE,
+        **selection,
+    )
+    response_json = json.dumps(transitions, ensure_ascii=False)
+    response = Response(response_json, content_type="application/json; charset=utf-8")
+    if len(transitions) == limit:
+        last = transitions[-1]
+        add_next_page(response, encode_cursor([last["changed_at"], last["id"]]))
+    return response
+
+
+# Endpoint for hourly or daily transition counts
+@app.route("/history/rollups", methods=["GET"])
+@require_auth
+def history_rollups():
+    period = request.args.get("period", "daily")
+    if period not in styringDB.ROLLUP_PERIODS:
+        abort(400, description="Invalid period. Must be 'hourly' or 'daily'.")
+
+    rollups = stateHistory.get_rollups(
+        period=period,
+        device_id=request.args.get("id"),
+        hverfi=request.args.get("hverfi"),
+        field=request.args.get("field"),
+        start=request.args.get("from"),
+        end=request.args.get("to"),
+        db_name=DATABASE,
+    )
+    response_json = json.dumps(rollups, ensure_ascii=False)
+    return Response(response_json, content_type="application/json; charset=utf-8")
+
+
 # Custom error handlers to ensure non-ASCII characters are handled
 @app.errorhandler(400)
 def bad_request(e):
@@ -313,4 +553,7 @@ def internal_server_error(e):
 
 
 if __name__ == "__main__":
+    # Apply pending schema migrations, the ETags rely on the change log.
+    # Under another WSGI server run "styringDB.py --migrate" first.
+    styringDB.migrate(DATABASE)
     app.run(host="0.0.0.0", port=5053)
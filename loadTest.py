@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# loadTest.py - replays a mix of API and web UI requests at fixed concurrency.
+#
+# Seeds a synthetic styring.db in a scratch directory, starts
+# controllerSim.py, intrapi.py and ux.py against it and keeps a fixed number
+# of clients busy with a weighted mix of requests for a set time. Prints
+# latency percentiles per request kind, throughput and the apps' database
+# lock waits as JSON, so runs of different releases can be compared.
+
+import argparse
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import styringDB
+from fleetBenchmark import seed_fleet, simulator_stats, start_simulator, summarize
+
+DEVICES = 1000  # Devices in the synthetic fleet
+CONCURRENCY = 16  # Clients sending requests at the same time
+DURATION = 30  # Seconds of measured load
+WARMUP = 3  # Seconds of load before measuring starts
+SIMULATOR_PORT = 18090  # Port for controllerSim.py
+INTRAPI_PORT = 5053  # Port intrapi.py listens on
+UX_PORT = 5051  # Port ux.py listens on
+APP_START_TIMEOUT = 30  # Seconds to wait for an app to answer
+REQUEST_TIMEOUT = 30  # Seconds before a request counts as failed
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Request kinds and their default share of the load, an integrator polling
+# the API while operators have the web UI open
+DEFAULT_MIX = {
+    "devices": 10,  # GET /devices, full body every time
+    "devices_etag": 10,  # GET /devices with If-None-Match, as a polling client
+    "devices_page": 5,  # GET /devices?fields=...&limit=100
+    "device": 25,  # GET /devices/<id>
+    "field": 20,  # GET /devices/<id>/fields/outputstate
+    "state": 5,  # POST /devices/<id>/state of a MANUAL device
+    "astroman": 5,  # POST /devices/<id>/astroman
+    "index": 15,  # GET / of ux.py
+    "ux_astroman": 5,  # POST /update_astroman of ux.py
+}
+
+# Prometheus samples of the apps' database write metrics
+DB_SAMPLES = (
+    "gungnir_db_lock_wait_seconds_sum",
+    "gungnir_db_lock_wait_seconds_count",
+    "gungnir_db_write_seconds_sum",
+    "gungnir_db_write_seconds_count",
+    "gungnir_db_lock_retries_total",
+)
+
+
+def parse_mix(value):
+    """Parse "devices=20,device=50,..." into a dict of request kind -> weight."""
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Unknown request kind '{kind}'")
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid weight for '{kind}'")
+    return mix
+
+
+class LoadClient:
+    """One simulated client with its own keep-alive session and ETag memory."""
+
+    def __init__(self, intrapi_url, ux_url, auth_headers, devices, rng):
+        self.intrapi_url = intrapi_url
+        self.ux_url = ux_url
+        self.session = requests.Session()
+        self.session.headers.update(auth_headers)
+        self.devices = devices
+        self.manual = [device for device in devices if device["astroman"] == "MANUAL"]
+        self.rng = rng
+        self.etag = None
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, timeout=REQUEST_TIMEOUT, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session.post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+
+    def send(self, kind):
+        """Send one request of a kind and return whether it succeeded."""
+        device = self.rng.choice(self.devices)
+        if kind == "devices":
+            response = self.get(f"{self.intrapi_url}/devices")
+        elif kind == "devices_etag":
+            headers = {"If-None-Match": self.etag} if self.etag else {}
+            response = self.get(f"{self.intrapi_url}/devices", headers=headers)
+            self.etag = response.headers.get("ETag", self.etag)
+        elif kind == "devices_page":
+            response = self.get(
+                f"{self.intrapi_url}/devices",
+                params={"fields": "id,outputstate,localremote", "limit": 100},
+            )
+        elif kind == "device":
+            response = self.get(f"{self.intrapi_url}/devices/{device['id']}")
+        elif kind == "field":
+            response = self.get(
+                f"{self.intrapi_url}/devices/{device['id']}/fields/outputstate"
+            )
+        elif kind == "state":
+            device = self.rng.choice(self.manual)
+            response = self.post(
+                f"{self.intrapi_url}/devices/{device['id']}/state",
+                json={"state": self.rng.choice(["ON", "OFF"])},
+            )
+        elif kind == "astroman":
+            # Written back unchanged, so the mix of MANUAL devices stays put
+            response = self.post(
+                f"{self.intrapi_url}/devices/{device['id']}/astroman",
+                json={"astroman": device["astroman"]},
+            )
+        elif kind == "index":
+            response = self.get(f"{self.ux_url}/")
+        else:
+            response = self.post(
+                f"{self.ux_url}/update_astroman",
+                data={"device_id": device["id"], "astroman": device["astroman"]},
+                allow_redirects=False,
+            )
+        return response.status_code < 400
+
+
+def run_load(clients, mix, warmup, duration):
+    """Keep every client busy until the time is up; return the measured samples.
+
+    Returns a dict of request kind -> list of (latency, succeeded) and the
+    measured seconds.
+    """
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    samples = {kind: [] for kind in kinds}
+    lock = threading.Lock()
+    start = time.monotonic() + warmup
+    end = start + duration
+
+    def work(client):
+        while True:
+            kind = client.rng.choices(kinds, weights)[0]
+            started = time.monotonic()
+            if started >= end:
+                return
+            try:
+                succeeded = client.send(kind)
+            except requests.exceptions.RequestException:
+                succeeded = False
+            if started >= start:
+                with lock:
+                    samples[kind].append((time.monotonic() - started, succeeded))
+
+    threads = [threading.Thread(target=work, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, duration
+
+
+def start_app(script, port, workdir, check_url, headers=None):
+    """Start one of the Flask apps in the scratch directory and wait for it."""
+    log = open(os.path.join(workdir, f"{script}.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SCRIPT_DIR, script)],
+        cwd=workdir,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + APP_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            requests.get(check_url, headers=headers, timeout=5)
+            return process
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{script} did not start on port {port}, see {log.name}")
+
+
+def scrape_db_metrics(url, headers=None):
+    """Return the database write samples of an app's /metrics, summed over labels."""
+    values = dict.fromkeys(DB_SAMPLES, 0.0)
+    text = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT).text
+    for line in text.splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        name_and_labels, _, value = line.rpartition(" ")
+        name = name_and_labels.split("{")[0]
+        if name in values:
+            values[name] += float(value)
+    return values
+
+
+def db_report(before, after):
+    """Turn two scrapes into the writes, lock waits and retries between them."""
+    delta = {name: after[name] - before[name] for name in DB_SAMPLES}
+    writes = int(delta["gungnir_db_write_seconds_count"])
+    return {
+        "writes": writes,
+        "write_seconds_mean": round(
+            delta["gungnir_db_write_seconds_sum"] / writes if writes else 0, 6
+        ),
+        "lock_wait_seconds_total": round(delta["gungnir_db_lock_wait_seconds_sum"], 6),
+        "lock_wait_seconds_mean": round(
+            delta["gungnir_db_lock_wait_seconds_sum"] / writes if writes else 0, 6
+        ),
+        "lock_retries": int(delta["gungnir_db_lock_retries_total"]),
+    }
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test intrapi.py and ux.py against a synthetic fleet."
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=DEVICES,
+        help=f"Devices in the fleet (default {DEVICES})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Clients sending requests at the same time (default {CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=DURATION,
+        help=f"Seconds of measured load (default {DURATION})",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=WARMUP,
+        help=f"Seconds of load before measuring (default {WARMUP})",
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="Request kinds and weights, e.g. devices=20,device=50,index=30 "
+        f"(kinds: {', '.join(DEFAULT_MIX)})",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Random seed for the fleet and the mix"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for the scratch styring.db (default: a temp dir)"
+    )
+    parser.add_argument("--label", help="Name of this run, e.g. the release tested")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gungnir-load-")
+    os.makedirs(workdir, exist_ok=True)
+    db_name = os.path.join(workdir, styringDB.DB_NAME)
+    if os.path.exists(db_name):
+        sys.exit(
+            f"{workdir} already has a {styringDB.DB_NAME}, pick an empty --workdir"
+        )
+
+    # intrapi.py reads its credentials from the secret file in its directory
+    auth_id, auth_secret = secrets.token_hex(8), secrets.token_hex(16)
+    with open(os.path.join(workdir, "secret"), "w") as f:
+        f.write(f"Id: {auth_id}\nSecret: {auth_secret}\n")
+    auth_headers = {
+        "CF-Access-Client-Id": auth_id,
+        "CF-Access-Client-Secret": auth_secret,
+    }
+
+    seed_fleet(db_name, args.devices, SIMULATOR_PORT, seed=args.seed)
+    devices = [
+        {"id": device["id"], "astroman": device["astroman"]}
+        for device in styringDB.get_all_devices(db_name=db_name)
+    ]
+
+    intrapi_url = f"http://127.0.0.1:{INTRAPI_PORT}"
+    ux_url = f"http://127.0.0.1:{UX_PORT}"
+    processes = []
+    try:
+        processes.append(start_simulator(SIMULATOR_PORT, ["--seed", str(args.seed)]))
+        processes.append(
+            start_app(
+                "intrapi.py",
+                INTRAPI_PORT,
+                workdir,
+                f"{intrapi_url}/devices",
+                auth_headers,
+            )
+        )
+        processes.append(start_app("ux.py", UX_PORT, workdir, f"{ux_url}/"))
+
+        rng = random.Random(args.seed)
+        clients = [
+            LoadClient(
+                intrapi_url,
+                ux_url,
+                auth_headers,
+                devices,
+                random.Random(rng.random()),
+            )
+            for _ in range(args.concurrency)
+        ]
+        mix = {kind: weight for kind, weight in args.mix.items() if weight > 0}
+
+        # Scrape after the warmup so the lock waits cover the measured load only
+        scrape_urls = {
+            "intrapi": (f"{intrapi_url}/metrics", auth_headers),
+            "ux": (f"{ux_url}/metrics", None),
+        }
+        before = {}
+
+        def scrape_after_warmup():
+            time.sleep(args.warmup)
+            for app, (url, headers) in scrape_urls.items():
+                before[app] = scrape_db_metrics(url, headers)
+
+        scraper = threading.Thread(target=scrape_after_warmup)
+        scraper.start()
+        samples, duration = run_load(clients, mix, args.warmup, args.duration)
+        scraper.join()
+        after = {
+            app: scrape_db_metrics(url, headers)
+            for app, (url, headers) in scrape_urls.items()
+        }
+        simulator = simulator_stats(SIMULATOR_PORT)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+    requests_by_kind = {}
+    all_latencies = []
+    errors = 0
+    for kind, kind_samples in samples.items():
+        latencies = [latency for latency, _ in kind_samples]
+        kind_errors = sum(1 for _, succeeded in kind_samples if not succeeded)
+        requests_by_kind[kind] = {
+            **summarize(latencies),
+            "errors": kind_errors,
+            "per_second": round(len(latencies) / duration, 1),
+        }
+        all_latencies += latencies
+        errors += kind_errors
+
+    report = {
+        "label": args.label,
+        "devices": args.devices,
+        "concurrency": args.concurrency,
+        "duration_seconds": duration,
+        "workdir": workdir,
+        "mix": mix,
+        "total": {
+            **summarize(all_latencies),
+            "errors": errors,
+            "per_second": round(len(all_latencies) / duration, 1),
+        },
+        "requests": requests_by_kind,
+        "db": {app: db_report(before[app], after[app]) for app in after},
+        "controller_requests": simulator["requests"],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# metrics.py - counters and histograms exposed in the Prometheus text format
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket bounds in seconds, from a fast DB write to a slow sweep
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A count that only goes up, one series per combination of label values."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # Tuple of label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}  # Tuple of label values -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the enclosed block takes."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(b), s, c) for key, (b, s, c) in self.values.items()}
+        for key, (bucket_counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, [("le", "+Inf")])
+            yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+_metrics = {}  # Metric name -> Counter or Histogram
+_metrics_lock = threading.Lock()
+
+
+def _register(metric_class, name, documentation, labelnames, **kwargs):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = metric_class(
+                name, documentation, labelnames, **kwargs
+            )
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Return the counter with this name, creating it on first use."""
+    return _register(Counter, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return the histogram with this name, creating it on first use."""
+    return _register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def render():
+    """Return every metric of this process in the Prometheus text format."""
+    with _metrics_lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the daemon's output
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve /metrics on a port from a background thread, for the daemons."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# Metrics shared by several modules
+
+controller_request_seconds = histogram(
+    "gungnir_controller_request_seconds",
+    "Round-trip time of HTTP requests to a cabinet controller.",
+    ["tsip"],
+)
+controller_requests_total = counter(
+    "gungnir_controller_requests_total",
+    "HTTP requests to cabinet controllers by outcome (ok, error, timeout).",
+    ["tsip", "outcome"],
+)
+controller_retries_total = counter(
+    "gungnir_controller_retries_total",
+    "Controller requests retried after a failed attempt.",
+    ["script"],
+)
+sweep_seconds = histogram(
+    "gungnir_sweep_seconds",
+    "Duration of one full pass of a control loop.",
+    ["loop"],
+)
+db_write_seconds = histogram(
+    "gungnir_db_write_seconds",
+    "Duration of database write transactions, including the lock wait.",
+)
+db_lock_wait_seconds = histogram(
+    "gungnir_db_lock_wait_seconds",
+    "Time spent waiting for the database write lock.",
+)
+db_lock_retries_total = counter(
+    "gungnir_db_lock_retries_total",
+    "Write transactions retried because the database stayed locked.",
+)
+switch_lag_seconds = histogram(
+    "gungnir_switch_lag_seconds",
+    "Time from a scheduled astro flip until the switch was verified.",
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+http_request_seconds = histogram(
+    "gungnir_http_request_seconds",
+    "Latency of web requests per app, route and status.",
+    ["app", "route", "method", "status"],
+)
+
+
+def instrument_flask(app, name, decorator=None):
+    """Time every request of a Flask app and serve /metrics from it.
+
+    decorator, if given, wraps the /metrics view (e.g. to require auth).
+    """
+    from flask import Response, g, request  # Only the web apps need Flask
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_latency(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            http_request_seconds.observe(
+                time.perf_counter() - started,
+                app=name,
+                route=request.url_rule.rule if request.url_rule else "unmatched",
+                method=request.method,
+                status=response.status_code,
+            )
+        return response
+
+    def metrics_view():
+        return Response(render(), content_type=CONTENT_TYPE)
+
+    if decorator is not None:
+        metrics_view = decorator(metrics_view)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -0,0 +1,225 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# pollerLeases.py - splits the fleet between poller workers with leases.
+#
+# The fleet is divided into partitions, by a hash of the device id or by
+# hverfi or ds. Each worker heartbeats into poller_workers and holds
+# time-limited leases on its share of the partitions in poller_leases.
+# Leases are only taken when free or expired, so a partition has one
+# owner at a time; a worker stops polling a partition the moment its lease
+# runs out locally, before anyone else can take it. When a worker joins,
+# the others give up their excess at their next rebalance; when one dies,
+# its leases expire and the rest pick them up.
+#
+# The tables are created by a migration in styringDB.MIGRATIONS. All
+# workers must share one database. With SQLite that means running
+# them on the host of styring.db; workers on other hosts need a database
+# server they can all reach.
+
+import datetime
+import math
+import os
+import socket
+import threading
+import zlib
+from datetime import timedelta
+
+import metrics
+import styringDB
+
+DB_NAME = "styring.db"  # Database name
+PARTITION_BY = ("hash", "hverfi", "ds")  # Ways the fleet can be partitioned
+PARTITIONS = 64  # Partitions when partitioning by hash of the device id
+LEASE_TTL = 30  # Seconds a lease lasts unless renewed
+RENEW_INTERVAL = 10  # Seconds between lease renewals during a sweep
+WORKER_TIMEOUT = 30  # Seconds without a heartbeat before a worker counts as gone
+SAFETY_MARGIN = 2  # Seconds before expiry a worker stops using a lease
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+lease_changes_total = metrics.counter(
+    "gungnir_poller_lease_changes_total",
+    "Partition leases claimed, released or lost by this worker.",
+    ["change"],
+)
+
+
+def _format(moment):
+    return moment.strftime(TIMESTAMP_FORMAT)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaseManager:
+    """One worker's view of the partition leases.
+
+    rebalance() heartbeats, gives up or claims partitions to reach this
+    worker's fair share and returns the partitions held. renew() only
+    extends the leases already held, for use during a sweep.
+    """
+
+    def __init__(
+        self,
+        worker_id=None,
+        partition_by="hash",
+        partitions=PARTITIONS,
+        db_name=DB_NAME,
+        lease_ttl=LEASE_TTL,
+    ):
+        if partition_by not in PARTITION_BY:
+            raise ValueError(f"Unknown partitioning '{partition_by}'")
+        self.worker_id = worker_id or default_worker_id()
+        self.partition_by = partition_by
+        self.partitions = partitions
+        self.db_name = db_name
+        self.lease_ttl = lease_ttl
+        self.expiry = {}  # Partition -> datetime its lease runs out
+        self.lock = threading.Lock()
+
+    def partition_of(self, device):
+        """Return the partition a device belongs to."""
+        if self.partition_by == "hash":
+            index = zlib.crc32(device["id"].encode("utf-8")) % self.partitions
+            return f"hash:{index}"
+        return f"{self.partition_by}:{device[self.partition_by] or ''}"
+
+    def holds(self, partition):
+        """Whether this worker may poll the partition right now."""
+        with self.lock:
+            expires = self.expiry.get(partition)
+        margin = timedelta(seconds=SAFETY_MARGIN)
+        return expires is not None and datetime.datetime.utcnow() < expires - margin
+
+    def holds_device(self, device):
+        return self.holds(self.partition_of(device))
+
+    def held(self):
+        """Return the partitions this worker may poll right now."""
+        with self.lock:
+            partitions = list(self.expiry)
+        return {partition for partition in partitions if self.holds(partition)}
+
+    def _heartbeat(self, conn, now):
+        conn.execute(
+            """
+            INSERT INTO poller_workers (worker_id, host, pid, heartbeat_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+        """,
+            (self.worker_id, socket.gethostname(), os.getpid(), _format(now)),
+        )
+
+    def _set_held(self, held, expires):
+        with self.lock:
+            lost = set(self.expiry) - set(held)
+            self.expiry = {partition: expires for partition in held}
+        return lost
+
+    def rebalance(self, devices):
+        """Claim or give up partitions to hold this worker's fair share.
+
+        devices are the heimtaugaskapar rows, used to find the partitions
+        when partitioning by hverfi or ds. Returns the set of partitions held.
+        """
+        if self.partition_by == "hash":
+            partitions = {f"hash:{index}" for index in range(self.partitions)}
+        else:
+            partitions = {self.partition_of(device) for device in devices}
+        prefix = f"{self.partition_by}:"
+
+        now = datetime.datetime.utcnow()
+        expires = now + timedelta(seconds=self.lease_ttl)
+        with styringDB.transaction(self.db_name) as conn:
+            self._heartbeat(conn, now)
+            conn.execute(
+                "DELETE FROM poller_workers WHERE heartbeat_at < ?",
+                (_format(now - timedelta(seconds=WORKER_TIMEOUT)),),
+            )
+            workers = conn.execute("SELECT COUNT(*) FROM poller_workers").fetchone()[0]
+
+            # Every partition gets a row; rows of partitions that are gone go
+            conn.executemany(
+                "INSERT OR IGNORE INTO poller_leases (partition) VALUES (?)",
+                [(partition,) for partition in sorted(partitions)],
+            )
+            rows = conn.execute(
+                "SELECT partition, worker_id, expires_at FROM poller_leases "
+                "WHERE substr(partition, 1, ?) = ? ORDER BY partition",
+                (len(prefix), prefix),
+            ).fetchall()
+            conn.executemany(
+                "DELETE FROM poller_leases WHERE partition = ?",
+                [(row[0],) for row in rows if row[0] not in partitions],
+            )
+            rows = [row for row in rows if row[0] in partitions]
+
+            now_text = _format(now)
+            held = [
+                row[0]
+                for row in rows
+                if row[1] == self.worker_id and row[2] >= now_text
+            ]
+            free = [row[0] for row in rows if row[1] is None or row[2] < now_text]
+            target = math.ceil(len(partitions) / max(workers, 1))
+
+            released = held[target:]
+            claimed = free[: max(target - len(held), 0)]
+            held = held[:target] + claimed
+            conn.executemany(
+                "UPDATE poller_leases SET worker_id = NULL, expires_at = '' "
+                "WHERE partition = ? AND worker_id = ?",
+                [(partition, self.worker_id) for partition in released],
+            )
+            conn.executemany(
+                "UPDATE poller_leases SET worker_id = ?, expires_at = ? "
+                "WHERE partition = ?",
+                [(self.worker_id, _format(expires), partition) for partition in held],
+            )
+
+        lease_changes_total.inc(len(claimed), change="claimed")
+        lease_changes_total.inc(len(released), change="released")
+        self._set_held(held, expires)
+        return set(held)
+
+    def renew(self):
+        """Extend the leases still held and return them; lapsed ones are dropped."""
+        now = datetime.datetime.utcnow()
+        expires = now + timedelta(seconds=self.lease_ttl)
+        with styringDB.transaction(self.db_name) as conn:
+            self._heartbeat(conn, now)
+            conn.execute(
+                "UPDATE poller_leases SET expires_at = ? "
+                "WHERE worker_id = ? AND expires_at >= ?",
+                (_format(expires), self.worker_id, _format(now)),
+            )
+            held = [
+                row[0]
+                for row in conn.execute(
+                    "SELECT partition FROM poller_leases "
+                    "WHERE worker_id = ? AND expires_at = ?",
+                    (self.worker_id, _format(expires)),
+                )
+            ]
+        lost = self._set_held(held, expires)
+        if lost:
+            lease_changes_total.inc(len(lost), change="lost")
+            print(
+                f"Worker {self.worker_id} lost the leases of {', '.join(sorted(lost))}"
+            )
+        return set(held)
+
+    def release_all(self):
+        """Give up every lease and leave, so the others take over at once."""
+        with styringDB.transaction(self.db_name) as conn:
+            conn.execute(
+                "UPDATE poller_leases SET worker_id = NULL, expires_at = '' "
+                "WHERE worker_id = ?",
+                (self.worker_id,),
+            )
+            conn.execute(
+                "DELETE FROM poller_workers WHERE worker_id = ?", (self.worker_id,)
+            )
+        self._set_held([], None)
@@ -0,0 +1,70 @@
+#!/bin/sh
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# offlineSchedule.sh - switches the lights from the schedule pushed by
+# scheduleCompiler.py while the central server cannot be reached.
+#
+# Run from cron every minute:
+#   * * * * * /etc/gungnir/offlineSchedule.sh
+# /etc/gungnir/offline.conf sets USERNAME, PASSWORD and CENTRAL_HOST.
+
+CONF=/etc/gungnir/offline.conf
+SCHEDULE=/etc/gungnir/schedule
+
+[ -r "$CONF" ] && [ -r "$SCHEDULE" ] || exit 0
+. "$CONF"
+
+# The central server is in charge while it can be reached
+ping -c 1 -W 5 "$CENTRAL_HOST" >/dev/null 2>&1 && exit 0
+
+# gungnir-schedule <version> <id> <astroman> <pin> <start epoch> <days> <initial state>
+set -- $(head -n 1 "$SCHEDULE")
+if [ "$1" != "gungnir-schedule" ] || [ "$2" != "1" ]; then
+    logger -t gungnir "Unknown schedule format in $SCHEDULE"
+    exit 1
+fi
+ASTROMAN=$4
+PIN=$5
+START=$6
+DAYS=$7
+INITIAL=$8
+
+# A device in MANUAL mode keeps whatever state it was left in
+[ "$ASTROMAN" = "ASTRO" ] || exit 0
+
+NOW=$(date -u +%s)
+DAY=$(( (NOW - START) / 86400 ))
+MINUTE=$(( NOW % 86400 / 60 ))
+if [ "$DAY" -lt 0 ] || [ "$DAY" -ge "$DAYS" ]; then
+    logger -t gungnir "Schedule in $SCHEDULE does not cover today"
+    exit 1
+fi
+
+# The state is set by the last event up to now, line 2 is the first day
+STATE=$(awk -v day="$DAY" -v minute="$MINUTE" -v state="$INITIAL" '
+    NR == 1 { next }
+    NR - 2 > day { exit }
+    {
+        for (i = 1; i <= NF; i++) {
+            if (NR - 2 < day || substr($i, 2) + 0 <= minute)
+                state = substr($i, 1, 1) == "+" ? "on" : "off"
+        }
+    }
+    END { print state }
+' "$SCHEDULE")
+
+# Only switch when the output differs, to spare the relay
+API="http://127.0.0.1/cgi-bin"
+AUTH="username=$USERNAME&password=$PASSWORD&pin=$PIN"
+CURRENT=$(wget -q -O - "$API/io_value?$AUTH")
+if [ "$STATE" = "on" ]; then WANTED=1; else WANTED=0; fi
+[ "$CURRENT" = "$WANTED" ] && exit 0
+
+if wget -q -O /dev/null "$API/io_state?$AUTH&state=$STATE"; then
+    logger -t gungnir "Central server unreachable, turned $PIN $STATE by schedule"
+else
+    logger -t gungnir "Central server unreachable, failed to turn $PIN $STATE"
+fi
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# scheduleCompiler.py - compiles each cabinet's astro schedule for its router.
+#
+# Every device gets a small text file with one line per day of ON/OFF
+# events, which router/offlineSchedule.sh follows while the central server
+# cannot be reached. The window starts at the first of the month, so a
+# file only changes when the month rolls over or the device's location,
+# mode, pin or the offset changes. --push copies only the files whose
+# digest differs from the one last pushed to that router.
+#
+# File format, one header line and then one line per day from the start:
+#   gungnir-schedule 1 <id> <astroman> <output pin> <start epoch> <days> <initial state>
+#   -491 +1043
+# Each event is + (ON) or - (OFF) followed by the minute of the UTC day.
+# The initial state is the state at the start, "on" or "off".
+
+import argparse
+import calendar
+import datetime
+import hashlib
+import os
+import subprocess
+from datetime import timedelta
+
+import astroSchedule
+import styringDB
+
+DB_NAME = "styring.db"  # Database name
+MONTHS = 13  # Months compiled ahead, from the first of the current month
+OUTPUT_DIR = "schedules"  # Directory the compiled files are written to
+ROUTER_PATH = "/etc/gungnir/schedule"  # Where the router script reads the file
+ROUTER_USER = "root"  # User scp logs in as on the routers
+SCP_TIMEOUT = 10  # Seconds to wait for a router to accept the connection
+FORMAT_VERSION = 1  # Bumped when the router script needs to read a new format
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def window(today, months=MONTHS):
+    """Return the first day and the number of days of the window around today."""
+    start = today.replace(day=1)
+    year, month = start.year, start.month
+    days = 0
+    for _ in range(months):
+        days += calendar.monthrange(year, month)[1]
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return start, days
+
+
+def compile_schedule(device, events, start, days):
+    """Return the schedule file of one device as a string.
+
+    events is the device's list of (op, eventtime string) from
+    astroSchedule.build_schedules(), covering at least the day before start.
+    """
+    lines = [[] for _ in range(days)]
+    initial = "off"
+    for op, eventtime in events:
+        moment = datetime.datetime.strptime(eventtime, TIMESTAMP_FORMAT)
+        day = (moment.date() - start).days
+        if day < 0:
+            initial = op.lower()  # The last event before the window wins
+        elif day < days:
+            minute = moment.hour * 60 + moment.minute
+            lines[day].append(("+" if op == "ON" else "-") + str(minute))
+
+    start_epoch = calendar.timegm(start.timetuple())
+    header = (
+        f"gungnir-schedule {FORMAT_VERSION} {device['id']} {device['astroman']} "
+        f"{device['outputpin']} {start_epoch} {days} {initial}"
+    )
+    return "\n".join([header] + [" ".join(line) for line in lines]) + "\n"
+
+
+def compile_all(devices, offset, today, months=MONTHS):
+    """Compile every located device; returns (window start, {device id: text})."""
+    located = [
+        device
+        for device in devices
+        if device.get("lat") is not None and device.get("lon") is not None
+    ]
+    start, days = window(today, months)
+    # A day either side catches events the offset moves across midnight
+    events = astroSchedule.build_schedules(
+        located, offset, start - timedelta(days=1), days + 2
+    )
+    return start, {
+        device["id"]: compile_schedule(device, events[device["id"]], start, days)
+        for device in located
+    }
+
+
+def digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# Function to write the compiled files and record their digests
+def save_schedules(db_name, start, schedules, output_dir, prune=True):
+    """Write each schedule to output_dir and return the ids whose digest changed.
+
+    With prune, devices missing from schedules are forgotten.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    compiled_at = datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    changed = []
+    with styringDB.transaction(db_name) as conn:
+        known = {
+            row["device_id"]: row["digest"]
+            for row in conn.execute("SELECT device_id, digest FROM router_schedules")
+        }
+        for device_id, text in schedules.items():
+            new_digest = digest(text)
+            path = os.path.join(output_dir, f"{device_id}.txt")
+            if known.get(device_id) == new_digest and os.path.exists(path):
+                continue
+            with open(path, "w") as f:
+                f.write(text)
+            conn.execute(
+                """
+                INSERT INTO router_schedules (device_id, window_start, digest, compiled_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (device_id) DO UPDATE SET
+                    window_start = excluded.window_start,
+                    digest = excluded.digest,
+                    compiled_at = excluded.compiled_at
+            """,
+                (device_id, start.isoformat(), new_digest, compiled_at),
+            )
+            changed.append(device_id)
+
+        if prune:
+            # Forget devices that were removed or lost their location
+            removed = [
+                (device_id,) for device_id in known if device_id not in schedules
+            ]
+            conn.executemany(
+                "DELETE FROM router_schedules WHERE device_id = ?", removed
+            )
+    return changed
+
+
+def pending_pushes(db_name, device_ids=None):
+    """Return the ids whose compiled digest has not reached their router yet."""
+    with styringDB.connection(db_name) as conn:
+        rows = conn.execute(
+            "SELECT device_id FROM router_schedules "
+            "WHERE pushed_digest IS NULL OR pushed_digest != digest"
+        ).fetchall()
+    pending = [row["device_id"] for row in rows]
+    if device_ids is not None:
+        pending = [device_id for device_id in pending if device_id in device_ids]
+    return pending
+
+
+# Function to copy one schedule to its router, replacing the old one in one step
+def push_schedule(path, tsip):
+    host = f"{ROUTER_USER}@{tsip.split(':')[0]}"
+    options = ["-o", "BatchMode=yes", "-o", f"ConnectTimeout={SCP_TIMEOUT}"]
+    # Copy next to the old file and rename it, so the router never reads half a file
+    subprocess.run(
+        ["scp", "-q"] + options + [path, f"{host}:{ROUTER_PATH}.new"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    subprocess.run(
+        ["ssh"] + options + [host, f"mv {ROUTER_PATH}.new {ROUTER_PATH}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def push_all(db_name, devices, output_dir, device_ids):
+    """Push each pending schedule; returns (pushed, failed) counts."""
+    tsips = {device["id"]: device["tsip"] for device in devices}
+    pushed = failed = 0
+    for device_id in device_ids:
+        tsip = tsips.get(device_id)
+        if not tsip:
+            continue
+        path = os.path.join(output_dir, f"{device_id}.txt")
+        with open(path) as f:
+            pushed_digest = digest(f.read())
+        try:
+            push_schedule(path, tsip)
+        except (subprocess.CalledProcessError, OSError) as e:
+            stderr = getattr(e, "stderr", "") or e
+            print(f"Error pushing the schedule of {device_id} to {tsip}: {stderr}")
+            failed += 1
+            continue
+        with styringDB.transaction(db_name) as conn:
+            conn.execute(
+                "UPDATE router_schedules SET pushed_digest = ?, pushed_at = ? "
+                "WHERE device_id = ?",
+                (
+                    pushed_digest,
+                    datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT),
+                    device_id,
+                ),
+            )
+        pushed += 1
+    return pushed, failed
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile offline ON/OFF schedules for the cabinet routers."
+    )
+    parser.add_argument("--db", default=DB_NAME, help="Database name")
+    parser.add_argument("--id", help="Only compile and push this device")
+    parser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        help="Offset in minutes for lights ON/OFF times",
+    )
+    parser.add_argument(
+        "--months",
+        type=int,
+        default=MONTHS,
+        help=f"Months to compile ahead (default {MONTHS})",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=OUTPUT_DIR,
+        help=f"Directory for the compiled files (default {OUTPUT_DIR})",
+    )
+    parser.add_argument(
+        "--push",
+        action="store_true",
+        help="Copy changed schedules to the routers with scp.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="With --push, push every schedule even if the router has it.",
+    )
+    args = parser.parse_args()
+
+    # Apply pending schema migrations, the digests live in router_schedules
+    styringDB.migrate(args.db)
+
+    devices = styringDB.get_all_devices(db_name=args.db)
+    if args.id:
+        devices = [device for device in devices if device["id"] == args.id]
+        if not devices:
+            print(f"No device found with ID {args.id}")
+            return
+
+    start, schedules = compile_all(
+        devices, args.offset, datetime.datetime.utcnow().date(), args.months
+    )
+    changed = save_schedules(
+        args.db, start, schedules, args.output_dir, prune=not args.id
+    )
+    print(
+        f"Compiled {len(schedules)} schedules from {start.isoformat()}, "
+        f"{len(changed)} changed."
+    )
+
+    if args.push:
+        device_ids = set(schedules)
+        to_push = (
+            sorted(device_ids) if args.force else pending_pushes(args.db, device_ids)
+        )
+        pushed, failed = push_all(args.db, devices, args.output_dir, to_push)
+        print(f"Pushed {pushed} schedules, {failed} failed.")
+
+
+if __name__ == "__main__":
+    main()
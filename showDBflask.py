@@ -5,12 +5,24 @@
 import argparse
 import csv
 import io
+import json
 import sqlite3
+import zlib
 
-from flask import Flask, Response, abort, render_template_string
+from flask import Flask, Response, abort, render_template_string, request, url_for
+
+import metrics
+import styringDB
 
 app = Flask(__name__)
 
+PAGE_SIZE = 1000  # Rows shown per page of a table
+EXPORT_CHUNK_ROWS = 1000  # Rows fetched from the cursor per chunk of an export
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# Time every route and serve /metrics
+metrics.instrument_flask(app, "showDBflask")
+
 # HTML template for rendering tables and data
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -35,7 +47,8 @@ th, td {
   {% for table in tables %}
   <li>
     <a href="/{{ table }}">{{ table }}</a> - 
-    <a href="/download/{{ table }}/csv">csv</a>
+    <a href="/download/{{ table }}/csv">csv</a> -
+    <a href="/download/{{ table }}/ndjson">ndjson</a>
   </li>
   {% endfor %}
 </ul>
@@ -55,72 +68,206 @@ th, td {
   </tr>
   {% endfor %}
 </table>
+<p>
+  <a href="/{{ table_name }}">First page</a>
+  {% if next_url %} - <a href="{{ next_url }}">Next page</a>{% endif %}
+</p>
 {% endif %}
 </body>
 </html>
 """
 
 
-# Function to connect to your database
-def get_db_connection(db_name):
-    conn = sqlite3.connect(db_name)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-
 # Route to display tables and data
 @app.route("/", defaults={"table_name": None})
 @app.route("/<table_name>")
 def show_table(table_name):
-    conn = get_db_connection(app.config["DB_NAME"])
-    cur = conn.cursor()
-
-    if table_name is None:
-        # List all tables
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = [row[0] for row in cur.fetchall()]
-        conn.close()
-        return render_template_string(HTML_TEMPLATE, tables=tables)
-    else:
-        # Show data from the specified table
-        try:
-            cur.execute(f'SELECT * FROM "{table_name}" LIMIT 1000')
-        except sqlite3.OperationalError:
-            conn.close()
-            abort(404)
-        rows = cur.fetchall()
-        columns = [description[0] for description in cur.description]
-        conn.close()
-        return render_template_string(
-            HTML_TEMPLATE, table_name=table_name, rows=rows, columns=columns
-        )
+    with styringDB.connection(app.config["DB_NAME"], read_only=True) as conn:
+        cur = conn.cursor()
+
+        if table_name is None:
+            # List all tables
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+            tables = [row[0] for row in cur.fetchall()]
+            return render_template_string(HTML_TEMPLATE, tables=tables)
+        else:
+            # Show one page of the specified table, continuing after the
+            # key of the previous page's last row
+            if table_columns(table_name) is None:
+                abort(404)
+            keys = page_key(conn, table_name)
+            after = page_after(request.args.get("after"), keys)
+            query = f'SELECT {", ".join(keys)}, * FROM "{table_name}"'
+            if after:
+                query += f' WHERE ({", ".join(keys)}) > ({", ".join("?" * len(keys))})'
+            query += f' ORDER BY {", ".join(keys)} LIMIT {PAGE_SIZE}'
+            cur.execute(query, after or [])
+            results = cur.fetchall()
+            columns = [description[0] for description in cur.description][len(keys) :]
+            rows = [tuple(result)[len(keys) :] for result in results]
+
+            next_url = None
+            if len(results) == PAGE_SIZE:
+                last_key = list(tuple(results[-1])[: len(keys)])
+                next_url = url_for(
+                    "show_table", table_name=table_name, after=json.dumps(last_key)
+                )
+            return render_template_string(
+                HTML_TEMPLATE,
+                table_name=table_name,
+                rows=rows,
+                columns=columns,
+                next_url=next_url,
+            )
 
 
-# Route to download table as CSV
-@app.route("/download/<table_name>/csv")
-def download_csv(table_name):
-    conn = get_db_connection(app.config["DB_NAME"])
-    cur = conn.cursor()
+# Function to get the columns a table is paged by: its rowid, or the
+# primary key of a WITHOUT ROWID table
+def page_key(conn, table_name):
     try:
-        cur.execute(f'SELECT * FROM "{table_name}"')
+        conn.execute(f'SELECT rowid FROM "{table_name}" LIMIT 0')
+        return ["rowid"]
     except sqlite3.OperationalError:
-        conn.close()
-        abort(404)
-    rows = cur.fetchall()
-    columns = [description[0] for description in cur.description]
-    conn.close()
+        rows = conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+        primary_key = sorted((row["pk"], row["name"]) for row in rows if row["pk"])
+        return [f'"{name}"' for _, name in primary_key]
+
+
+# Function to read the key a page starts after from the query string
+def page_after(value, keys):
+    if not value:
+        return None
+    try:
+        after = json.loads(value)
+    except ValueError:
+        abort(400)
+    if not isinstance(after, list) or len(after) != len(keys):
+        abort(400)
+    return after
+
+
+# Function to get the column names of a table, or None if it does not exist
+def table_columns(table_name):
+    with styringDB.connection(app.config["DB_NAME"], read_only=True) as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,),
+        ).fetchone()
+        if not exists:
+            return None
+        rows = conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+    return [row["name"] for row in rows]
+
+
+# Function to build the export query from the request's column and time filters
+def export_query(table_name, all_columns, args):
+    columns = all_columns
+    if args.get("columns"):
+        columns = [column.strip() for column in args["columns"].split(",")]
+        unknown = [column for column in columns if column not in all_columns]
+        if unknown:
+            abort(400, description=f"Unknown columns: {', '.join(unknown)}")
+
+    conditions = []
+    params = []
+    if args.get("from") or args.get("to"):
+        # Default to the first column that holds a time
+        time_column = args.get("time_column") or next(
+            (
+                column
+                for column in all_columns
+                if column.endswith("time") or column.endswith("_at")
+            ),
+            None,
+        )
+        if time_column not in all_columns:
+            abort(400, description="A valid 'time_column' is needed for from/to")
+        if args.get("from"):
+            conditions.append(f'"{time_column}" >= ?')
+            params.append(args["from"])
+        if args.get("to"):
+            conditions.append(f'"{time_column}" < ?')
+            params.append(args["to"])
+
+    select = ", ".join(f'"{column}"' for column in columns)
+    query = f'SELECT {select} FROM "{table_name}"'
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query, params, columns
+
+
+# Generator that walks the cursor in chunks, so memory stays constant
+def export_rows(db_name, query, params):
+    with styringDB.connection(db_name, read_only=True) as conn:
+        cur = conn.execute(query, params)
+        while True:
+            rows = cur.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            yield rows
+
 
-    # Create CSV in-memory file
+# Generator that writes each chunk of rows as CSV text
+def csv_chunks(columns, chunks):
     output = io.StringIO()
     writer = csv.writer(output)
     writer.writerow(columns)
-    for row in rows:
-        writer.writerow(row)
-    output.seek(0)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate(0)
+    if output.tell():
+        yield output.getvalue()
+
+
+# Generator that writes each chunk of rows as one JSON object per line
+def ndjson_chunks(columns, chunks):
+    for rows in chunks:
+        yield "".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+
+# Generator that compresses the export as it is produced
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Route to download a table as CSV or NDJSON, streamed in chunks.
+# Query options: columns=a,b  from=...  to=...  time_column=...  gzip=1
+@app.route("/download/<table_name>/<export_format>")
+def download_table(table_name, export_format):
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    all_columns = table_columns(table_name)
+    if all_columns is None:
+        abort(404)
+
+    query, params, columns = export_query(table_name, all_columns, request.args)
+    chunks = export_rows(app.config["DB_NAME"], query, params)
+    if export_format == "csv":
+        body = csv_chunks(columns, chunks)
+    else:
+        body = ndjson_chunks(columns, chunks)
+
+    filename = f"{table_name}.{export_format}"
+    mimetype = EXPORT_FORMATS[export_format]
+    if request.args.get("gzip") in ("1", "true", "yes"):
+        body = gzip_chunks(body)
+        filename += ".gz"
+        mimetype = "application/gzip"
+
     return Response(
-        output,
-        mimetype="text/csv",
-        headers={"Content-Disposition": f"attachment;filename={table_name}.csv"},
+        body,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename={filename}"},
     )
 
 
@@ -0,0 +1,142 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# staggerPlanner.py - spreads ON commands over time to limit grid inrush
+
+import argparse
+import heapq
+import math
+from collections import Counter
+
+STAGGER_WINDOW = 60  # Seconds over which the ON commands of one transition are spread
+SLOT_LENGTH = 5  # Seconds per planning slot
+DS_LIMIT = 3  # ON commands per dreifistöð in one slot
+GLOBAL_RATE = 2  # ON commands per second across all dreifistöðvar
+
+
+def ds_limit_arg(value):
+    """argparse type for --ds-limit, which must allow at least one command."""
+    limit = int(value)
+    if limit < 1:
+        raise argparse.ArgumentTypeError("--ds-limit must be at least 1")
+    return limit
+
+
+class StaggerPlanner:
+    """Plans when each ON command is sent so activations are spread out.
+
+    Time is divided into slots of slot_length seconds. A plan spreads a
+    batch of devices evenly over the window, never putting more than
+    ds_limit devices of one dreifistöð (ds) or more than global_rate per
+    second in total into a slot. When the limits do not fit the batch into
+    the window, the plan runs past it rather than break them. Slots stay
+    booked between plans, so a second batch fills around the first one.
+    """
+
+    def __init__(
+        self,
+        window=STAGGER_WINDOW,
+        slot_length=SLOT_LENGTH,
+        ds_limit=DS_LIMIT,
+        global_rate=GLOBAL_RATE,
+    ):
+        if ds_limit < 1:
+            raise ValueError("ds_limit must be at least 1")
+        self.window = window
+        self.slot_length = slot_length
+        self.ds_limit = ds_limit
+        self.global_rate = global_rate
+        self.slot_capacity = max(int(global_rate * slot_length), 1)
+        self.booked = {}  # Slot number -> Counter of ds -> commands, None is the total
+        self.queue = []  # Heap of (send time, device id)
+        self.planned = {}  # Device id -> (send time, slot, ds, device)
+
+    def plan(self, devices, now):
+        """Book a send time for every device in the batch and return the plan.
+
+        devices are heimtaugaskapar rows; now is in seconds (time.monotonic()).
+        Returns a list of (send time, device) sorted by time.
+        """
+        devices = [device for device in devices if device["id"] not in self.planned]
+        if not devices:
+            return []
+
+        # Spread the batch evenly over the slots of the window
+        slots_in_window = max(int(self.window // self.slot_length), 1)
+        target = math.ceil(len(devices) / slots_in_window)
+
+        # Take devices from each ds in turn, so one ds does not fill the first slots
+        by_ds = {}
+        for device in devices:
+            by_ds.setdefault(device["ds"] or "", []).append(device)
+        remaining = sorted(by_ds.values(), key=len, reverse=True)
+
+        first_slot = int(now // self.slot_length)
+        slot = first_slot
+        plan = []
+        while remaining:
+            booked = self.booked.setdefault(slot, Counter())
+            # Only the part of a slot still ahead can take commands, or a
+            # plan made late in a slot would send a whole slot's worth at once
+            start = max(slot * self.slot_length, now)
+            capacity = self.slot_capacity
+            if start > slot * self.slot_length:
+                end = (slot + 1) * self.slot_length
+                capacity = int(self.global_rate * (end - start))
+            room = min(target, capacity - booked[None])
+            in_slot = []
+            while room > 0:
+                progress = False
+                for group in remaining:
+                    if room == 0:
+                        break
+                    ds = group[0]["ds"] or ""
+                    if booked[ds] < self.ds_limit:
+                        in_slot.append(group.pop(0))
+                        booked[ds] += 1
+                        booked[None] += 1
+                        room -= 1
+                        progress = True
+                remaining = [group for group in remaining if group]
+                if not progress or not remaining:
+                    break
+
+            # Spread the slot's commands evenly within it
+            step = (slot + 1) * self.slot_length - start
+            for index, device in enumerate(in_slot):
+                send_at = start + step * index / len(in_slot)
+                ds = device["ds"] or ""
+                self.planned[device["id"]] = (send_at, slot, ds, device)
+                heapq.heappush(self.queue, (send_at, device["id"]))
+                plan.append((send_at, device))
+            slot += 1
+
+        return plan
+
+    def cancel(self, device_id):
+        """Drop a planned command, e.g. when the device left ASTRO mode."""
+        entry = self.planned.pop(device_id, None)
+        if entry:
+            _, slot, ds, _ = entry
+            booked = self.booked.get(slot)
+            if booked:
+                booked[ds] -= 1
+                booked[None] -= 1
+
+    def due(self, now):
+        """Pop and return the devices whose send time has come."""
+        devices = []
+        while self.queue and self.queue[0][0] <= now:
+            send_at, device_id = heapq.heappop(self.queue)
+            entry = self.planned.get(device_id)
+            if entry is None or entry[0] != send_at:
+                continue  # Cancelled or planned again since
+            del self.planned[device_id]
+            devices.append(entry[3])
+
+        # Forget slots that have passed
+        current_slot = int(now // self.slot_length)
+        for slot in [slot for slot in self.booked if slot < current_slot]:
+            del self.booked[slot]
+        return devices
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# stateHistory.py - queries and retention for the state transition history.
+# The transitions and rollups are written by triggers, see styringDB.MIGRATIONS.
+
+import argparse
+import datetime
+
+import styringDB
+
+DB_NAME = "styring.db"  # Database name
+RETENTION_DAYS = 90  # Days raw transitions are kept, rollups are kept for good
+PRUNE_BATCH = 10000  # Rows deleted per transaction when pruning
+QUERY_LIMIT = 10000  # Most transitions returned by one query, the rest are paged
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _time_range(column, start, end, conditions, params):
+    if start:
+        conditions.append(f"{column} >= ?")
+        params.append(start)
+    if end:
+        conditions.append(f"{column} < ?")
+        params.append(end)
+
+
+def get_transitions(
+    device_id=None,
+    hverfi=None,
+    field=None,
+    start=None,
+    end=None,
+    after=None,
+    limit=QUERY_LIMIT,
+    db_name=DB_NAME,
+):
+    """Return the transitions of a device or a hverfi in a time range, oldest first.
+
+    start and end are timestamps as stored in changed_at; either may be None.
+    At most limit transitions are returned, ordered by (changed_at, id). To
+    get the next page, pass the (changed_at, id) of the last one as after.
+    """
+    if device_id is None and hverfi is None:
+        raise ValueError("A device_id or hverfi is required")
+
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    else:
+        conditions.append("hverfi = ?")
+        params.append(hverfi)
+    if field is not None:
+        conditions.append("field = ?")
+        params.append(field)
+    _time_range("changed_at", start, end, conditions, params)
+    if after is not None:
+        conditions.append("(changed_at, id) > (?, ?)")
+        params.extend(after)
+
+    query = (
+        "SELECT id, device_id, hverfi, field, old_value, new_value, changed_at "
+        "FROM state_transitions WHERE "
+        + " AND ".join(conditions)
+        + " ORDER BY changed_at, id LIMIT ?"
+    )
+    with styringDB.connection(db_name) as conn:
+        rows = conn.execute(query, params + [limit]).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_rollups(
+    period="hourly",
+    device_id=None,
+    hverfi=None,
+    field=None,
+    start=None,
+    end=None,
+    db_name=DB_NAME,
+):
+    """Return transition counts per period, device, field and new value.
+
+    period is "hourly" or "daily"; start and end compare with the period
+    start ("2024-11-20T16:00" or "2024-11-20").
+    """
+    if period not in styringDB.ROLLUP_PERIODS:
+        raise ValueError(f"Unknown rollup period '{period}'")
+
+    conditions = []
+    params = []
+    if device_id is not None:
+        conditions.append("device_id = ?")
+        params.append(device_id)
+    if hverfi is not None:
+        conditions.append("hverfi = ?")
+        params.append(hverfi)
+    if field is not None:
+        conditions.append("field = ?")
+        params.append(field)
+    _time_range("period", start, end, conditions, params)
+
+    query = (
+        "SELECT period, device_id, hverfi, field, new_value, transitions "
+        f"FROM state_rollup_{period}"
+    )
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY period, device_id, field, new_value"
+    with styringDB.connection(db_name) as conn:
+        rows = conn.execute(query, params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def prune(retention_days=RETENTION_DAYS, db_name=DB_NAME, now=None):
+    """Delete raw transitions older than the retention, keeping the rollups.
+
+    Deletes in batches so writers are never locked out for long. Returns the
+    number of rows deleted.
+    """
+    now = now or datetime.datetime.utcnow()
+    cutoff = (now - datetime.timedelta(days=retention_days)).strftime(TIMESTAMP_FORMAT)
+    deleted = 0
+    while True:
+        with styringDB.transaction(db_name) as conn:
+            cursor = conn.execute(
+                """
+                DELETE FROM state_transitions WHERE id IN (
+                    SELECT id FROM state_transitions
+                    WHERE changed_at < ? ORDER BY changed_at LIMIT ?
+                )
+            """,
+                (cutoff, PRUNE_BATCH),
+            )
+        deleted += cursor.rowcount
+        if cursor.rowcount < PRUNE_BATCH:
+            return deleted
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query or prune the state transition history."
+    )
+    parser.add_argument("--db", default=DB_NAME, help="Database name")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete transitions older than the retention (rollups are kept)",
+    )
+    group.add_argument("--id", help="Print the transitions of a device")
+    group.add_argument("--hverfi", help="Print the transitions of a hverfi")
+    parser.add_argument(
+        "--retention-days",
+        type=int,
+        default=RETENTION_DAYS,
+        help=f"Days of raw transitions to keep (default {RETENTION_DAYS})",
+    )
+    parser.add_argument("--from", dest="start", help="Start of the time range")
+    parser.add_argument("--to", dest="end", help="End of the time range")
+    args = parser.parse_args()
+
+    if args.prune:
+        deleted = prune(args.retention_days, db_name=args.db)
+        print(f"Deleted {deleted} transitions older than {args.retention_days} days.")
+        return
+
+    # Page through the whole range
+    after = None
+    while True:
+        transitions = get_transitions(
+            device_id=args.id,
+            hverfi=args.hverfi,
+            start=args.start,
+            end=args.end,
+            after=after,
+            db_name=args.db,
+        )
+        for transition in transitions:
+            print(
+                f"{transition['changed_at']} {transition['device_id']} "
+                f"{transition['field']}: {transition['old_value']} -> {transition['new_value']}"
+            )
+        if len(transitions) < QUERY_LIMIT:
+            break
+        after = (transitions[-1]["changed_at"], transitions[-1]["id"])
+
+
+if __name__ == "__main__":
+    main()
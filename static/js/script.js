@@ -92,6 +92,45 @@ const handleDeviceButtonClick = (event) => {
   document.location.hash = newDevice.id;
 };
 
+// ---------------------------------------------------------------------------
+
+const MODES = ['ASTRO', 'MANUAL'];
+
+const applyDeviceDelta = (delta) => {
+  const device = document.querySelector(
+    `.device[data-device-id="${CSS.escape(delta.id)}"]`
+  );
+  if (!device) {
+    return;
+  }
+  Object.entries(delta).forEach(([field, value]) => {
+    device.querySelectorAll(`[data-field="${field}"]`).forEach((el) => {
+      el.textContent = value ?? 'None';
+    });
+  });
+  if ('astroman' in delta) {
+    device.querySelector('.device-mode').hidden = !MODES.includes(
+      delta.astroman
+    );
+    device.querySelector('.manual-controls').hidden =
+      delta.astroman !== 'MANUAL';
+  }
+};
+
+const subscribeToDeviceEvents = () => {
+  const { eventsUrl, version } = document.body.dataset;
+  if (!window.EventSource || !eventsUrl) {
+    return;
+  }
+  // On reconnect the browser sends the id of the last event it got instead
+  const source = new EventSource(
+    `${eventsUrl}?since=${encodeURIComponent(version)}`
+  );
+  source.addEventListener('device', (event) => {
+    applyDeviceDelta(JSON.parse(event.data));
+  });
+};
+
 // ===========================================================================
 
 const main = () => {
@@ -120,6 +159,9 @@ const main = () => {
 
   initializeOpenSectionsBasedOnURL();
   restoreTempSavedScrollState(); // open states must have been restored first
+
+  // Keep device states current without reloading the page
+  subscribeToDeviceEvents();
 };
 
 // ===========================================================================
@@ -0,0 +1,679 @@
+# SPDX-FileCopyrightText: 2024 Davíð Berman <davidjberman@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+# styringDB.py - shared data access for styring.db
+
+import argparse
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from metrics import db_lock_retries_total, db_lock_wait_seconds, db_write_seconds
+
+DB_NAME = "styring.db"  # Database name
+BUSY_TIMEOUT = 5000  # Milliseconds SQLite waits on a locked database
+LOCK_RETRIES = 5  # Times a write transaction is retried if the database stays locked
+LOCK_RETRY_DELAY = 0.2  # Seconds before the first retry, doubled on each attempt
+POOL_SIZE = 8  # Idle connections kept per database file
+STATEMENT_CACHE_SIZE = 256  # Prepared statements cached per connection
+CHANGE_LOG_SIZE = 10000  # Rows kept in the heimtaugaskapar_changes log
+HISTORY_FIELDS = ("outputstate", "inputstate", "localremote")  # Kept in state history
+ROLLUP_PERIODS = {  # Rollup table suffix -> SQLite expression of the period start
+    "hourly": "strftime('%Y-%m-%dT%H:00', 'now')",
+    "daily": "date('now')",
+}
+
+# Columns the control scripts are allowed to write
+WRITABLE_COLUMNS = {
+    "inputstate",
+    "outputstate",
+    "localremote",
+    "astroman",
+    "astrostate",
+    "uxstate",
+    "lastastrotime",
+    "lasastroOP",
+    "nextastrotime",
+    "nextastroOP",
+}
+
+_pools = {}  # (Database file, read only) -> queue of idle connections
+_pools_lock = threading.Lock()
+_checked_out = threading.local()  # Connections in use by the current thread
+
+
+def _open_connection(db_name, read_only=False):
+    database = db_name
+    if read_only:
+        # A read-only URI neither creates the file nor changes its journal mode
+        database = f"file:{pathname2url(os.path.abspath(db_name))}?mode=ro"
+    conn = sqlite3.connect(
+        database,
+        timeout=BUSY_TIMEOUT / 1000,
+        isolation_level=None,  # Transactions are started explicitly
+        check_same_thread=False,  # Connections move between threads via the pool
+        cached_statements=STATEMENT_CACHE_SIZE,
+        uri=read_only,
+    )
+    conn.row_factory = sqlite3.Row  # Enable dict-like access to rows
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+    if read_only:
+        return conn
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def _get_pool(key):
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return _pools[key]
+
+
+@contextmanager
+def connection(db_name=DB_NAME, read_only=False):
+    """Check a pooled connection out for the current thread.
+
+    Nested calls on the same thread reuse the connection already checked out,
+    so a query helper can be called inside a transaction. read_only opens
+    the file as it is, for tools that only look at a database.
+    """
+    key = (db_name, read_only)
+    in_use = _checked_out.__dict__.setdefault("connections", {})
+    if key in in_use:
+        conn, depth = in_use[key]
+        in_use[key] = (conn, depth + 1)
+        try:
+            yield conn
+        finally:
+            conn, depth = in_use[key]
+            in_use[key] = (conn, depth - 1)
+        return
+
+    pool = _get_pool(key)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection(db_name, read_only)
+    in_use[key] = (conn, 1)
+    try:
+        yield conn
+    finally:
+        del in_use[key]
+        if conn.in_transaction:
+            conn.rollback()  # Never hand a half-finished transaction to the pool
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def _is_locked(error):
+    return "locked" in str(error) or "busy" in str(error)
+
+
+@contextmanager
+def transaction(db_name=DB_NAME):
+    """Run the enclosed statements in one write transaction.
+
+    The write lock is taken up front with BEGIN IMMEDIATE, retrying with
+    backoff while another process holds it, so the statements inside never
+    fail with "database is locked" halfway through.
+    """
+    with connection(db_name) as conn:
+        if conn.in_transaction:
+            yield conn  # Already inside a transaction on this thread
+            return
+
+        started = time.perf_counter()
+        delay = LOCK_RETRY_DELAY
+        for attempt in range(LOCK_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if not _is_locked(e) or attempt == LOCK_RETRIES:
+                    raise
+                db_lock_retries_total.inc()
+                time.sleep(delay)
+                delay *= 2
+        db_lock_wait_seconds.observe(time.perf_counter() - started)
+
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        db_write_seconds.observe(time.perf_counter() - started)
+
+
+# Schema migrations, applied in order. PRAGMA user_version holds the number
+# of migrations already applied to a database.
+MIGRATIONS = [
+    (
+        "Change log of heimtaugaskapar, filled by triggers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS heimtaugaskapar_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL,
+                changed_at TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS heimtaugaskapar_changes_device
+            ON heimtaugaskapar_changes (device_id, seq)
+            """,
+        ]
+        + [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS heimtaugaskapar_log_{event.lower()}
+            AFTER {event} ON heimtaugaskapar
+            BEGIN
+                INSERT INTO heimtaugaskapar_changes (device_id, changed_at)
+                VALUES ({row}.id, strftime('%Y-%m-%dT%H:%M:%f', 'now'));
+                DELETE FROM heimtaugaskapar_changes
+                WHERE seq <= (SELECT MAX(seq) FROM heimtaugaskapar_changes)
+                    - {CHANGE_LOG_SIZE};
+            END
+            """
+            for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD"))
+        ],
+    ),
+    (
+        "Indexes for device lookups by id, hs and tsip",
+        [
+            "CREATE INDEX IF NOT EXISTS heimtaugaskapar_id ON heimtaugaskapar (id)",
+            "CREATE INDEX IF NOT EXISTS heimtaugaskapar_hs ON heimtaugaskapar (hs)",
+            "CREATE INDEX IF NOT EXISTS heimtaugaskapar_tsip ON heimtaugaskapar (tsip)",
+        ],
+    ),
+    (
+        "State transition history with hourly and daily rollups",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS state_transitions (
+                id INTEGER PRIMARY KEY,
+                device_id TEXT NOT NULL,
+                hverfi TEXT,
+                field TEXT NOT NULL,
+                old_value TEXT,
+                new_value TEXT,
+                changed_at TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS state_transitions_device
+            ON state_transitions (device_id, changed_at)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS state_transitions_hverfi
+            ON state_transitions (hverfi, changed_at)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS state_transitions_time
+            ON state_transitions (changed_at)
+            """,
+        ]
+        + [
+            statement
+            for period in ROLLUP_PERIODS
+            for statement in (
+                f"""
+                CREATE TABLE IF NOT EXISTS state_rollup_{period} (
+                    period TEXT NOT NULL,
+                    device_id TEXT NOT NULL,
+                    hverfi TEXT,
+                    field TEXT NOT NULL,
+                    new_value TEXT NOT NULL,
+                    transitions INTEGER NOT NULL,
+                    PRIMARY KEY (period, device_id, field, new_value)
+                ) WITHOUT ROWID
+                """,
+                f"""
+                CREATE INDEX IF NOT EXISTS state_rollup_{period}_device
+                ON state_rollup_{period} (device_id, period)
+                """,
+                f"""
+                CREATE INDEX IF NOT EXISTS state_rollup_{period}_hverfi
+                ON state_rollup_{period} (hverfi, period)
+                """,
+            )
+        ]
+        # One trigger per field appends the transition and counts it in the
+        # rollups, so every writer (pollers, commands, scripts) is recorded
+        + [
+            f"""
+            CREATE TRIGGER IF NOT EXISTS state_transitions_{field}
+            AFTER UPDATE OF {field} ON heimtaugaskapar
+            WHEN OLD.{field} IS NOT NEW.{field}
+            BEGIN
+                INSERT INTO state_transitions
+                    (device_id, hverfi, field, old_value, new_value, changed_at)
+                VALUES (
+                    NEW.id, NEW.hverfi, '{field}', OLD.{field}, NEW.{field},
+                    strftime('%Y-%m-%dT%H:%M:%f', 'now')
+                );
+            """
+            + "".join(
+                f"""
+                INSERT INTO state_rollup_{period}
+                    (period, device_id, hverfi, field, new_value, transitions)
+                VALUES (
+                    {period_start}, NEW.id, NEW.hverfi, '{field}',
+                    COALESCE(NEW.{field}, ''), 1
+                )
+                ON CONFLICT (period, device_id, field, new_value)
+                DO UPDATE SET transitions = transitions + 1;
+                """
+                for period, period_start in ROLLUP_PERIODS.items()
+            )
+            + "END"
+            for field in HISTORY_FIELDS
+        ],
+    ),
+    (
+        "Last switch command sent to each device",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS device_commands (
+                device_id TEXT PRIMARY KEY,
+                state TEXT,
+                issued_at TEXT
+            )
+            """,
+        ],
+    ),
+    (
+        "Last change of each device, kept when the change log is trimmed",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS heimtaugaskapar_versions (
+                device_id TEXT PRIMARY KEY,
+                seq INTEGER NOT NULL
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS heimtaugaskapar_versions_log
+            AFTER INSERT ON heimtaugaskapar_changes
+            BEGIN
+                INSERT INTO heimtaugaskapar_versions (device_id, seq)
+                VALUES (NEW.device_id, NEW.seq)
+                ON CONFLICT (device_id) DO UPDATE SET seq = excluded.seq;
+            END
+            """,
+            # Devices without a change in the log keep the version they
+            # had before, the seq just below the oldest entry
+            """
+            INSERT OR REPLACE INTO heimtaugaskapar_versions (device_id, seq)
+            SELECT id, COALESCE(
+                (
+                    SELECT MAX(seq) FROM heimtaugaskapar_changes
+                    WHERE device_id = device.id
+                ),
+                (SELECT MIN(seq) - 1 FROM heimtaugaskapar_changes),
+                0
+            )
+            FROM heimtaugaskapar AS device
+            """,
+        ],
+    ),
+    (
+        "Digests of the offline schedules compiled for the routers",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS router_schedules (
+                device_id TEXT PRIMARY KEY,
+                window_start TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                compiled_at TEXT NOT NULL,
+                pushed_digest TEXT,
+                pushed_at TEXT
+            )
+            """,
+        ],
+    ),
+    (
+        "Poller workers and their partition leases",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS poller_workers (
+                worker_id TEXT PRIMARY KEY,
+                host TEXT,
+                pid INTEGER,
+                heartbeat_at TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS poller_leases (
+                partition TEXT PRIMARY KEY,
+                worker_id TEXT,
+                expires_at TEXT NOT NULL DEFAULT ''
+            )
+            """,
+        ],
+    ),
+]
+
+
+def migrate(db_name=DB_NAME):
+    """Apply the migrations this database has not had yet.
+
+    Returns the descriptions of the migrations applied.
+    """
+    applied = []
+    with transaction(db_name) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, (description, statements) in enumerate(
+            MIGRATIONS[version:], start=version + 1
+        ):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            applied.append(description)
+    return applied
+
+
+# Named queries on the heimtaugaskapar_changes log, whose last seq is a
+# version number that grows with every change to heimtaugaskapar
+
+
+def get_data_version(db_name=DB_NAME):
+    """Return the seq of the last change to heimtaugaskapar, 0 if none."""
+    with connection(db_name) as conn:
+        row = conn.execute("SELECT MAX(seq) FROM heimtaugaskapar_changes").fetchone()
+    return row[0] or 0
+
+
+def get_device_version(device_id, db_name=DB_NAME):
+    """Return a version number that grows with every change to one device.
+
+    It comes from heimtaugaskapar_versions, so trimming the log leaves the
+    version of a quiet device alone.
+    """
+    with connection(db_name) as conn:
+        row = conn.execute(
+            "SELECT seq FROM heimtaugaskapar_versions WHERE device_id = ?",
+            (device_id,),
+        ).fetchone()
+    return row[0] if row else 0
+
+
+def get_changes_since(seq, db_name=DB_NAME):
+    """Return (version, ids of devices changed after seq, complete).
+
+    complete is False when the log has been pruned past seq, so some
+    changes can no longer be listed and the caller has to reload everything.
+    """
+    with connection(db_name) as conn:
+        conn.execute("BEGIN")
+        try:
+            version, oldest = conn.execute(
+                "SELECT MAX(seq), MIN(seq) FROM heimtaugaskapar_changes"
+            ).fetchone()
+            rows = conn.execute(
+                "SELECT DISTINCT device_id FROM heimtaugaskapar_changes WHERE seq > ?",
+                (seq,),
+            ).fetchall()
+        finally:
+            conn.rollback()
+    complete = oldest is None or oldest <= seq + 1
+    return version or 0, [row["device_id"] for row in rows], complete
+
+
+# Named queries on the heimtaugaskapar table
+
+
+def get_all_devices(db_name=DB_NAME):
+    """Return every device as a dict."""
+    with connection(db_name) as conn:
+        rows = conn.execute("SELECT * FROM heimtaugaskapar").fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_all_devices_with_version(db_name=DB_NAME):
+    """Return the data version and every device, read from the same snapshot."""
+    with connection(db_name) as conn:
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute(
+                "SELECT MAX(seq) FROM heimtaugaskapar_changes"
+            ).fetchone()[0]
+            rows = conn.execute("SELECT * FROM heimtaugaskapar").fetchall()
+        finally:
+            conn.rollback()
+    return version or 0, [dict(row) for row in rows]
+
+
+def get_device_columns(db_name=DB_NAME):
+    """Return the column names of the heimtaugaskapar table."""
+    with connection(db_name) as conn:
+        rows = conn.execute("PRAGMA table_info(heimtaugaskapar)").fetchall()
+    return [row["name"] for row in rows]
+
+
+def query_devices(
+    fields=None,
+    ids=None,
+    hverfi=None,
+    astroman=None,
+    after_id=None,
+    limit=None,
+    db_name=DB_NAME,
+):
+    """Return the data version and a filtered page of devices, ordered by id.
+
+    fields limits the columns selected (id is always included), ids, hverfi
+    and astroman filter the rows, and after_id/limit select a page by keyset.
+    Column names in fields must have been checked against get_device_columns().
+    """
+    columns = "*"
+    if fields:
+        columns = ", ".join(["id"] + [field for field in fields if field != "id"])
+
+    conditions = []
+    params = []
+    if ids:
+        conditions.append(f"id IN ({', '.join('?' * len(ids))})")
+        params.extend(ids)
+    if hverfi is not None:
+        conditions.append("hverfi = ?")
+        params.append(hverfi)
+    if astroman is not None:
+        conditions.append("astroman = ?")
+        params.append(astroman)
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+
+    query = f"SELECT {columns} FROM heimtaugaskapar"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+
+    with connection(db_name) as conn:
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute(
+                "SELECT MAX(seq) FROM heimtaugaskapar_changes"
+            ).fetchone()[0]
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.rollback()
+    return version or 0, [dict(row) for row in rows]
+
+
+def get_device_ids(db_name=DB_NAME):
+    """Return the id of every device."""
+    with connection(db_name) as conn:
+        rows = conn.execute("SELECT id FROM heimtaugaskapar").fetchall()
+    return [row["id"] for row in rows]
+
+
+def get_device_by_id(device_id, db_name=DB_NAME):
+    """Return the device with the given id as a dict, or None."""
+    with connection(db_name) as conn:
+        row = conn.execute(
+            "SELECT * FROM heimtaugaskapar WHERE id = ?", (device_id,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def get_devices_by_ids(device_ids, db_name=DB_NAME):
+    """Return a dict of device id -> device dict, or None if it does not exist."""
+    devices = dict.fromkeys(device_ids)
+    device_ids = list(devices)
+    with connection(db_name) as conn:
+        for start in range(0, len(device_ids), 500):
+            chunk = device_ids[start : start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in conn.execute(
+                f"SELECT * FROM heimtaugaskapar WHERE id IN ({placeholders})", chunk
+            ):
+                devices[row["id"]] = dict(row)
+    return devices
+
+
+def get_device_with_version(device_id, db_name=DB_NAME):
+    """Return a device's version and the device as a dict, from the same snapshot.
+
+    The device is None if it does not exist.
+    """
+    with connection(db_name) as conn:
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute(
+                "SELECT * FROM heimtaugaskapar WHERE id = ?", (device_id,)
+            ).fetchone()
+            version = conn.execute(
+                "SELECT seq FROM heimtaugaskapar_versions WHERE device_id = ?",
+                (device_id,),
+            ).fetchone()
+        finally:
+            conn.rollback()
+    return (version[0] if version else 0), (dict(row) if row else None)
+
+
+def get_device_by_hs(hs, db_name=DB_NAME):
+    """Return the device with the given HS number as a dict, or None."""
+    with connection(db_name) as conn:
+        row = conn.execute(
+            "SELECT * FROM heimtaugaskapar WHERE hs = ?", (hs,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def get_device_by_tsip(tsip, db_name=DB_NAME):
+    """Return the device with the given Tailscale IP as a dict, or None."""
+    with connection(db_name) as conn:
+        row = conn.execute(
+            "SELECT * FROM heimtaugaskapar WHERE tsip = ?", (tsip,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def get_devices_in_group(hverfi=None, ds=None, db_name=DB_NAME):
+    """Return the devices in a hverfi and/or dreifistöð as dicts."""
+    conditions = []
+    params = []
+    if hverfi is not None:
+        conditions.append("hverfi = ?")
+        params.append(hverfi)
+    if ds is not None:
+        conditions.append("ds = ?")
+        params.append(ds)
+    if not conditions:
+        raise ValueError("A hverfi or ds is required")
+
+    query = "SELECT * FROM heimtaugaskapar WHERE " + " AND ".join(conditions)
+    with connection(db_name) as conn:
+        rows = conn.execute(query + " ORDER BY id", params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _update_query(columns):
+    for column in columns:
+        if column not in WRITABLE_COLUMNS:
+            raise ValueError(f"Column '{column}' cannot be updated")
+    assignments = ", ".join(f"{column} = ?" for column in columns)
+    return f"UPDATE heimtaugaskapar SET {assignments} WHERE id = ?"
+
+
+def update_device(device_id, db_name=DB_NAME, **values):
+    """Set one or more columns of a single device."""
+    columns = sorted(values)
+    with transaction(db_name) as conn:
+        conn.execute(
+            _update_query(columns),
+            [values[column] for column in columns] + [device_id],
+        )
+
+
+def update_devices(columns, rows, db_name=DB_NAME):
+    """Set the same columns on many devices in one transaction.
+
+    rows is a list of (device_id, values) with values in the order of columns.
+    """
+    if not rows:
+        return
+    query = _update_query(columns)
+    with transaction(db_name) as conn:
+        conn.executemany(
+            query, [list(values) + [device_id] for device_id, values in rows]
+        )
+
+
+# Named queries on the device_commands table, which remembers the last
+# switch command sent to each device
+
+
+def record_command(device_id, state, issued_at, db_name=DB_NAME):
+    """Remember that a switch command was sent to a device."""
+    with transaction(db_name) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO device_commands (device_id, state, issued_at) "
+            "VALUES (?, ?, ?)",
+            (device_id, state, issued_at),
+        )
+
+
+def get_command_times(db_name=DB_NAME):
+    """Return a dict of device id -> time its last command was issued."""
+    with connection(db_name) as conn:
+        rows = conn.execute(
+            "SELECT device_id, issued_at FROM device_commands"
+        ).fetchall()
+    return {row["device_id"]: row["issued_at"] for row in rows}
+
+
+# Main function to handle command-line arguments
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the styring database.")
+    parser.add_argument("--db", default=DB_NAME, help="Database name")
+    parser.add_argument(
+        "--migrate", action="store_true", help="Apply pending schema migrations"
+    )
+    args = parser.parse_args()
+
+    if args.migrate:
+        applied = migrate(args.db)
+        for description in applied:
+            print(f"Applied: {description}")
+        print(f"{len(applied)} migrations applied to {args.db}.")
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,22 +3,62 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import argparse
-import sqlite3
+
+import styringDB
+
+
+# Tables that may be updated, with the columns that may be set and the
+# columns that may be used to identify a row
+UPDATABLE_TABLES = {
+    "heimtaugaskapar": {
+        "columns": styringDB.WRITABLE_COLUMNS,
+        "keys": {"id", "hs", "tsip"},
+    },
+}
+
+
+# Function to check table and column names against the whitelist
+def validate_update(table_name, columns, col_name):
+    if table_name not in UPDATABLE_TABLES:
+        raise ValueError(f"Table '{table_name}' cannot be updated")
+    allowed = UPDATABLE_TABLES[table_name]
+    if col_name not in allowed["keys"]:
+        raise ValueError(f"Column '{col_name}' cannot be used to identify rows")
+    for column in columns:
+        if column not in allowed["columns"]:
+            raise ValueError(f"Column '{column}' cannot be updated")
+
+
+# Function to update several columns of several rows in one transaction
+def update_db_cells(db_name, table_name, col_name, rows):
+    """Apply rows of (col_name_value, {column: new_value}) in one transaction."""
+    if not rows:
+        return
+
+    # Group rows by the set of columns they change so each group is one
+    # executemany of the same parameterized statement.
+    groups = {}
+    for col_name_value, values in rows:
+        validate_update(table_name, values, col_name)
+        columns = tuple(sorted(values))
+        groups.setdefault(columns, []).append(
+            [values[column] for column in columns] + [col_name_value]
+        )
+
+    with styringDB.transaction(db_name) as conn:
+        for columns, params in groups.items():
+            assignments = ", ".join(f"{column} = ?" for column in columns)
+            query = f"UPDATE {table_name} SET {assignments} WHERE {col_name} = ?"
+            conn.executemany(query, params)
 
 
 # Function to update a specific cell in the database
 def update_db_cell(
     db_name, table_name, col_to_change, col_name, col_name_value, new_value
 ):
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
-    # Construct and execute the SQL update query
-    query = f"UPDATE {table_name} SET {col_to_change} = ? WHERE {col_name} = ?"
-    cursor.execute(query, (new_value, col_name_value))
-
-    conn.commit()
-    conn.close()
+    update_db_cells(
+        db_name, table_name, col_name, [(col_name_value, {col_to_change: new_value})]
+    )
     print(
         f"Updated {col_to_change} to {new_value} for {col_name} = {col_name_value} in table {table_name}"
     )
@@ -2,21 +2,28 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import sqlite3
+import json
+import queue
 import subprocess
 from datetime import datetime
 
-from flask import Flask, redirect, render_template, request, url_for
+from flask import Flask, Response, redirect, render_template, request, url_for
+
+import metrics
+import styringDB
+from commandQueue import get_queue, switch_group
+from deviceEvents import get_feed
+from deviceRegistry import get_registry
 
 app = Flask(__name__)
 
 DATABASE = "styring.db"
+EVENTS_KEEPALIVE = 15  # Seconds between comments that keep an idle stream open
+EVENTS_RETRY = 5000  # Milliseconds a browser waits before reconnecting
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # Enable dict-like access to rows
-    return conn
+# Time every route and serve /metrics
+metrics.instrument_flask(app, "ux")
 
 
 # Custom Jinja2 filter to format datetime strings
@@ -38,9 +45,7 @@ def datetimeformat(value):
 
 @app.route("/")
 def index():
-    conn = get_db_connection()
-    devices = conn.execute("SELECT * FROM heimtaugaskapar").fetchall()
-    conn.close()
+    version, devices = styringDB.get_all_devices_with_version(db_name=DATABASE)
 
     # Organize devices by hverfi
     hverfi_dict = {}
@@ -50,19 +55,58 @@ def index():
             hverfi_dict[hverfi] = []
         hverfi_dict[hverfi].append(device)
 
-    return render_template("index.html", hverfi_dict=hverfi_dict)
+    return render_template("index.html", hverfi_dict=hverfi_dict, version=version)
+
+
+# Helper function to format a batch of device deltas as Server-Sent Events
+def format_events(version, deltas):
+    return "".join(
+        f"id: {version}\nevent: device\ndata: {json.dumps(delta, ensure_ascii=False)}\n\n"
+        for delta in deltas
+    )
+
+
+@app.route("/events")
+def events():
+    # The page passes the version it was rendered at, a reconnecting browser
+    # the id of the last event it received
+    since = request.headers.get("Last-Event-ID") or request.args.get("since")
+    feed = get_feed(DATABASE)
+    subscription = feed.subscribe()
+
+    def generate():
+        try:
+            yield f"retry: {EVENTS_RETRY}\n\n"
+
+            # Send every device's state if the browser missed any change
+            version, snapshot = feed.snapshot()
+            if not since or not since.isdigit() or int(since) < version:
+                yield format_events(version, snapshot)
+
+            while True:
+                try:
+                    version, deltas = subscription.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    if not feed.is_subscribed(subscription):
+                        return  # Dropped for falling behind, the browser reconnects
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_events(version, deltas)
+        finally:
+            feed.unsubscribe(subscription)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/update_astroman", methods=["POST"])
 def update_astroman():
     device_id = request.form["device_id"]
     new_mode = request.form["astroman"]
-    conn = get_db_connection()
-    conn.execute(
-        "UPDATE heimtaugaskapar SET astroman = ? WHERE id = ?", (new_mode, device_id)
-    )
-    conn.commit()
-    conn.close()
+    get_registry(DATABASE).update_device(device_id, astroman=new_mode)
     return redirect(url_for("index"))
 
 
@@ -70,12 +114,8 @@ def update_astroman():
 def update_uxstate():
     device_id = request.form["device_id"]
     new_state = request.form["uxstate"]
-    conn = get_db_connection()
-
     # Get current outputstate
-    device = conn.execute(
-        "SELECT outputstate FROM heimtaugaskapar WHERE id = ?", (device_id,)
-    ).fetchone()
+    device = get_registry(DATABASE).get_by_id(device_id)
     if device is not None:
         current_outputstate = device["outputstate"]
         if new_state != current_outputstate:
@@ -98,13 +138,39 @@ def update_uxstate():
         print(f"Device {device_id} not found in database.")
 
     # Update uxstate in database
-    conn.execute(
-        "UPDATE heimtaugaskapar SET uxstate = ? WHERE id = ?", (new_state, device_id)
+    get_registry(DATABASE).update_device(device_id, uxstate=new_state)
+    return redirect(url_for("index"))
+
+
+@app.route("/update_group_uxstate", methods=["POST"])
+def update_group_uxstate():
+    hverfi = request.form["hverfi"]
+    new_state = request.form["uxstate"]
+    devices = styringDB.get_devices_in_group(hverfi=hverfi, db_name=DATABASE)
+
+    # Only devices whose output differs need a switch, the rest just get uxstate
+    manual = [device for device in devices if device["astroman"] == "MANUAL"]
+    to_switch = [device for device in manual if device["outputstate"] != new_state]
+    styringDB.update_devices(
+        ["uxstate"],
+        [(device["id"], [new_state]) for device in manual],
+        db_name=DATABASE,
     )
-    conn.commit()
-    conn.close()
+
+    # Switch them all at once and wait for the results before redirecting
+    counts = {}
+    for result in switch_group(to_switch, new_state, queue=get_queue(DATABASE)):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        if result["status"] != "verified":
+            print(
+                f"Device {result['device_id']} in {hverfi}: {result['status']} {result.get('error') or ''}"
+            )
+    print(f"Turned {hverfi} {new_state}: {counts or 'no devices needed switching'}")
     return redirect(url_for("index"))
 
 
 if __name__ == "__main__":
+    # Apply pending schema migrations, the device registry follows the change log.
+    # Under another WSGI server run "styringDB.py --migrate" first.
+    styringDB.migrate(DATABASE)
     app.run(host="0.0.0.0", port=5051)